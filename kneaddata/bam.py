@@ -0,0 +1,298 @@
+"""
+KneadData: bam module
+
+Copyright (c) 2015 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import struct
+import string
+import logging
+
+from kneaddata import bgzf
+
+# name global logging instance
+logger=logging.getLogger(__name__)
+
+# the name length, cigar length, flag, and sequence length of each record (at this
+# offset from the start of the record, see the SAM/BAM specification)
+record_fields=struct.Struct("<B3xHHi")
+record_fields_offset=12
+record_name_offset=36
+
+flag_paired=0x1
+flag_reverse=0x10
+flag_read1=0x40
+flag_read2=0x80
+flag_secondary=0x100
+flag_supplementary=0x800
+
+# the bases for the high and low four bits of each byte of the sequence (two bases packed in each byte)
+sequence_bases=bytearray(b"=ACMGRSVTWYHKDBN")
+first_base_table=bytes(bytearray([sequence_bases[i >> 4] for i in range(256)]))
+second_base_table=bytes(bytearray([sequence_bases[i & 15] for i in range(256)]))
+try:
+    complement_table=string.maketrans(b"ACGTMRWSYKVHDBN", b"TGCAKYWSRMBDHVN")
+except AttributeError:
+    # allow for python3 in which maketrans is from the bytes class
+    complement_table=bytes.maketrans(b"ACGTMRWSYKVHDBN", b"TGCAKYWSRMBDHVN")
+# warn when this many mates are held in memory waiting for the other mate
+max_unpaired_mates=1000000
+
+# convert the phred qualities to fastq (with quality 1 if the qualities are not stored, as in samtools)
+quality_table=bytes(bytearray([min(i+33, 126) for i in range(255)]+[34]))
+
+def read_records(file, threads=1):
+    """ Yield lists of the flag, name, sequence, and qualities (converted to fastq) of the records in the BAM file """
+
+    data=b""
+    header_read=False
+    for block in bgzf.read_blocks(file, threads):
+        data+=block
+        offset=0
+        if not header_read:
+            offset=get_header_size(data)
+            if offset is None:
+                continue
+            header_read=True
+
+        offset, records=decode_records(data, offset)
+        yield records
+        data=data[offset:]
+
+    if data or not header_read:
+        raise ValueError("Truncated BAM file")
+
+def get_header_size(data):
+    """ Return the size of the header (text and references) or None if the data does not contain the full header """
+
+    if len(data) < 8:
+        return None
+    if data[:4] != b"BAM\x01":
+        raise ValueError("Not a BAM file")
+
+    offset=8+struct.unpack_from("<i", data, 4)[0]
+    if offset+4 > len(data):
+        return None
+    total_references=struct.unpack_from("<i", data, offset)[0]
+    offset+=4
+    for index in range(total_references):
+        if offset+4 > len(data):
+            return None
+        offset+=4+struct.unpack_from("<i", data, offset)[0]+4
+    if offset > len(data):
+        return None
+
+    return offset
+
+def decode_records(data, offset):
+    """ Decode the complete records in the data starting at the offset, returning the offset
+    after the last complete record and the flag, name, sequence, and qualities for each record
+    (decoding the sequences and qualities for all records at once) """
+
+    flags=[]
+    names=[]
+    packed_sequences=[]
+    qualities=[]
+    lengths=[]
+    data_length=len(data)
+    while offset+4 <= data_length:
+        end=offset+4+struct.unpack_from("<i", data, offset)[0]
+        if end > data_length:
+            break
+        name_length, cigar_length, flag, sequence_length=record_fields.unpack_from(data, offset+record_fields_offset)
+        # the name is null terminated
+        name_start=offset+record_name_offset
+        sequence_start=name_start+name_length+cigar_length*4
+        quality_start=sequence_start+(sequence_length+1)//2
+        flags.append(flag)
+        names.append(data[name_start:name_start+name_length-1])
+        packed_sequences.append(data[sequence_start:quality_start])
+        qualities.append(data[quality_start:quality_start+sequence_length])
+        lengths.append(sequence_length)
+        offset=end
+
+    # two bases are packed in each byte so decode the first and second base of each byte
+    packed_sequence=b"".join(packed_sequences)
+    sequence=bytearray(len(packed_sequence)*2)
+    sequence[0::2]=packed_sequence.translate(first_base_table)
+    sequence[1::2]=packed_sequence.translate(second_base_table)
+    sequence=bytes(sequence)
+    quality=b"".join(qualities).translate(quality_table)
+
+    records=[]
+    sequence_offset=0
+    quality_offset=0
+    for flag, name, length in zip(flags, names, lengths):
+        records.append((flag, name, sequence[sequence_offset:sequence_offset+length],
+            quality[quality_offset:quality_offset+length]))
+        sequence_offset+=(length+1)//2*2
+        quality_offset+=length
+
+    return offset, records
+
+def format_record(flag, name, sequence, quality):
+    """ Format the record as fastq, in the original orientation for reverse alignments,
+    adding the mate number to the name (as in samtools fastq) """
+
+    if flag & flag_reverse:
+        sequence=sequence.translate(complement_table)[::-1]
+        quality=quality[::-1]
+    if flag & flag_read1 and not flag & flag_read2:
+        name+=b"/1"
+    elif flag & flag_read2 and not flag & flag_read1:
+        name+=b"/2"
+
+    return b"@"+name+b"\n"+sequence+b"\n+\n"+quality+b"\n"
+
+def split_reads(file, pair_handles, single_handle, threads=1):
+    """ Write the primary reads from the BAM file, with the mates of each pair to the pair
+    files (in the same order) and the single end reads and reads without their mate to the
+    single file. Return the number of pairs and single reads written. """
+
+    unpaired_mates={}
+    total_pairs=0
+    total_single=0
+    for records in read_records(file, threads):
+        pairs=[[], []]
+        single=[]
+        for flag, name, sequence, quality in records:
+            if flag & (flag_secondary | flag_supplementary):
+                continue
+
+            mate=None
+            if flag & flag_paired:
+                if flag & flag_read1 and not flag & flag_read2:
+                    mate=0
+                elif flag & flag_read2 and not flag & flag_read1:
+                    mate=1
+            if mate is None:
+                single.append(format_record(flag, name, sequence, quality))
+                continue
+
+            # hold the mate until the other mate is found (adjacent unless the file is sorted by position)
+            other_mate=unpaired_mates.pop(name, None)
+            if other_mate is None or other_mate[0] == mate:
+                if other_mate is not None:
+                    single.append(other_mate[1])
+                unpaired_mates[name]=(mate, format_record(flag, name, sequence, quality))
+                continue
+            pairs[mate].append(format_record(flag, name, sequence, quality))
+            pairs[other_mate[0]].append(other_mate[1])
+
+        pair_handles[0].write(b"".join(pairs[0]))
+        pair_handles[1].write(b"".join(pairs[1]))
+        single_handle.write(b"".join(single))
+        total_pairs+=len(pairs[0])
+        total_single+=len(single)
+
+    for mate, record in unpaired_mates.values():
+        single_handle.write(record)
+        total_single+=1
+
+    return total_pairs, total_single
+
+def warn_unpaired_mates(file, reason):
+    """ Warn that the memory used to hold the mates grows with the size of the file """
+
+    message="The mates in the SAM file are held in memory until the other mate is found, "+\
+        "so the memory used grows with the file size as "+reason+". Sort the file by name "+\
+        "(ie samtools sort -n) to convert the file with constant memory: "+file
+    logger.warning(message)
+    print("WARNING: "+message)
+
+def split_sam_reads(file, pair_handles, single_handle, read_size=4*1024*1024):
+    """ Write the primary reads from the SAM file in one pass, as in split_reads, holding
+    each mate until the other mate is found (so the mates do not need to be adjacent, as
+    in files sorted by position, which is warned as the memory then grows with the file).
+    Repeated adjacent records for the same read are only written once. Return the number
+    of pairs and single reads written. """
+
+    unpaired_mates={}
+    warned=False
+    last_read=None
+    total_pairs=0
+    total_single=0
+    with open(file, "rb") as file_handle:
+        while True:
+            lines=file_handle.readlines(read_size)
+            if not lines:
+                break
+
+            pairs=[[], []]
+            single=[]
+            for line in lines:
+                if line.startswith(b"@HD") and not warned:
+                    sort_order=[field[3:].strip() for field in line.split(b"\t") if field.startswith(b"SO:")]
+                    if sort_order and sort_order[0] == b"coordinate":
+                        warn_unpaired_mates(file, "the file is sorted by coordinate")
+                        warned=True
+                if line.startswith(b"@") or not line.strip():
+                    continue
+                data=line.split(b"\t", 11)
+                flag=int(data[1])
+                if flag & (flag_secondary | flag_supplementary):
+                    continue
+
+                name=data[0]
+                mate=None
+                if flag & flag_paired:
+                    if flag & flag_read1 and not flag & flag_read2:
+                        mate=0
+                    elif flag & flag_read2 and not flag & flag_read1:
+                        mate=1
+
+                # skip other alignments for the same read not marked as secondary
+                if (name, mate) == last_read:
+                    continue
+                last_read=(name, mate)
+
+                quality=data[10].rstrip(b"\r\n")
+                if quality == b"*":
+                    quality=b'"'*len(data[9])
+                record=format_record(flag, name, data[9], quality)
+                if mate is None:
+                    single.append(record)
+                    continue
+
+                # hold the mate until the other mate is found (adjacent unless the file is sorted by position)
+                other_mate=unpaired_mates.pop(name, None)
+                if other_mate is None or other_mate[0] == mate:
+                    if other_mate is not None:
+                        single.append(other_mate[1])
+                    unpaired_mates[name]=(mate, record)
+                    if len(unpaired_mates) >= max_unpaired_mates and not warned:
+                        warn_unpaired_mates(file, "the mates are not adjacent")
+                        warned=True
+                    continue
+                pairs[mate].append(record)
+                pairs[other_mate[0]].append(other_mate[1])
+
+            pair_handles[0].write(b"".join(pairs[0]))
+            pair_handles[1].write(b"".join(pairs[1]))
+            single_handle.write(b"".join(single))
+            total_pairs+=len(pairs[0])
+            total_single+=len(single)
+
+    for mate, record in unpaired_mates.values():
+        single_handle.write(record)
+        total_single+=1
+
+    return total_pairs, total_single
@@ -0,0 +1,230 @@
+"""
+KneadData: bgzf module
+
+Copyright (c) 2015 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import struct
+import zlib
+import collections
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # allow for python2 without the futures backport, which compresses the blocks in one thread
+    ThreadPoolExecutor=None
+
+# BGZF files are a series of gzip members each holding at most 64KB with the
+# compressed block size stored in the "BC" extra field (see the SAM/BAM specification)
+# so they can be read by any gzip reader
+bgzf_max_block_data_size=0xff00
+bgzf_header=b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+bgzf_eof_block=b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+bgzf_compression_level=6
+
+def compress_block(data, level=bgzf_compression_level):
+    """ Compress the data into a single BGZF block """
+
+    compressor=zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed_data=compressor.compress(data)+compressor.flush()
+
+    # the block size stored is the total block size minus one
+    block_size=len(bgzf_header)+2+len(compressed_data)+8
+
+    return b"".join([bgzf_header, struct.pack("<H", block_size-1), compressed_data,
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+class BgzfWriter(object):
+    """ Write a BGZF (gzip compatible) file compressing the blocks with multiple threads """
+
+    def __init__(self, file, threads=1, level=bgzf_compression_level):
+        self.file_handle=open(file, "wb")
+        self.level=level
+        self.buffer=bytearray()
+        self.threads=max(1, int(threads))
+        # limit the blocks waiting to be written to bound memory
+        self.max_pending=self.threads*4
+        self.pending=collections.deque()
+        self.executor=None
+        if self.threads > 1 and ThreadPoolExecutor:
+            self.executor=ThreadPoolExecutor(self.threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        """ Add the data to the buffer, compressing each full block """
+
+        if not isinstance(data, bytes):
+            data=data.encode("utf-8")
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= bgzf_max_block_data_size:
+            self._compress(bytes(self.buffer[:bgzf_max_block_data_size]))
+            del self.buffer[:bgzf_max_block_data_size]
+
+    def _compress(self, data):
+        """ Compress a block, in the thread pool if available, writing blocks in order """
+
+        if not self.executor:
+            self.file_handle.write(compress_block(data, self.level))
+            return
+
+        # zlib releases the GIL while compressing so the blocks are compressed in parallel
+        self.pending.append(self.executor.submit(compress_block, data, self.level))
+        while len(self.pending) > self.max_pending:
+            self.file_handle.write(self.pending.popleft().result())
+
+    def close(self):
+        """ Compress any remaining data, write the end of file block, and close the file """
+
+        if self.file_handle.closed:
+            return
+
+        if self.buffer:
+            self._compress(bytes(self.buffer))
+            self.buffer=bytearray()
+        while self.pending:
+            self.file_handle.write(self.pending.popleft().result())
+        if self.executor:
+            self.executor.shutdown()
+
+        self.file_handle.write(bgzf_eof_block)
+        self.file_handle.close()
+
+def is_bgzf_file(file):
+    """ Check if the file is BGZF compressed from the header of the first block """
+
+    try:
+        with open(file, "rb") as file_handle:
+            header=file_handle.read(len(bgzf_header)+2)
+    except EnvironmentError:
+        return False
+
+    return get_block_size(header, 0) is not None
+
+def get_block_size(data, offset):
+    """ Get the size of the BGZF block starting at the offset, or None if this is not a block header """
+
+    if data[offset:offset+4] != bgzf_header[:4] or data[offset+12:offset+16] != bgzf_header[12:16]:
+        return None
+    if offset+18 > len(data):
+        return None
+
+    return struct.unpack("<H", data[offset+16:offset+18])[0]+1
+
+def decompress_blocks(data):
+    """ Decompress the data of one or more complete gzip members """
+
+    decompressed_data=[]
+    while data:
+        decompressor=zlib.decompressobj(31)
+        decompressed_data.append(decompressor.decompress(data))
+        data=decompressor.unused_data
+
+    return b"".join(decompressed_data)
+
+def find_first_block(data):
+    """ Find the offset of the first block in the data where the blocks end at the end of the data """
+
+    offset=data.find(bgzf_header[:4])
+    while offset != -1:
+        # follow the block sizes to check this is a block boundary
+        block_offset=offset
+        while block_offset < len(data):
+            block_size=get_block_size(data, block_offset)
+            if block_size is None:
+                break
+            block_offset+=block_size
+        if block_offset == len(data):
+            return offset
+        offset=data.find(bgzf_header[:4], offset+1)
+
+    return None
+
+def read_last_blocks(file, min_size):
+    """ Read the decompressed data from the blocks at the end of the BGZF file, reading
+    the blocks back from the end until there is at least the min size of data. Return
+    the data and if the data starts at the beginning of the file. """
+
+    file_size=os.path.getsize(file)
+    read_size=bgzf_max_block_data_size*2
+    with open(file, "rb") as file_handle:
+        while True:
+            start=max(0, file_size-read_size)
+            file_handle.seek(start)
+            data=file_handle.read()
+            offset=find_first_block(data) if start > 0 else 0
+            if offset is not None:
+                decompressed_data=decompress_blocks(data[offset:])
+                if len(decompressed_data) >= min_size or start+offset == 0:
+                    return decompressed_data, start+offset == 0
+            read_size*=2
+
+def read_blocks(file, threads=1, read_size=1024*1024):
+    """ Yield the decompressed data of the BGZF file, reading groups of complete blocks
+    and decompressing the groups with multiple threads (yielding the data in order) """
+
+    threads=max(1, int(threads))
+    executor=ThreadPoolExecutor(threads) if threads > 1 and ThreadPoolExecutor else None
+    pending=collections.deque()
+    remainder=b""
+    with open(file, "rb") as file_handle:
+        while True:
+            data=file_handle.read(read_size)
+            if not data and not remainder:
+                break
+            data=remainder+data
+
+            # find the end of the last complete block
+            offset=0
+            while offset < len(data):
+                block_size=get_block_size(data, offset)
+                if block_size is None:
+                    if len(data)-offset >= len(bgzf_header)+2:
+                        raise ValueError("Invalid BGZF block at offset "+str(file_handle.tell()-len(data)+offset))
+                    break
+                if offset+block_size > len(data):
+                    break
+                offset+=block_size
+            remainder=data[offset:]
+            if offset == 0:
+                if len(data) < read_size:
+                    raise ValueError("Truncated BGZF block at the end of the file")
+                read_size*=2
+                continue
+
+            # zlib releases the GIL while decompressing so the groups are decompressed in parallel
+            if not executor:
+                yield decompress_blocks(data[:offset])
+                continue
+            pending.append(executor.submit(decompress_blocks, data[:offset]))
+            while len(pending) > threads*2:
+                yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+    if executor:
+        executor.shutdown()
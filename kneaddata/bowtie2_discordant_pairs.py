@@ -36,9 +36,18 @@ try:
 except ImportError:
     sys.exit("Please upgrade to python 2.7+")
     
+import array
 import string
 import tempfile
 import subprocess
+import threading
+import collections
+
+try:
+    from itertools import zip_longest
+except ImportError:
+    # allow for python2 in which the function is named izip_longest
+    from itertools import izip_longest as zip_longest
 
 try:
     from kneaddata import utilities
@@ -154,15 +163,214 @@ def run_bowtie2(bowtie2_path,pair1,pair2,orphans,database,sam,threads,options,re
             message+="\nError message returned from bowtie2:\n" + e.output
         sys.exit(message)
     
+def write_reads_to_bowtie2(stdin,pair1,pair2,orphans,read_types):
+    """ Write the pairs interleaved, followed by the orphans, to the bowtie2 input stream
+    recording if each read written is from a pair """
+    
+    try:
+        for read1, read2 in zip_longest(utilities.read_fastq_records(pair1),utilities.read_fastq_records(pair2)):
+            # reads without a mate in the other file are treated as orphans
+            is_pair = read1 is not None and read2 is not None
+            for read in [read1, read2]:
+                if read is not None:
+                    read_types.append(is_pair)
+                    stdin.write(utilities.format_fastq_record(read))
+        
+        for orphan_file in orphans.split(",") if orphans else []:
+            for read in utilities.read_fastq_records(orphan_file):
+                read_types.append(False)
+                stdin.write(utilities.format_fastq_record(read))
+    except EnvironmentError:
+        # bowtie2 stopped reading, the error is reported from the return code
+        pass
+    finally:
+        try:
+            stdin.close()
+        except EnvironmentError:
+            pass
+        
+def get_alignments_by_read(sam_lines,sam_file_handle):
+    """ Yield the read id, sequence, quality and if the read aligned for each read,
+    grouping the consecutive alignments for a read, and write the lines to the sam file if provided """
+    
+    current_read=None
+    for line in sam_lines:
+        if sam_file_handle:
+            sam_file_handle.write(line)
+        # the header lines are only written to the sam file
+        if line.startswith(b"@"):
+            continue
+        data=line.rstrip(b"\n").split(b"\t")
+        aligned = not int(data[1]) & 4
+        if current_read and current_read[0] == data[0]:
+            current_read[3] = current_read[3] or aligned
+        else:
+            if current_read:
+                yield current_read
+            current_read=[data[0],data[9],data[10],aligned]
+    if current_read:
+        yield current_read
+
+def write_read(read,file_type,open_files,counts):
+    """ Write the read to the output file of the type provided """
+    
+    read_id, sequence, quality, aligned = read
+    open_files[file_type].write(b"@"+read_id+b"\n"+sequence+b"\n+\n"+quality+b"\n")
+    counts[file_type]+=1
+    
+def write_orphan(read,open_files,counts):
+    """ Write a read without a mate to the orphan output files """
+    
+    pair = "orphan2" if read[0].endswith(b"2") else "orphan1"
+    write_read(read, pair+("_aligned" if read[3] else "_unaligned"), open_files, counts)
+
+def write_pair(read1,read2,open_files,counts,mode):
+    """ Write both reads in a pair to the output files based on the alignments for the pair """
+    
+    if read1[3] and read2[3]:
+        # both reads in the pair aligned to the reference
+        file_types=["pair1_aligned","pair2_aligned"]
+    elif not read1[3] and not read2[3]:
+        # both reads did not align to the reference
+        file_types=["pair1_unaligned","pair2_unaligned"]
+    elif mode == "strict":
+        # if running in strict mode, if either read aligned then filter out the pair
+        file_types=["pair1_aligned","pair2_aligned"]
+    else:
+        # only one read from the pair aligned to the reference
+        write_orphan(read1,open_files,counts)
+        write_orphan(read2,open_files,counts)
+        return
+    
+    write_read(read1,file_types[0],open_files,counts)
+    write_read(read2,file_types[1],open_files,counts)
+        
+def organize_alignments_stream(sam_lines,read_types,open_files,counts,mode,sam_file_handle=None):
+    """ Organize the alignments in input order as they are generated, writing each pair
+    as soon as both reads have been seen """
+    
+    # reads waiting for a mate (only one at a time if the pair files are in the same order)
+    waiting_reads={}
+    for read in get_alignments_by_read(sam_lines,sam_file_handle):
+        if not read_types.popleft():
+            write_orphan(read,open_files,counts)
+            continue
+        
+        query_id = read[0][:-1]
+        mate = waiting_reads.pop(query_id, None)
+        if mate is None:
+            waiting_reads[query_id]=read
+        else:
+            write_pair(mate,read,open_files,counts,mode)
+    
+    # write any reads that did not have a mate in the other pair file
+    for read in waiting_reads.values():
+        write_orphan(read,open_files,counts)
+    
+class ReadAlignmentStates(object):
+    """ Store the alignments for each query id as bits in a compact open addressing hash table
+    of 64-bit query id hashes instead of a dictionary of sets """
+    
+    pair1_aligned=1
+    pair2_aligned=2
+    pair1_unaligned=4
+    pair2_unaligned=8
+    
+    def __init__(self, size=1024):
+        self.keys=array.array(utilities.hash_typecode,[0])*size
+        self.states=bytearray(size)
+        self.mask=size-1
+        self.total=0
+        
+    def _get_slot(self, key):
+        """ Get the slot for the key, which is either the key or the empty slot to store the key """
+        
+        index=key & self.mask
+        keys=self.keys
+        while True:
+            slot_key=keys[index]
+            if slot_key == key or slot_key == 0:
+                return index
+            index=(index+1) & self.mask
+            
+    def _resize(self):
+        """ Double the size of the table, adding the keys to the new table """
+        
+        keys, states = self.keys, self.states
+        self.keys=array.array(utilities.hash_typecode,[0])*(len(keys)*2)
+        self.states=bytearray(len(keys)*2)
+        self.mask=len(keys)*2-1
+        for key, state in zip(keys, states):
+            if key != 0:
+                index=self._get_slot(key)
+                self.keys[index]=key
+                self.states[index]=state
+                
+    @staticmethod
+    def _get_key(query_id):
+        """ Get the hash for the query id, reserving zero for empty slots """
+        
+        return hash(query_id) or 1
+    
+    def add(self, query_id, state):
+        """ Add the alignment state to the query """
+        
+        key=self._get_key(query_id)
+        index=self._get_slot(key)
+        if self.keys[index] == 0:
+            self.total+=1
+            # keep the table at most half full
+            if self.total*2 > len(self.keys):
+                self._resize()
+                index=self._get_slot(key)
+            self.keys[index]=key
+        self.states[index]|=state
+        
+    def get(self, query_id):
+        """ Get the alignment states for the query """
+        
+        return self.states[self._get_slot(self._get_key(query_id))]
+        
+def get_file_types_for_states(mode):
+    """ Get the output file type for each alignment state, for pair1 and pair2 reads """
+    
+    file_types=[]
+    for state in range(16):
+        aligned=set(pair for pair, bit in [(True,ReadAlignmentStates.pair1_aligned),(False,ReadAlignmentStates.pair2_aligned)] if state & bit)
+        unaligned=set(pair for pair, bit in [(True,ReadAlignmentStates.pair1_unaligned),(False,ReadAlignmentStates.pair2_unaligned)] if state & bit)
+        
+        # if running in strict mode, for all pairs with a single alignment
+        # also filter out the other pair
+        if mode == "strict" and len(aligned) == 1 and len(unaligned) == 1:
+            aligned.update(unaligned)
+            unaligned=set()
+            
+        types_for_pair={}
+        for pair1 in [True, False]:
+            if len(aligned) > 1:
+                # both reads in the pair aligned to the reference
+                types_for_pair[pair1] = "pair1_aligned" if pair1 else "pair2_aligned"
+            elif len(unaligned) > 1:
+                # both reads did not align to the reference
+                types_for_pair[pair1] = "pair1_unaligned" if pair1 else "pair2_unaligned"
+            elif pair1 in aligned:
+                # only this read from the pair aligned to the reference
+                types_for_pair[pair1] = "orphan1_aligned" if pair1 else "orphan2_aligned"
+            else:
+                # only this read from the pair did not align to the reference
+                types_for_pair[pair1] = "orphan1_unaligned" if pair1 else "orphan2_unaligned"
+        file_types.append(types_for_pair)
+        
+    return file_types
+    
 def organize_alignments_single(sam,open_files,counts,mode):
     """ Organize the alignments that were generated running the pairs as single end reads """
     
-    # read through the sam file, organizing reads by those that aligned 
-    aligned={}
-    unaligned={}
+    # read through the sam file, storing the reads that aligned for each query
+    states=ReadAlignmentStates()
     with open(sam) as file_handle:
         for line in file_handle:
-            data=line.rstrip().split("\t")
+            data=line.split("\t",2)
             flag=int(data[1])
             
             query_id = data[0][:-1]
@@ -171,24 +379,13 @@ def organize_alignments_single(sam,open_files,counts,mode):
             # check if the read aligned
             if flag & 4:
                 # this read did not align to the reference
-                if not query_id in unaligned:
-                    unaligned[query_id]=set()
-                unaligned[query_id].add(pair1)
+                states.add(query_id, ReadAlignmentStates.pair1_unaligned if pair1 else ReadAlignmentStates.pair2_unaligned)
             else:
                 # this read aligned to the reference
-                if not query_id in aligned:
-                    aligned[query_id]=set()
-                aligned[query_id].add(pair1)
-               
-    # if running in strict mode, for all pairs with a single alignment
-    # also filter out the other pair
-    if mode == "strict":
-        for query_id in aligned:
-            if len(aligned[query_id]) == 1 and len(unaligned.get(query_id,[])) == 1:
-                aligned[query_id].update(unaligned[query_id])
-                unaligned[query_id]=set()
+                states.add(query_id, ReadAlignmentStates.pair1_aligned if pair1 else ReadAlignmentStates.pair2_aligned)
  
     # read through the sam file again to write the reads to the output files
+    file_types=get_file_types_for_states(mode)
     with open(sam) as file_handle:
         for line in file_handle:
             data=line.rstrip().split("\t")
@@ -197,51 +394,36 @@ def organize_alignments_single(sam,open_files,counts,mode):
             pair1 = False if data[0][-1] == "2" else True
             
             # check the alignment type of this query
-            align_values = aligned.get(query_id,[])
-            unalign_values = unaligned.get(query_id,[])
-            
-            if len(align_values) > 1:
-                # both reads in the pair aligned to the reference
-                file_name = "pair1_aligned" if pair1 else "pair2_aligned"
-            elif len(unalign_values) > 1:
-                # both reads did not align to the reference
-                file_name = "pair1_unaligned" if pair1 else "pair2_unaligned"
-            elif pair1 in align_values:
-                # only this read from the pair aligned to the reference
-                file_name = "orphan1_aligned" if pair1 else "orphan2_aligned"
-            elif pair1 in unalign_values:
-                # only this read from the pair did not align to the reference
-                file_name = "orphan1_unaligned" if pair1 else "orphan2_unaligned"
+            file_name = file_types[states.get(query_id)][pair1]
 
             # write the read to the file
-            open_files[file_name].write("\n".join(["@"+data[0],data[9],"+",data[10]])+"\n")
+            open_files[file_name].write(("\n".join(["@"+data[0],data[9],"+",data[10]])+"\n").encode("utf-8"))
             # increase the count
-            counts[file_name]=counts[file_name]+1                
-    
-
-def process_alignments(sam,aligned_pair,unaligned_pair,aligned_orphan,unaligned_orphan,mode):
-    """ Read through the sam alignments and organize into the output files """
+            counts[file_name]=counts[file_name]+1
+        
+def open_output_files(aligned_pair,unaligned_pair,aligned_orphan,unaligned_orphan):
+    """ Open all of the output files for writing """
     
     # open the output files
-    pair1_aligned=open(aligned_pair.replace("%","1"),"wt")
-    pair2_aligned=open(aligned_pair.replace("%","2"),"wt")
+    pair1_aligned=open(aligned_pair.replace("%","1"),"wb")
+    pair2_aligned=open(aligned_pair.replace("%","2"),"wb")
     
-    pair1_unaligned=open(unaligned_pair.replace("%","1"),"wt")
-    pair2_unaligned=open(unaligned_pair.replace("%","2"),"wt")
+    pair1_unaligned=open(unaligned_pair.replace("%","1"),"wb")
+    pair2_unaligned=open(unaligned_pair.replace("%","2"),"wb")
     
-    orphan1_aligned=open(aligned_orphan.replace("%","1"),"wt")
-    orphan2_aligned=open(aligned_orphan.replace("%","2"),"wt")
+    orphan1_aligned=open(aligned_orphan.replace("%","1"),"wb")
+    orphan2_aligned=open(aligned_orphan.replace("%","2"),"wb")
     
-    orphan1_unaligned=open(unaligned_orphan.replace("%","1"),"wt")
-    orphan2_unaligned=open(unaligned_orphan.replace("%","2"),"wt")  
+    orphan1_unaligned=open(unaligned_orphan.replace("%","1"),"wb")
+    orphan2_unaligned=open(unaligned_orphan.replace("%","2"),"wb")  
     
-    open_files={"pair1_aligned":pair1_aligned,"pair2_aligned":pair2_aligned,
-                "pair1_unaligned":pair1_unaligned,"pair2_unaligned":pair2_unaligned,
-                "orphan1_aligned":orphan1_aligned,"orphan2_aligned":orphan2_aligned,
-                "orphan1_unaligned":orphan1_unaligned,"orphan2_unaligned":orphan2_unaligned}
-    counts={name:0 for name in open_files.keys()}  
+    return {"pair1_aligned":pair1_aligned,"pair2_aligned":pair2_aligned,
+            "pair1_unaligned":pair1_unaligned,"pair2_unaligned":pair2_unaligned,
+            "orphan1_aligned":orphan1_aligned,"orphan2_aligned":orphan2_aligned,
+            "orphan1_unaligned":orphan1_unaligned,"orphan2_unaligned":orphan2_unaligned}
     
-    organize_alignments_single(sam,open_files,counts,mode)
+def close_output_files(open_files,counts):
+    """ Close all of the output files and write out the counts """
             
     # close all of the files
     for file_name, file_handle in open_files.items():
@@ -250,12 +432,66 @@ def process_alignments(sam,aligned_pair,unaligned_pair,aligned_orphan,unaligned_
     # write out the counts for each file
     for file_name,total in counts.items():
         print(file_name+" : "+str(total))
+
+def process_alignments(sam,aligned_pair,unaligned_pair,aligned_orphan,unaligned_orphan,mode):
+    """ Read through the sam alignments and organize into the output files """
+    
+    open_files=open_output_files(aligned_pair,unaligned_pair,aligned_orphan,unaligned_orphan)
+    counts={name:0 for name in open_files.keys()}  
+    
+    organize_alignments_single(sam,open_files,counts,mode)
+            
+    close_output_files(open_files,counts)
+    
+def process_alignments_stream(bowtie2_path,pair1,pair2,orphans,database,sam,threads,options,
+                              aligned_pair,unaligned_pair,aligned_orphan,unaligned_orphan,mode):
+    """ Run bowtie2 on the reads from the input stream, organizing the alignments from the
+    output stream into the output files in a single pass without writing a temp sam file """
     
+    command=[bowtie2_path,"--threads",str(threads),"-x",database,"-U","-","--reorder"]
+    if options:
+        command+=utilities.format_options_to_list([options])
+    
+    try:
+        process=subprocess.Popen(command,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    except EnvironmentError:
+        sys.exit("Unable to run bowtie2: " +" ".join(command))
+    
+    # write the reads to bowtie2 in a thread while reading the alignments
+    read_types=collections.deque()
+    writer=threading.Thread(target=write_reads_to_bowtie2,args=(process.stdin,pair1,pair2,orphans,read_types))
+    writer.daemon=True
+    writer.start()
+    
+    sam_file_handle=None
+    if sam and sam != os.devnull:
+        sam_file_handle=open(sam,"wb")
+    
+    open_files=open_output_files(aligned_pair,unaligned_pair,aligned_orphan,unaligned_orphan)
+    counts={name:0 for name in open_files.keys()}
+    
+    organize_alignments_stream(process.stdout,read_types,open_files,counts,mode,sam_file_handle)
+    
+    writer.join()
+    return_code=process.wait()
+    if sam_file_handle:
+        sam_file_handle.close()
+    if return_code:
+        sys.exit("Unable to run bowtie2: " +" ".join(command))
+    
+    close_output_files(open_files,counts)
 
 def main():
     # parse the command line arguments
     args = parse_arguments(sys.argv)
     
+    # with reordered output the mates are adjacent, so the alignments can be organized in one pass
+    # as they are generated without writing a temp sam file
+    if args.reorder:
+        process_alignments_stream(args.bowtie2,args.pair1,args.pair2,args.orphan,args.index,args.sam,args.threads,
+            args.bowtie2_options,args.al_pair,args.un_pair,args.al_single,args.un_single,args.mode)
+        return
+    
     # if no sam output is provided or it is set to dev/null, write to temp file
     output_dir=os.path.dirname(args.un_pair)
     temp_files=[]
@@ -0,0 +1,229 @@
+"""
+KneadData: cache module
+
+Copyright (c) 2015 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import glob
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from kneaddata import config
+from kneaddata import utilities
+
+# name global logging instance
+logger=logging.getLogger(__name__)
+
+# the fingerprints of the files hashed (or copied) by this run, by the file status,
+# so the outputs of a step copied to or from the cache are not hashed again as the inputs to the next step
+file_fingerprints={}
+
+def get_file_status(file):
+    """ Return the inode, size, and modification and change times of the file
+    (in nanoseconds if available, as python2 only has the times in seconds) """
+    
+    stat=os.stat(file)
+    return (stat.st_ino, stat.st_size, getattr(stat, "st_mtime_ns", stat.st_mtime),
+        getattr(stat, "st_ctime_ns", stat.st_ctime))
+
+def new_hash():
+    """ Return a new hash for the keys and file contents (blake2b requires python3.6+) """
+    
+    try:
+        return hashlib.blake2b(digest_size=16)
+    except AttributeError:
+        return hashlib.sha1()
+
+def get_file_fingerprint(file):
+    """ Return the fingerprint of the contents of the file from its size and a hash of
+    all of the data (or None if this is not a regular file, like a fifo) """
+    
+    if not os.path.isfile(file):
+        return None
+    
+    status=get_file_status(file)
+    if file_fingerprints.get(file, (None,))[0] == status:
+        return file_fingerprints[file][1]
+    
+    hash=new_hash()
+    with open(file, "rb") as file_handle:
+        for block in iter(lambda: file_handle.read(config.file_read_block_size), b""):
+            hash.update(block)
+    fingerprint=str(status[1])+"_"+hash.hexdigest()
+    file_fingerprints[file]=(status, fingerprint)
+    
+    return fingerprint
+
+def copy_file(file, new_file):
+    """ Copy the file, storing the fingerprint of the data for both files as it is copied """
+    
+    hash=new_hash()
+    with open(file, "rb") as file_handle:
+        with open(new_file, "wb") as file_handle_write:
+            for block in iter(lambda: file_handle.read(config.file_read_block_size), b""):
+                hash.update(block)
+                file_handle_write.write(block)
+    
+    fingerprint=str(os.path.getsize(new_file))+"_"+hash.hexdigest()
+    for copied_file in [file, new_file]:
+        file_fingerprints[copied_file]=(get_file_status(copied_file), fingerprint)
+
+class StepCache(object):
+    """ Store the output files of the workflow steps in the cache folder keyed by the
+    command for the step and the fingerprints of the input files, so the outputs are
+    restored instead of running the step again on a rerun. The entries used least
+    recently are removed when the cache is larger than the max size (in bytes). """
+    
+    manifest_file="manifest.txt"
+    
+    def __init__(self, folder, max_size, version=""):
+        self.folder=folder
+        self.max_size=max_size
+        self.version=version
+        utilities.create_directory(self.folder)
+        
+    def get_key(self, step, command, infiles, outfiles, databases=None):
+        """ Get the key for the step, or None if the inputs can not be fingerprinted. The input
+        and output files in the command are replaced by their position (the inputs are identified
+        by their contents) and the folders of the files are removed from the other paths, so the
+        key does not change with the temp file names or the output folder. The index files of the
+        databases are identified by their size and modification time, as they are large to hash. """
+        
+        paths=[(file, "<input "+str(index)+">") for index, file in enumerate(infiles)]
+        paths+=[(file, "<output "+str(index)+">") for index, file in enumerate(outfiles)]
+        paths+=[(os.path.dirname(file)+os.sep, "") for file in infiles+outfiles]
+        paths.sort(key=lambda path: len(path[0]), reverse=True)
+        
+        hash=new_hash()
+        for item in [self.version, step]+[str(item) for item in command]:
+            for path, replacement in paths:
+                item=item.replace(path, replacement)
+            hash.update(item.encode("utf-8")+b"\0")
+        for file in infiles:
+            fingerprint=get_file_fingerprint(file)
+            if fingerprint is None:
+                return None
+            hash.update(fingerprint.encode("utf-8")+b"\0")
+        for database in databases or []:
+            for file in sorted(glob.glob(database+".*")):
+                status=get_file_status(file)
+                hash.update((file[len(database):]+"_"+str(status[1])+"_"+str(status[2])).encode("utf-8")+b"\0")
+            
+        return step.replace(" ","_")+"_"+hash.hexdigest()
+        
+    def restore(self, key, outfiles):
+        """ Copy the output files from the cache entry, returning True if restored """
+        
+        if not key:
+            return False
+        
+        entry=os.path.join(self.folder, key)
+        try:
+            with open(os.path.join(entry, self.manifest_file)) as file_handle:
+                manifest=[line.rstrip("\n").split("\t") for line in file_handle]
+        except EnvironmentError:
+            return False
+        if [name for name, total_reads in manifest] != [os.path.basename(file) for file in outfiles]:
+            return False
+        
+        try:
+            for index, (file, (name, total_reads)) in enumerate(zip(outfiles, manifest)):
+                cached_file=os.path.join(entry, str(index))
+                if os.path.isfile(file):
+                    utilities.remove_file(file)
+                # this output was not written by the step
+                if not os.path.isfile(cached_file):
+                    continue
+                # copy (instead of linking) so the cached file is not changed if
+                # the output file is overwritten in place by a later step
+                copy_file(cached_file, file)
+                if total_reads:
+                    utilities.record_read_count(file, int(total_reads))
+            # mark the entry as recently used
+            os.utime(entry, None)
+        except EnvironmentError:
+            # the entry might have been removed by another run sharing the cache
+            logger.warning("Unable to restore cache entry: " + entry)
+            return False
+        
+        message="Restored output files from cache entry: " + entry
+        logger.info(message)
+        print(message)
+        
+        return True
+        
+    def store(self, key, outfiles):
+        """ Copy the output files to a new cache entry, then remove old entries to fit the max size """
+        
+        if not key:
+            return
+        
+        entry=os.path.join(self.folder, key)
+        output_size=sum(os.path.getsize(file) for file in outfiles if os.path.isfile(file))
+        if os.path.isdir(entry) or output_size > self.max_size:
+            return
+        
+        # write to a temp folder and then rename so runs sharing the cache do not see a partial entry
+        temp_entry=None
+        try:
+            temp_entry=tempfile.mkdtemp(prefix="temp_", dir=self.folder)
+            with open(os.path.join(temp_entry, self.manifest_file), "w") as file_handle:
+                for index, file in enumerate(outfiles):
+                    total_reads=None
+                    if os.path.isfile(file):
+                        copy_file(file, os.path.join(temp_entry, str(index)))
+                        total_reads=utilities.get_recorded_read_count(file)
+                    file_handle.write(os.path.basename(file)+"\t"+(str(int(total_reads)) if total_reads is not None else "")+"\n")
+            os.rename(temp_entry, entry)
+        except EnvironmentError:
+            logger.warning("Unable to write cache entry: " + entry)
+            if temp_entry:
+                shutil.rmtree(temp_entry, ignore_errors=True)
+            return
+        
+        logger.info("Stored cache entry: " + entry)
+        self.remove_old_entries()
+        
+    def remove_old_entries(self):
+        """ Remove the entries used least recently until the cache fits in the max size """
+        
+        entries=[]
+        total_size=0
+        for name in os.listdir(self.folder):
+            entry=os.path.join(self.folder, name)
+            if name.startswith("temp_") or not os.path.isdir(entry):
+                continue
+            try:
+                size=sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except EnvironmentError:
+                continue
+            total_size+=size
+        
+        for mtime, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info("Removing cache entry used least recently: " + entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size-=size
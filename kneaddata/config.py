@@ -45,6 +45,13 @@ trimmomatic_slidingwindow_option="SLIDINGWINDOW:4:20"
 trimmomatic_minlen_option_tag="MINLEN"
 trimmomatic_option_delimiter=":"
 trimmomatic_min_len_percent=50
+# the engines to trim reads, either Trimmomatic or the native engine which runs the
+# ILLUMINACLIP, SLIDINGWINDOW, and MINLEN steps on batches of this many reads
+trim_engines=["trimmomatic","native"]
+trim_engine=trim_engines[0]
+native_trim_batch_size=1000
+# the streaming mode holds at most this many batches of reads waiting for each fifo
+stream_queue_size=4
 default_read_length=100
 min_init_read_length=60
 
@@ -64,6 +71,16 @@ trf_match_probability=80
 trf_pi=10
 trf_minscore=50
 trf_maxperiod=500
+# the engines to find tandem repeats, either the external TRF or the native short read scorer
+trf_engines=["trf","native"]
+trf_engine=trf_engines[0]
+# the native engine scores this many reads at once and requires a repeat to cover
+# at least this many copies of the period (as TRF reports repeats with at least 1.9 copies)
+native_trf_batch_size=4096
+native_trf_min_copies=1.9
+# the native engine is designed for short reads, for longer reads TRF is run instead if available
+# (the length is checked on the first batch of reads)
+native_trf_max_read_length=300
 
 samtools_exe="samtools"
 
@@ -93,6 +110,25 @@ bmtagger_db_endings = [
 # File extensions
 fastq_file_extension=".fastq"
 fasta_file_extension=".fasta"
+gzip_file_extension=".gz"
+
+# size of the blocks to read when streaming through files
+file_read_block_size=4*1024*1024
+
+# size to read from the end of a file to find the last lines
+tail_read_size=64*1024
+
+# number of reads to check at once when intersecting fastq files
+intersect_batch_size=100000
+
+# number of reads to sort in memory for each sorted run when reordering fastq files
+reorder_max_records_in_memory=1000000
+
+# max number of reads waiting for mates to resync the pairs instead of sorting
+pair_order_resync_window=100000
+
+# max size (in GB) of the step cache
+cache_max_size=100
 
 # Trimmomatic file endings for single end and paired end, respectively
 trimomatic_se_ending = ".trimmed.fastq"
@@ -62,7 +62,16 @@ import os
 import logging
 import argparse
 import re
+import time
 import itertools
+import subprocess
+import multiprocessing.pool
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # allow for python2 without the futures backport, which runs the samples with a thread pool
+    ThreadPoolExecutor=None
 
 # Try to load one of the kneaddata modules to check the installation
 try:
@@ -72,7 +81,9 @@ except ImportError:
         " Please check your install.")
 
 from kneaddata import run
+from kneaddata import streaming
 from kneaddata import config
+from kneaddata import cache
 
 VERSION="0.12.4"
 
@@ -81,9 +92,9 @@ logger=logging.getLogger(__name__)
 # Global input files path list for FASTQC
 original_input_files=[]
 
-def parse_arguments(args):
+def get_argument_parser():
     """ 
-    Parse the arguments from the user
+    Get the parser for the arguments from the user
     """
     
     parser = argparse.ArgumentParser(
@@ -111,6 +122,10 @@ def parse_arguments(args):
         "-un","--unpaired",
         help="unparied input FASTQ file", 
         dest='unpaired')
+    group1.add_argument(
+        "--sample-sheet",
+        help="tab-delimited file of samples to run in batch mode with one sample per line\n"+\
+             "(sample name, input1 [, input2]) with --processes samples run at once sharing the --threads")
     group1.add_argument(
         "-o", "--output",
         dest='output_dir',
@@ -121,6 +136,17 @@ def parse_arguments(args):
         dest='scratch_dir',
         help="directory to write temp files",
         default="")
+    group1.add_argument(
+        "--cache-dir",
+        dest='cache_dir',
+        help="directory to cache the output files of the trim, repeat filter, and decontamination\n"+\
+             "steps so they are restored on a rerun with the same input files and options")
+    group1.add_argument(
+        "--cache-max-size",
+        type=float,
+        default=config.cache_max_size,
+        help="max size (in GB) of the cache directory, removing the entries used least recently\n"+\
+             "[ DEFAULT : "+str(config.cache_max_size)+" ]")
     group1.add_argument(
         "-db", "--reference-db",
         default=[], action="append",
@@ -184,10 +210,25 @@ def parse_arguments(args):
         "--remove-intermediate-output",
         action="store_true",
         help="remove intermediate output files\n[ DEFAULT : intermediate output files are stored ]")
+    group1.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream the trimmed reads through the removal of tandem repeats and into bowtie2\n"+\
+             "without writing the trimmed and repeat removed files, unless --store-temp-output is set\n"+\
+             "(requires --trim-engine native and --trf-engine native or --bypass-trf, and sets\n"+\
+             "--serial and --reorder)\n[ DEFAULT : each step writes its output files ]")
     group1.add_argument(
         "--cat-final-output",
         action="store_true",
         help="concatenate all final output files\n[ DEFAULT : final output is not concatenated ]")
+    group1.add_argument(
+        "--gzip-output",
+        action="store_true",
+        help="compress the final output files with gzip (BGZF) using the threads provided\nafter the workflow (the concatenated final output is compressed as it is written)\n[ DEFAULT : final output is not compressed ]")
+    group1.add_argument(
+        "--gzip-intermediate-output",
+        action="store_true",
+        help="also compress the intermediate output files (sets --gzip-output)\n[ DEFAULT : intermediate output is not compressed ]")
     group1.add_argument(
         "--log-level",
         default=config.log_level,
@@ -202,6 +243,13 @@ def parse_arguments(args):
         "--trimmomatic",
         dest='trimmomatic_path',
         help="path to trimmomatic\n[ DEFAULT : $PATH ]")
+    group2.add_argument(
+        "--trim-engine",
+        choices=config.trim_engines,
+        default=config.trim_engine,
+        help="the engine to trim reads, the native engine runs the ILLUMINACLIP, SLIDINGWINDOW,\n"+\
+             "and MINLEN trimmomatic options in process on batches of reads (requires numpy)\n"+\
+             "[ DEFAULT : "+config.trim_engine+" ]")
     group2.add_argument(
         "--run-trim-repetitive",
         default=False,
@@ -243,6 +291,12 @@ def parse_arguments(args):
         "--reorder",
         action="store_true",
         help="order the sequences in the same order as the input\n[ DEFAULT : Sequences are not ordered ]")
+    group3.add_argument(
+        "--preload-index",
+        action="store_true",
+        help="load the reference database indexes into memory before running the alignments\n"+\
+             "and run bowtie2 with memory-mapped indexes (--mm) so the index pages are shared\n"+\
+             "by all processes and sample runs on the node\n[ DEFAULT : indexes are loaded by each process ]")
     group3.add_argument(
         "--serial",
         action="store_true",
@@ -253,12 +307,30 @@ def parse_arguments(args):
         "--bmtagger",
         dest='bmtagger_path',
         help="path to BMTagger\n[ DEFAULT : $PATH ]")
+    group4.add_argument(
+        "--bmtagger-temp",
+        dest='bmtagger_temp_dir',
+        default="",
+        help="directory on a fast local disk (ie tmpfs or nvme) for the bmtagger temp files,\n"+\
+             "with a temp directory for each database\n[ DEFAULT : output directory ]")
 
     group5 = parser.add_argument_group("trf arguments")
     group5.add_argument(
             "--trf",
             dest='trf_path',
             help="path to TRF\n[ DEFAULT : $PATH ]")
+    group5.add_argument(
+            "--trf-engine",
+            choices=config.trf_engines,
+            default=config.trf_engine,
+            help="the engine to find tandem repeats, the native engine scores short reads in\n"+\
+                 "process with the match, mismatch, delta, minscore, and maxperiod (requires numpy)\n"+\
+                 "[ DEFAULT : "+config.trf_engine+" ]")
+    group5.add_argument(
+            "--trf-chunk-size",
+            type=int,
+            help="run trf on chunks of this many reads, with the threads running the chunks as each\n"+\
+                 "chunk finishes, logging the time for each chunk\n[ DEFAULT : one chunk per thread ]")
     group5.add_argument(
             "--match", 
             type=int,
@@ -300,8 +372,68 @@ def parse_arguments(args):
             dest='fastqc_path',
             help="path to fastqc\n[ DEFAULT : $PATH ]")
 
-    return parser.parse_args()
+    return parser
+
+def parse_arguments(args):
+    """ 
+    Parse the arguments from the user
+    """
+    
+    return get_argument_parser().parse_args()
+    
+def find_dependencies(args):
+    """ Find the location of each of the dependencies that are set to run """
     
+    # find the location of trimmomatic, trimmomatic does not need to be executable
+    if not args.bypass_trim and args.trim_engine == "trimmomatic":
+        args.trimmomatic_path=utilities.find_dependency(args.trimmomatic_path,config.trimmomatic_jar,"trimmomatic",
+            "--trimmomatic", bypass_permissions_check=True)
+    
+    # find the location of bmtagger, if set to run
+    if args.reference_db:
+        if args.bmtagger:
+            args.bmtagger_path=utilities.find_dependency(args.bmtagger_path,config.bmtagger_exe,"bmtagger",
+                "--bmtagger", bypass_permissions_check=False)
+            # add this folder to path, so as to be able to find other dependencies like bmfilter
+            utilities.add_exe_to_path(os.path.dirname(args.bmtagger_path))
+        else:
+            # find the location of bowtie2, if not running with bmtagger
+            args.bowtie2_path=utilities.find_dependency(args.bowtie2_path, config.bowtie2_exe, "bowtie2",
+                "--bowtie2", bypass_permissions_check=False)        
+    
+    # find the location of trf, if set to run
+    if not args.bypass_trf and args.trf_engine == "trf":
+        args.trf_path=utilities.find_dependency(args.trf_path,config.trf_exe,"trf",
+            "--trf", bypass_permissions_check=False)
+    elif not args.bypass_trf:
+        # the native engine runs trf for long reads, if trf can be found
+        if args.trf_path:
+            args.trf_path=utilities.find_dependency(args.trf_path,config.trf_exe,"trf",
+                "--trf", bypass_permissions_check=False)
+        else:
+            args.trf_path=utilities.find_exe_in_path(config.trf_exe, bypass_permissions_check=True,
+                add_exe_to_path=True)
+        
+    # if fastqc is set to be run, check if the executable can be found
+    if args.fastqc_start or args.fastqc_end or args.run_trim_repetitive:
+        args.fastqc_path=utilities.find_dependency(args.fastqc_path,config.fastqc_exe,"fastqc",
+                                                   "--fastqc",bypass_permissions_check=False)
+
+def find_reference_indexes(args):
+    """ Find the indexes for each of the reference databases """
+    
+    # find the bowtie2 indexes for each of the reference databases
+    # reference database inputs can be directories, indexes, or index files
+    if args.reference_db:
+        reference_indexes=[]
+        database_type="bowtie2"
+        if args.bmtagger:
+            database_type="bmtagger"
+        for directory in args.reference_db:
+            reference_indexes.append(utilities.find_database_index(os.path.abspath(directory),database_type))
+    
+        args.reference_db=reference_indexes
+
 def update_configuration(args):
     """ Update the run settings based on the arguments provided """
 
@@ -309,10 +441,26 @@ def update_configuration(args):
     if args.processes == 1:
         args.serial=True
 
+    # the streaming mode runs the native trim and tandem repeat engines on the stream
+    # of reads and only the first database reads the stream so databases run in serial,
+    # with the pairs ordered so the discordant pairs mode reads both streams at once
+    if args.stream:
+        if args.bypass_trim or args.trim_engine != "native":
+            sys.exit("ERROR: The streaming mode requires the native trim engine (--trim-engine native).")
+        if not args.bypass_trf and args.trf_engine != "native":
+            sys.exit("ERROR: The streaming mode requires the native tandem repeat engine "+\
+                "(--trf-engine native) or --bypass-trf.")
+        if not args.reference_db or args.bmtagger:
+            sys.exit("ERROR: The streaming mode requires bowtie2 reference databases.")
+        args.serial=True
+        args.reorder=True
+
     # get the full path for the output directory
     args.output_dir = os.path.abspath(args.output_dir)
     if args.scratch_dir:
         args.scratch_dir = os.path.abspath(args.scratch_dir)    
+    if args.bmtagger_temp_dir:
+        args.bmtagger_temp_dir = os.path.abspath(args.bmtagger_temp_dir)
 
     # set if temp output should be removed
     args.remove_temp_output = not args.store_temp_output
@@ -320,6 +468,10 @@ def update_configuration(args):
     # if intermediate output should be removed, then also remove temp output
     if args.remove_intermediate_output:
         args.remove_temp_output = True
+        
+    # if intermediate output should be compressed, then also compress final output
+    if args.gzip_intermediate_output:
+        args.gzip_output = True
     
     # check the input files are non-empty and readable
     args.input=[]
@@ -345,6 +497,13 @@ def update_configuration(args):
     if args.scratch_dir:
         utilities.create_directory(args.scratch_dir)
     
+    # set the cache for the output files of the steps
+    args.cache=None
+    if args.cache_dir:
+        args.cache=cache.StepCache(os.path.abspath(args.cache_dir), int(args.cache_max_size*1024**3), VERSION)
+    if args.bmtagger_temp_dir:
+        utilities.create_directory(args.bmtagger_temp_dir)
+    
     # set bowtie2 options
     if args.bowtie2_options:
         # parse the options from the user into any array of options
@@ -355,6 +514,10 @@ def update_configuration(args):
         
     # add the quality scores to the bowtie2 options
     args.bowtie2_options+=[config.bowtie2_flag_start+args.trimmomatic_quality_scores]    
+
+    # use memory-mapped indexes so the preloaded index is shared by the bowtie2 processes
+    if args.preload_index and not args.bmtagger and not "--mm" in args.bowtie2_options:
+        args.bowtie2_options+=["--mm"]
   
     # set the mode for single end input file
     if len(args.input) == 1:
@@ -368,32 +531,8 @@ def update_configuration(args):
     # update the quality score option into a flag for trimmomatic
     args.trimmomatic_quality_scores=config.trimmomatic_flag_start+args.trimmomatic_quality_scores
         
-    # find the location of trimmomatic, trimmomatic does not need to be executable
-    if not args.bypass_trim:
-        args.trimmomatic_path=utilities.find_dependency(args.trimmomatic_path,config.trimmomatic_jar,"trimmomatic",
-            "--trimmomatic", bypass_permissions_check=True)
-    
-    # find the location of bmtagger, if set to run
-    if args.reference_db:
-        if args.bmtagger:
-            args.bmtagger_path=utilities.find_dependency(args.bmtagger_path,config.bmtagger_exe,"bmtagger",
-                "--bmtagger", bypass_permissions_check=False)
-            # add this folder to path, so as to be able to find other dependencies like bmfilter
-            utilities.add_exe_to_path(os.path.dirname(args.bmtagger_path))
-        else:
-            # find the location of bowtie2, if not running with bmtagger
-            args.bowtie2_path=utilities.find_dependency(args.bowtie2_path, config.bowtie2_exe, "bowtie2",
-                "--bowtie2", bypass_permissions_check=False)        
-    
-    # find the location of trf, if set to run
-    if not args.bypass_trf:
-        args.trf_path=utilities.find_dependency(args.trf_path,config.trf_exe,"trf",
-            "--trf", bypass_permissions_check=False)
-        
-    # if fastqc is set to be run, check if the executable can be found
-    if args.fastqc_start or args.fastqc_end or args.run_trim_repetitive:
-        args.fastqc_path=utilities.find_dependency(args.fastqc_path,config.fastqc_exe,"fastqc",
-                                                   "--fastqc",bypass_permissions_check=False)
+    # find the location of the dependencies
+    find_dependencies(args)
 
     # set the default output prefix 
     if args.output_prefix == None:
@@ -404,17 +543,8 @@ def update_configuration(args):
             infile_base = os.path.splitext(os.path.basename(args.input[0]))[0]
         args.output_prefix = infile_base + "_kneaddata"    
 
-    # find the bowtie2 indexes for each of the reference databases
-    # reference database inputs can be directories, indexes, or index files
-    if args.reference_db:
-        reference_indexes=[]
-        database_type="bowtie2"
-        if args.bmtagger:
-            database_type="bmtagger"
-        for directory in args.reference_db:
-            reference_indexes.append(utilities.find_database_index(os.path.abspath(directory),database_type))
-    
-        args.reference_db=reference_indexes
+    # find the database indexes
+    find_reference_indexes(args)
     
     return args
 
@@ -446,10 +576,116 @@ def setup_logging(args):
         message+=key+" = "+value_string+"\n"
     logger.debug(message)
 
+def get_sample_arguments(args, sample_settings):
+    """ Get the arguments to forward to each sample run from the arguments parsed,
+    skipping the settings set for each sample and those that are the defaults """
+    
+    sample_arguments=[]
+    for action in get_argument_parser()._actions:
+        if not action.option_strings or action.dest in sample_settings or not hasattr(args, action.dest):
+            continue
+        value=getattr(args, action.dest)
+        if value == action.default:
+            continue
+        # use the long option with the value attached so values starting with a dash are kept
+        option=action.option_strings[-1]
+        if action.nargs == 0:
+            sample_arguments.append(option)
+        elif isinstance(value, list):
+            sample_arguments+=[option+"="+str(item) for item in value]
+        else:
+            sample_arguments.append(option+"="+str(value))
+            
+    return sample_arguments
+
+def run_sample(sample_command):
+    """ Run kneaddata for a single sample in the batch, returning the run time if successful """
+    
+    command, sample, log = sample_command
+    start_time=time.time()
+    try:
+        subprocess.check_output(command, stderr=subprocess.STDOUT)
+    except (EnvironmentError, subprocess.CalledProcessError) as e:
+        message="ERROR: Unable to run sample "+sample+". See the log for more information: "+log
+        if hasattr(e, 'output') and e.output:
+            message+="\n"+e.output.decode("utf-8")
+        print(message)
+        return None
+    
+    seconds=time.time()-start_time
+    print("Finished sample "+sample+" in {0:.2f} seconds".format(seconds))
+    
+    return seconds
+
+def run_sample_sheet(args):
+    """ Run all of the samples in the sample sheet concurrently sharing the threads and processes,
+    finding the dependencies and database indexes once for all samples """
+    
+    samples=utilities.read_sample_sheet(args.sample_sheet)
+    
+    args.output_dir = os.path.abspath(args.output_dir)
+    utilities.create_directory(args.output_dir)
+    
+    # forward the settings from the user, except those that are set for each sample
+    sample_settings=["sample_sheet","input1","input2","unpaired","output_prefix","log","reference_db",
+        "threads","processes","trimmomatic_path","bowtie2_path","bmtagger_path","trf_path","fastqc_path"]
+    sample_arguments=get_sample_arguments(args,sample_settings)
+    
+    # find the dependencies and database indexes once for all samples
+    find_dependencies(args)
+    find_reference_indexes(args)
+    
+    # run as many samples at once as processes, dividing the threads among the samples
+    total_samples_at_once=max(1,min(args.processes,len(samples)))
+    threads_per_sample=max(1,args.threads // total_samples_at_once)
+    
+    command_base=[sys.executable,"-m","kneaddata.knead_data"]+sample_arguments
+    command_base+=["--threads",str(threads_per_sample),"--processes","1"]
+    for option, path in [("--trimmomatic",args.trimmomatic_path),("--bowtie2",args.bowtie2_path),
+        ("--bmtagger",args.bmtagger_path),("--trf",args.trf_path),("--fastqc",args.fastqc_path)]:
+        if path:
+            command_base+=[option,os.path.dirname(path)]
+    for index in args.reference_db:
+        command_base+=["-db",index]
+    
+    message="Running "+str(len(samples))+" samples with "+str(total_samples_at_once)+" at once using "+\
+        str(threads_per_sample)+" threads each"
+    print(message)
+    
+    sample_commands=[]
+    for sample, inputs in samples:
+        output_prefix=sample+"_kneaddata"
+        log=os.path.join(args.output_dir,output_prefix+".log")
+        command=command_base+["--output-prefix",output_prefix,"--log",log]
+        if len(inputs) == 2:
+            command+=["--input1",inputs[0],"--input2",inputs[1]]
+        else:
+            command+=["--unpaired",inputs[0]]
+        sample_commands.append((command, sample, log))
+    
+    # each sample runs in its own subprocess, so run the samples with threads
+    if ThreadPoolExecutor:
+        with ThreadPoolExecutor(total_samples_at_once) as executor:
+            run_times=list(executor.map(run_sample, sample_commands))
+    else:
+        pool=multiprocessing.pool.ThreadPool(total_samples_at_once)
+        run_times=pool.map(run_sample, sample_commands)
+        pool.close()
+        pool.join()
+    
+    failed_samples=[sample for (command, sample, log), seconds in zip(sample_commands, run_times) if seconds is None]
+    if failed_samples:
+        sys.exit("ERROR: Unable to run samples: "+" ".join(sorted(failed_samples)))
+            
 def main():
     # Parse the arguments from the user
     args = parse_arguments(sys.argv)
     
+    # Run all of the samples in batch mode, if set
+    if args.sample_sheet:
+        run_sample_sheet(args)
+        return
+    
     # Update the configuration
     args = update_configuration(args)
     
@@ -469,16 +705,24 @@ def main():
     for index in range(len(args.input)):
 
         # check for gzipped/bz2 files
-        if args.input[index].endswith(".gz") or args.input[index].endswith(".bz2"):
-            args.input[index]=utilities.get_decompressed_file(args.input[index], args.output_dir, temp_output_files, args.input)
+        # these are read decompressed on the fly by the checks and by trimmomatic,
+        # so only write a decompressed copy if the trim step is bypassed
+        if utilities.is_file_compressed(args.input[index]):
+            # if the identifiers will be reformatted, the reformatted file is written decompressed
+            if args.bypass_trim and not utilities.check_sequence_identifier_format(args.input[index]):
+                args.input[index]=utilities.get_decompressed_file(args.input[index], args.output_dir, temp_output_files, args.input)
         elif args.input[index].endswith(".bam"):
-            input_files_set=utilities.get_fastq_from_bam_file(args.input[index], args.output_dir, temp_output_files, args.input)
+            input_files_set=utilities.get_fastq_from_bam_file(args.input[index], args.output_dir, temp_output_files, args.input, args.threads)
             if isinstance(input_files_set,list):
                 args.input=input_files_set
             else:
                 args.input[index]=input_files_set
         elif args.input[index].endswith(".sam"): 
-            args.input[index]=utilities.get_fastq_from_sam_file(args.input[index], args.output_dir, temp_output_files, args.input)
+            input_files_set=utilities.get_fastq_from_sam_file(args.input[index], args.output_dir, temp_output_files, args.input)
+            if isinstance(input_files_set,list):
+                args.input=input_files_set
+            else:
+                args.input[index]=input_files_set
         
     # Get the format of the first input file
     file_format=utilities.get_file_format(args.input[0])
@@ -489,12 +733,17 @@ def main():
         sys.exit(message)
     
     # if this is the new illumina identifier format, create temp files after reformatting the headers
-    for index in range(len(args.input)):
-        args.input[index]=utilities.get_reformatted_identifiers(args.input[index],index,args.output_dir, temp_output_files, args.input)
+    # for pairs, also check the order of the reads in the same pass (if trimmomatic is run)
+    if len(args.input)==2:
+        args.input, pair_order=utilities.get_reformatted_identifiers_for_pairs(args.input, args.output_dir,
+            temp_output_files, check_order=not args.bypass_trim)
+    else:
+        for index in range(len(args.input)):
+            args.input[index]=utilities.get_reformatted_identifiers(args.input[index],index,args.output_dir, temp_output_files, args.input)
     
     # check for reads that are not ordered and order if needed (if trimmomatic is run)
     if not args.bypass_trim and len(args.input)==2:
-        args.input=utilities.check_and_reorder_reads(args.input, args.output_dir, temp_output_files)
+        args.input=utilities.check_and_reorder_reads(args.input, args.output_dir, temp_output_files, args.processes, pair_order)
    
     # remove any temp files from decompress/reformat that are no longer needed
     utilities.update_temp_output_files(temp_output_files, [], args.input)
@@ -526,7 +775,18 @@ def main():
                 temp_file = os.path.splitext(temp_file)[0]
             output_txt_files.append(args.output_dir+"/fastqc/"+temp_file.split('/')[-1]+"_fastqc/fastqc_data.txt")
 
-    if not args.bypass_trim:
+    if args.stream:
+        if args.run_trim_repetitive:
+            args.trimmomatic_options = utilities.get_updated_trimmomatic_parameters(output_txt_files, args.output_dir, args.trimmomatic_options)
+
+        if args.preload_index:
+            for index in args.reference_db:
+                utilities.preload_database_index(index, "bowtie2")
+                
+        # trim, remove repeats, and decontaminate at once streaming the reads between the steps
+        trimmomatic_output_files, trf_output_files, final_output_files = streaming.run_pipeline(args,
+            full_path_output_prefix, temp_output_files)
+    elif not args.bypass_trim:
         if args.run_trim_repetitive:
              # Get the Min Overrepresented Seq Length
             args.trimmomatic_options = utilities.get_updated_trimmomatic_parameters(output_txt_files, args.output_dir, args.trimmomatic_options)
@@ -534,7 +794,7 @@ def main():
         trimmomatic_output_files = run.trim(
         args.input, full_path_output_prefix, args.trimmomatic_path, 
         args.trimmomatic_quality_scores, args.max_memory, args.trimmomatic_options, 
-        args.threads, args.verbose)
+        args.threads, args.verbose, args.trim_engine, cache=args.cache)
         
     else:
         message="Bypass trimming"	
@@ -545,17 +805,18 @@ def main():
     # Get the number of reads after trimming
     utilities.log_read_count_for_files(trimmomatic_output_files,"trimmed","Total reads after trimming",args.verbose)
    
-    # run TRF, if set
-    if not args.bypass_trf:
+    # run TRF, if set (the streaming mode removes the repeats as the reads are streamed)
+    if not args.bypass_trf and not args.stream:
         # run trf on all output files
         trf_output_files=run.tandem(trimmomatic_output_files, full_path_output_prefix, args.match,
                                       args.mismatch,args.delta,args.pm,args.pi,
                                       args.minscore,args.maxperiod,args.trf_path,
-                                      args.processes,args.verbose,args.remove_temp_output,args.threads)
+                                      args.processes,args.verbose,args.remove_temp_output,args.threads,
+                                      args.trf_chunk_size,args.trf_engine,cache=args.cache)
         # remove the aligment files, if intermediate output files should be removed
         if args.reference_db and args.remove_intermediate_output:
             temp_output_files+=utilities.resolve_sublists(trimmomatic_output_files)
-    else:
+    elif not args.stream:
         trf_output_files = trimmomatic_output_files
     # If a reference database is not provided, then bypass decontamination step
     if not args.reference_db:
@@ -564,7 +825,10 @@ def main():
         print(message)
         # resolve sub-lists if present
         final_output_files=trf_output_files
-    else:
+    elif not args.stream:
+        if args.preload_index:
+            for index in args.reference_db:
+                utilities.preload_database_index(index, "bmtagger" if args.bmtagger else "bowtie2")
         final_output_files=run.decontaminate(args, full_path_output_prefix, trf_output_files)
         # remove trimmed output files, if set to remove intermediate outputx
         if not args.bypass_trim and args.remove_intermediate_output:
@@ -573,8 +837,11 @@ def main():
     # If set, concat the final output files if there is more than one
     final_output_files = utilities.resolve_sublists(final_output_files)
     if args.cat_final_output and len(final_output_files) > 1:
+        # with gzip output, the merged file is compressed as it is written
         cat_output_file=full_path_output_prefix+config.fastq_file_extension
-        utilities.cat_files(final_output_files,cat_output_file)
+        if args.gzip_output:
+            cat_output_file+=config.gzip_file_extension
+        utilities.cat_files(final_output_files,cat_output_file,args.threads if args.gzip_output else None)
         
         # if removing intermediate output, then remove the files that were merged
         if args.remove_intermediate_output:
@@ -588,6 +855,15 @@ def main():
         for file in temp_output_files:
             utilities.remove_file(file)
             
+    # Compress the output files, if set (after all read counts have been logged)
+    # this is a post-processing pass as most outputs are written by the external tools
+    if args.gzip_output:
+        if args.gzip_intermediate_output:
+            for file in utilities.find_intermediate_output_files(args.output_dir, args.output_prefix, final_output_files):
+                utilities.compress_file(file, args.threads)
+        final_output_files=[file if utilities.is_file_compressed(file) else utilities.compress_file(file, args.threads)
+            for file in final_output_files]
+            
     # Run fastqc if set to run at end of workflow
     if args.fastqc_end:
         run.fastqc(args.fastqc_path, args.output_dir, final_output_files, args.threads, args.verbose)
@@ -34,6 +34,9 @@ import gzip
 import tempfile
 from kneaddata import utilities
 from kneaddata import config
+from kneaddata import trf_parallel
+from kneaddata import tandem_repeats
+from kneaddata import trimming
 
 # name global logging instance
 logger=logging.getLogger(__name__)
@@ -52,9 +55,10 @@ def fastqc(fastqc_path, output_dir, input_files, threads, verbose):
 
 def align(infile_list, db_prefix_list, output_prefix, remove_temp_output,
           bowtie2_path, threads, processors, bowtie2_opts, verbose, 
-          discordant=None, reorder=None, serial=None, decontaminate_pairs=None):
+          discordant=None, reorder=None, serial=None, decontaminate_pairs=None, cache=None):
     """ Runs bowtie2 on a single-end sequence file or a paired-end set of files. 
-    For each input file set and database provided, a bowtie2 command is generated and run."""
+    For each input file set and database provided, a bowtie2 command is generated and run
+    (unless the output files are restored from the step cache)."""
 
     # determine if the input are paired reads
     is_paired = (len(infile_list) == 2)
@@ -67,6 +71,7 @@ def align(infile_list, db_prefix_list, output_prefix, remove_temp_output,
         all_outputs_to_combine = [[],[],[]]
         database_names = [[],[],[]]
     all_contaminated_outputs = []
+    sam_outputs = []
     bowtie2_command = [bowtie2_path, "--threads", str(threads)] + bowtie2_opts
     
     for basename, fullpath in _prefix_bases(db_prefix_list):
@@ -159,9 +164,20 @@ def align(infile_list, db_prefix_list, output_prefix, remove_temp_output,
         cmd += [ "-S", sam_out ]
         
         commands.append([cmd,"bowtie2",infile_list,outputs_to_combine,None])
-
+        if sam_out != os.devnull:
+            sam_outputs.append(sam_out)
+
+    # the outputs of all of the commands are cached as one step (as in serial mode each command reads the output of the last)
+    outputs_sets = itertools.chain.from_iterable(all_outputs_to_combine) if discordant else all_outputs_to_combine
+    step_outputs = all_contaminated_outputs + [file for outputs in outputs_sets for file in outputs] + sam_outputs
+    cache_key = cache.get_key("align", [item for command in commands for item in command[0]], infile_list, step_outputs,
+        databases=db_prefix_list) if cache else None
+    restored = cache.restore(cache_key, step_outputs) if cache else False
+    
     # run the bowtie2 commands with the number of processes specified
-    utilities.start_processes(commands,processors,verbose)
+    # (one at a time in serial mode as each command reads the output of the last)
+    if not restored:
+        utilities.start_processes(commands,1 if serial else processors,verbose,threads=threads)
 
     # write out total number of contaminated reads found
     for file in all_contaminated_outputs:
@@ -170,6 +186,9 @@ def align(infile_list, db_prefix_list, output_prefix, remove_temp_output,
         logger.info(message)
         if verbose:
             print(message)   
+    
+    if cache and not restored:
+        cache.store(cache_key, step_outputs)
 
     # if bowtie2 produced output, merge the files from multiple databases
     combined_outs = []
@@ -184,55 +203,119 @@ def align(infile_list, db_prefix_list, output_prefix, remove_temp_output,
 
     return combined_outs
 
-def write_tagged_sequences_from_fastq(input_fastq, bmtagger_output, output_fastq, verbose):
-    """ Find the sequences bmtagger has tagged as contaminates from the extract output file """
+def write_tagged_sequences_in_order(input_fastq, bmtagger_outputs, file_handles_write):
+    """ Write the sequences bmtagger has tagged as contaminates for each database, merging
+    the extract outputs with the fastq file in one pass as bmtagger writes the untagged
+    sequences in the input order. Return the total tagged sequences for each database,
+    or None if an extract output is not in the same order. """
+    
+    untagged_headers=[utilities.read_fastq_records(file,header_only=True) for file in bmtagger_outputs]
+    next_headers=[next(headers, None) for headers in untagged_headers]
+    tagged_sequences=[0]*len(bmtagger_outputs)
+    for record in utilities.read_fastq_records(input_fastq):
+        formatted_record=None
+        for index, next_header in enumerate(next_headers):
+            if record[0] == next_header:
+                next_headers[index]=next(untagged_headers[index], None)
+            else:
+                if formatted_record is None:
+                    formatted_record=utilities.format_fastq_record(record)
+                tagged_sequences[index]+=1
+                file_handles_write[index].write(formatted_record)
+    
+    # any headers remaining were not found in order
+    if any(next_header is not None for next_header in next_headers):
+        for headers in untagged_headers:
+            headers.close()
+        return None
+    
+    return tagged_sequences
+
+def write_tagged_sequences_with_set(input_fastq, bmtagger_output, file_handle_write):
+    """ Write the sequences bmtagger has tagged as contaminates, storing all of the 
+    untagged sequences from the extract output. Return the total tagged sequences. """
     
     # store all of the sequences bmtagger has not tagged as contaminates
-    untagged_sequences=set()
-    for lines in utilities.read_file_n_lines(bmtagger_output,4):
-        untagged_sequences.add(lines[0])
-                        
-    try:
-        file_handle_write=open(output_fastq,"w")
-    except EnvironmentError:
-        sys.exit("ERROR: Unable to open file: " + output_fastq)
-        
+    untagged_sequences=set(utilities.read_fastq_records(bmtagger_output,header_only=True))
+    
     tagged_sequences=0
-    for lines in utilities.read_file_n_lines(input_fastq,4):
+    for record in utilities.read_fastq_records(input_fastq):
         # check if the sequence was identified by bmtagger
-        if not lines[0] in untagged_sequences:
+        if not record[0] in untagged_sequences:
             tagged_sequences+=1
-            file_handle_write.write("".join(lines))
+            file_handle_write.write(utilities.format_fastq_record(record))
+    
+    return tagged_sequences
+
+def open_output_files(files):
+    """ Open the files for writing """
+    
+    file_handles=[]
+    for file in files:
+        try:
+            file_handles.append(open(file,"wb"))
+        except EnvironmentError:
+            sys.exit("ERROR: Unable to open file: " + file)
+    
+    return file_handles
+
+def write_tagged_sequences(input_fastq, bmtagger_outputs, output_fastqs, verbose):
+    """ Find the sequences bmtagger has tagged as contaminates from the extract output
+    files for all databases with one pass through the input file """
+    
+    file_handles_write=open_output_files(output_fastqs)
+    tagged_sequences=write_tagged_sequences_in_order(input_fastq, bmtagger_outputs, file_handles_write)
+    for file_handle in file_handles_write:
+        file_handle.close()
+    
+    if tagged_sequences is None:
+        logger.warning("The sequences in the bmtagger outputs ( " + ", ".join(bmtagger_outputs) + " ) are not " +
+            "in the same order as the input file so all untagged sequences will be stored to find the contaminates")
+        tagged_sequences=[]
+        for bmtagger_output, output_fastq in zip(bmtagger_outputs, output_fastqs):
+            file_handle_write=open_output_files([output_fastq])[0]
+            tagged_sequences.append(write_tagged_sequences_with_set(input_fastq, bmtagger_output, file_handle_write))
+            file_handle_write.close()
+    
+    for output_fastq, total_tagged in zip(output_fastqs, tagged_sequences):
+        utilities.record_read_count(output_fastq, total_tagged)
         
-    # log the number of sequences
-    message="Total contaminate sequences in file ( " + output_fastq + " ): " + str(tagged_sequences)
-    logger.info(message)
-    if verbose:
-        print(message)
+        # log the number of sequences
+        message="Total contaminate sequences in file ( " + output_fastq + " ): " + str(total_tagged)
+        logger.info(message)
+        if verbose:
+            print(message)
+
+def write_tagged_sequences_from_fastq(input_fastq, bmtagger_output, output_fastq, verbose):
+    """ Find the sequences bmtagger has tagged as contaminates from the extract output file """
+    
+    write_tagged_sequences(input_fastq, [bmtagger_output], [output_fastq], verbose)
 
 def tag(infile_list, db_prefix_list, remove_temp_output, output_prefix,
-        bmtagger_path, processes, verbose):
+        bmtagger_path, processes, verbose, temp_dir=None):
     """ Runs BMTagger on a single-end sequence file or a paired-end set of files. 
-    For each input file set and database provided, a bmtagger command is generated and run."""
+    For each input file set and database provided, a bmtagger command is generated and run
+    with its own temp directory (in the temp dir, if provided, otherwise the output folder)."""
 
     # determine if the input are paired reads
     is_paired = (len(infile_list) == 2)
 
-    # create a temp directory for bmtagger
-    tempdir=tempfile.mkdtemp(prefix=os.path.basename(output_prefix)+'_temp_',dir=os.path.dirname(output_prefix))
-
     # create the bmtagger commands
     commands = []
     all_outputs_to_combine = []
     contaminated_outputs = []
-    bmtagger_command = [bmtagger_path, "-q", "1", "-1", infile_list[0], 
-                        "-T", tempdir,"--extract"]
+    bmtagger_command = [bmtagger_path, "-q", "1", "-1", infile_list[0], "--extract"]
 
     # build arguments
     database_names=[]
+    tempdirs=[]
+    database_sizes=[]
     for (basename, fullpath) in _prefix_bases(db_prefix_list):
         prefix = output_prefix + "_" + basename + "_bmtagger"
-        cmd = bmtagger_command + ["-b", str(fullpath + ".bitmask"),
+        # create a temp directory for each database so the concurrent bmtagger runs do not share files
+        tempdirs.append(tempfile.mkdtemp(prefix=os.path.basename(prefix)+'_temp_',dir=temp_dir or os.path.dirname(output_prefix)))
+        database_sizes.append(utilities.get_database_index_size(fullpath, "bmtagger"))
+        cmd = bmtagger_command + ["-T", tempdirs[-1], "-b", str(fullpath + ".bitmask"),
                                   "-x", str(fullpath + ".srprism"),
                                   "-o", prefix]
         if is_paired:
@@ -249,22 +332,25 @@ def tag(infile_list, db_prefix_list, remove_temp_output, output_prefix,
             contaminated_outputs.append([prefix + "_contam" + config.fastq_file_extension])
             database_names+=[basename]
 
-        commands.append([cmd,"bmtagger",infile_list,outputs_to_combine,None])
+        # name the command with the database so the time for each run is logged
+        commands.append([cmd,"bmtagger ( "+basename+" )",infile_list,outputs_to_combine,None])
         all_outputs_to_combine.append(outputs_to_combine)
         
-    # run the bmtagger commands with the number of processes specified
-    utilities.start_processes(commands,processes,verbose)
+    # run the bmtagger commands with the number of processes specified, limiting the
+    # commands run at once so the largest database index loaded by each fits in memory
+    utilities.start_processes(commands,processes,verbose,memory=max(database_sizes) if database_sizes else None)
     
-    # write the files of contaminate sequences
-    for index, outputs in enumerate(all_outputs_to_combine):
-        for input_fastq, bmtagger_output, contam_output_fastq in zip(infile_list, outputs, contaminated_outputs[index]):
-            write_tagged_sequences_from_fastq(input_fastq, bmtagger_output, contam_output_fastq, verbose)
-
-    # remove the temp directory
-    try:
-        shutil.rmtree(tempdir)
-    except EnvironmentError:
-        logger.debug("Unable to remove temp directory: " +tempdir)
+    # write the files of contaminate sequences for all databases with one pass through each input file
+    for index, input_fastq in enumerate(infile_list):
+        write_tagged_sequences(input_fastq, [outputs[index] for outputs in all_outputs_to_combine],
+            [outputs[index] for outputs in contaminated_outputs], verbose)
+
+    # remove the temp directories
+    for tempdir in tempdirs:
+        try:
+            shutil.rmtree(tempdir)
+        except EnvironmentError:
+            logger.debug("Unable to remove temp directory: " +tempdir)
 
     # merge the output files from multiple databases
     combined_outs = []
@@ -281,24 +367,37 @@ def intersect_fastq(fastq_files, out_file, remove_temp_output=None):
     
     # optimize for the common case, where we are intersecting 1 file
     if len(fastq_files) == 1:
+        total_reads=utilities.get_recorded_read_count(fastq_files[0])
         if remove_temp_output:
             shutil.move(fastq_files[0], out_file)
         else:
             shutil.copyfile(fastq_files[0], out_file)
+        if total_reads is not None:
+            utilities.record_read_count(out_file, total_reads)
     else:
-        # store the number of files that contain each sequence
-        sequence_count={}
-        for fname in fastq_files:
-            for lines in utilities.read_file_n_lines(fname, 4):
-                sequence_count[lines[0]]=sequence_count.get(lines[0],0)+1
-    
-        num_files = len(fastq_files)
-        with open(out_file, "w") as file_handle:
+        # store the sorted 64-bit hashes of the sequence identifiers in each of the other files
+        # to bound memory (a hash collision could keep a read that is not in all files, which is
+        # very unlikely with 64-bit hashes)
+        other_files_hashes=[utilities.get_sorted_read_id_hashes(fname) for fname in fastq_files[1:]]
+    
+        with open(out_file, "wb") as file_handle:
             # read through one of the files, writing out each sequence that 
             # is found in all of the files
-            for lines in utilities.read_file_n_lines(fastq_files[0],4):
-                if sequence_count.get(lines[0],0) >= num_files:
-                    file_handle.write("".join(lines))
+            total_reads=0
+            records=utilities.read_fastq_records(fastq_files[0])
+            while True:
+                batch=list(itertools.islice(records, config.intersect_batch_size))
+                if not batch:
+                    break
+                found=[True]*len(batch)
+                hashes=[hash(record[0]) for record in batch]
+                for sorted_hashes in other_files_hashes:
+                    found=[a and b for a, b in zip(found, utilities.hashes_in_sorted_array(hashes, sorted_hashes))]
+                for record, record_found in zip(batch, found):
+                    if record_found:
+                        total_reads+=1
+                        file_handle.write(utilities.format_fastq_record(record))
+        utilities.record_read_count(out_file, total_reads)
 
 def combine_fastq_output_files(files_to_combine, out_prefix, remove_temp_output, database_names):
     """ Combines fastq output created by BMTagger/bowtie2 on multiple databases and 
@@ -370,18 +469,13 @@ def _prefix_bases(db_prefix_list):
             yield os.path.basename(file), file
 
 def trim(infiles, outfiles_prefix, trimmomatic_path, quality_scores, 
-         java_memory, additional_options, threads, verbose):
-    """ Creates and runs trimmomatic commands based on input files and options. 
+         java_memory, additional_options, threads, verbose, engine="trimmomatic", cache=None):
+    """ Creates and runs trimmomatic commands based on input files and options
+    (or runs the native trim engine with the same options), restoring the output
+    files from the step cache if available. 
     Returns a list of the output files.
     """
 
-    # Determine if the provided trimmomatic_path is a jar or an executable for conda install.
-    if trimmomatic_path.endswith('.jar'):
-        command = ["java", "-Xmx" + java_memory, "-jar", trimmomatic_path]
-    else:
-        # Assume it's a directly executable file
-        command = [trimmomatic_path]
-
     # determine if paired end input files
     paired_end=False
     if len(infiles) == 2:
@@ -399,13 +493,37 @@ def trim(infiles, outfiles_prefix, trimmomatic_path, quality_scores,
         mode = "SE"
         outfiles = [outfiles_prefix + config.trimomatic_se_ending]
     
-    # add positional arguments to command
-    command += [mode, "-threads", str(threads), quality_scores] + infiles + outfiles
-    # add optional arguments to command
-    command += additional_options
-
-    # run trimmomatic command
-    utilities.run_command(command,"Trimmomatic",infiles,outfiles,None,verbose,exit_on_error=True)
+    if engine == "native":
+        # the native trim engine options (to identify the step in the cache)
+        command = [engine, mode, quality_scores] + infiles + outfiles + additional_options
+    else:
+        # Determine if the provided trimmomatic_path is a jar or an executable for conda install.
+        if trimmomatic_path.endswith('.jar'):
+            command = ["java", "-Xmx" + java_memory, "-jar", trimmomatic_path]
+        else:
+            # Assume it's a directly executable file
+            command = [trimmomatic_path]
+            
+        # add positional arguments to command
+        command += [mode, "-threads", str(threads), quality_scores] + infiles + outfiles
+        # add optional arguments to command
+        command += additional_options
+    
+    # run the step unless the output files are restored from the cache
+    cache_key = cache.get_key("trim", command, infiles, outfiles) if cache else None
+    if not cache or not cache.restore(cache_key, outfiles):
+        if engine == "native":
+            # trim in process, writing the same output files and recording the read counts
+            trimming.trim(infiles, outfiles, additional_options, quality_scores, threads, verbose)
+        else:
+            # run trimmomatic command
+            trimmomatic_output=utilities.run_command(command,"Trimmomatic",infiles,outfiles,None,verbose,exit_on_error=True)
+            
+            # record the read counts from the trimmomatic summary so the output files are not read again to count
+            record_trimmomatic_read_counts(trimmomatic_output, outfiles, paired_end)
+        
+        if cache:
+            cache.store(cache_key, outfiles)
     
     # now check all of the output files to find which are non-empty and return as 
     # sets for running the alignment steps
@@ -449,39 +567,108 @@ def trim(infiles, outfiles_prefix, trimmomatic_path, quality_scores,
         
     return nonempty_outfiles
         
-def remove_repeats_from_fastq(input_fastq, trf_output, output_fastq):
-    """ Remove the sequences from TRF that contain repeats from the output files """
+def record_trimmomatic_read_counts(trimmomatic_output, outfiles, paired_end):
+    """ Record the number of reads in each of the trimmomatic output files from the run summary """
+    
+    if not trimmomatic_output:
+        return
+    if not isinstance(trimmomatic_output, str):
+        trimmomatic_output=trimmomatic_output.decode("utf-8", "replace")
+    
+    if paired_end:
+        summary=re.search(r"Both Surviving: (\d+) .*Forward Only Surviving: (\d+) .*Reverse Only Surviving: (\d+) ",trimmomatic_output)
+        if summary:
+            pairs, forward, reverse = [int(count) for count in summary.groups()]
+            # the output files are ordered pair1, orphan1, pair2, orphan2
+            for file, total_reads in zip(outfiles,[pairs,forward,pairs,reverse]):
+                utilities.record_read_count(file, total_reads)
+    else:
+        summary=re.search(r"Input Reads: \d+ Surviving: (\d+) ",trimmomatic_output)
+        if summary:
+            utilities.record_read_count(outfiles[0], int(summary.group(1)))
+
+def read_repeat_headers(trf_output):
+    """ Yield the headers of the sequences with repeats from the TRF output """
     
-    sequences_with_repeats=set()
-    try:
-        with open(trf_output) as file_handle:
-            for line in file_handle:
-                # sequences start with "@"
-                if line[0] == "@":
-                    sequences_with_repeats.add(line)
-    except EnvironmentError:
-        pass
-                
     try:
-        file_handle_write=open(output_fastq,"w")
+        file_handle=open(trf_output, "rb")
     except EnvironmentError:
-        sys.exit("ERROR: Unable to open file: " + output_fastq)
-        
+        return
+    
+    with file_handle:
+        for line in file_handle:
+            # sequences start with "@"
+            if line.startswith(b"@"):
+                yield line.rstrip(b"\n")
+
+def filter_repeats_in_order(input_fastq, trf_output, file_handle_write):
+    """ Write the sequences without repeats, merging the TRF output with the fastq file
+    as TRF reports the sequences in the input order. Return the total sequences and the
+    sequences removed, or None if the TRF output is not in the same order. """
+    
+    repeat_headers=read_repeat_headers(trf_output)
+    next_header=next(repeat_headers, None)
     removed_sequences=0
-    for lines in utilities.read_file_n_lines(input_fastq,4):
-        # check if the sequence was identified by TRF
-        if lines[0] in sequences_with_repeats:
+    total_sequences=0
+    for record in utilities.read_fastq_records(input_fastq):
+        total_sequences+=1
+        if record[0] == next_header:
             removed_sequences+=1
+            next_header=next(repeat_headers, None)
         else:
-            file_handle_write.write("".join(lines))
+            file_handle_write.write(utilities.format_fastq_record(record))
+    
+    # any headers remaining were not found in order
+    if next_header is not None:
+        repeat_headers.close()
+        return None
+    
+    return total_sequences, removed_sequences
+
+def filter_repeats_with_set(input_fastq, trf_output, file_handle_write):
+    """ Write the sequences without repeats, storing all of the headers from the TRF output.
+    Return the total sequences and the sequences removed. """
+    
+    sequences_with_repeats=set(read_repeat_headers(trf_output))
+    removed_sequences=0
+    total_sequences=0
+    for record in utilities.read_fastq_records(input_fastq):
+        total_sequences+=1
+        if record[0] in sequences_with_repeats:
+            removed_sequences+=1
+        else:
+            file_handle_write.write(utilities.format_fastq_record(record))
+    
+    return total_sequences, removed_sequences
+
+def remove_repeats_from_fastq(input_fastq, trf_output, output_fastq):
+    """ Remove the sequences from TRF that contain repeats from the output files """
+    
+    counts=None
+    for filter_repeats in [filter_repeats_in_order, filter_repeats_with_set]:
+        try:
+            file_handle_write=open(output_fastq,"wb")
+        except EnvironmentError:
+            sys.exit("ERROR: Unable to open file: " + output_fastq)
+        counts=filter_repeats(input_fastq, trf_output, file_handle_write)
+        file_handle_write.close()
+        if counts is not None:
+            break
+        logger.warning("The sequences in the TRF output ( " + trf_output + " ) are not in the same " +
+            "order as the input file so all sequences with repeats will be stored to filter the file")
+            
+    total_sequences, removed_sequences=counts
+    utilities.record_read_count(output_fastq, total_sequences-removed_sequences)
         
     # log the number of sequences removed for repeats
     logger.info("Total number of sequences with repeats removed from file ( " + 
                 input_fastq + " ): " + str(removed_sequences))
         
 def tandem(input_files, output_prefix, match, mismatch, delta, pm, pi, minscore,
-               maxperiod, trf_path, processors, verbose, remove_temp_output, threads):
-    """ Run TRF on all input files """
+               maxperiod, trf_path, processors, verbose, remove_temp_output, threads, chunk_size=None,
+               engine="trf", cache=None):
+    """ Run TRF (or the native tandem repeat engine) on all input files, restoring
+    the output files from the step cache if available """
 
     # Convert all arguments to strings    
     trf_args = list(map(str, [match, mismatch, delta, pm, pi, minscore, maxperiod]))
@@ -501,41 +688,62 @@ def tandem(input_files, output_prefix, match, mismatch, delta, pm, pi, minscore,
         else:
             output_fastq_files = [output_prefix + config.fastq_file_extension]
         
-        commands=[]
-        temp_fasta_files=[]
-        trf_output_files=[]
-        for input_fastq in input_fastq_files:
-            # create a temp fasta file from the fastq file
-            input_fasta = input_fastq.replace(os.path.splitext(input_fastq)[-1],config.fasta_file_extension)
-            utilities.fastq_to_fasta(input_fastq, input_fasta)
-            temp_fasta_files.append(input_fasta)
+        # the native engine is for short reads, so use trf for long reads if available
+        step_engine = engine
+        if engine == "native":
+            step_engine = tandem_repeats.check_read_length(input_fastq_files, trf_path)
+        
+        # run the step unless the output files are restored from the cache
+        command = [step_engine] + ([trf_path] if step_engine != "native" else []) + trf_args + input_fastq_files + output_fastq_files
+        cache_key = cache.get_key("tandem", command, input_fastq_files, output_fastq_files) if cache else None
+        if not cache or not cache.restore(cache_key, output_fastq_files):
+            temp_fasta_files=[]
+            trf_output_files=[]
+            for input_fastq in input_fastq_files:
+                input_fasta = input_fastq.replace(os.path.splitext(input_fastq)[-1],config.fasta_file_extension)
+                trf_output_file = input_fasta+".trf.parameters."+".".join(trf_args)+".dat"
+                trf_output_files.append(trf_output_file)
             
-            trf_output_file = input_fasta+".trf.parameters."+".".join(trf_args)+".dat"
-            trf_output_files.append(trf_output_file)
+                if step_engine == "native":
+                    # score the reads in process, writing the headers of the reads with repeats
+                    start_time=time.time()
+                    tandem_repeats.find_tandem_repeats(input_fastq, trf_output_file, match, mismatch, delta,
+                        minscore, maxperiod, threads*processors)
+                    message="Total time for native tandem repeat engine ( "+input_fastq+" ) : "+\
+                        "{0:.2f} seconds wall time".format(time.time()-start_time)
+                    logger.info(message)
+                    if verbose:
+                        print(message)
+                    continue
             
-            # suppress html output and write reduced data file to standard output
-            trf_command=["kneaddata_trf_parallel","--input",input_fasta,"--output",trf_output_file,"--trf-path",
-                    trf_path,"--trf-options","'"+" ".join(trf_args+["-h","-ngs"])+"'","--nproc",str(threads)]
-
-            # only run trf if the fasta file is not empty
-            if os.path.getsize(input_fasta) > 0:
-                commands.append([trf_command,"trf",[input_fasta],[trf_output_file],trf_output_file])
+                # create fasta files from the fastq file, one for each thread for trf to run in parallel
+                # or of the chunk size so the chunks are balanced across the threads as each chunk finishes
+                temp_folder = utilities.get_trf_temp_folder(os.path.dirname(input_fastq))
+                fasta_chunks = utilities.fastq_to_fasta_chunks(input_fastq, threads, temp_folder, chunk_size)
+                temp_fasta_files+=fasta_chunks
             
-        # run the trf commands with the number of processes specified
-        utilities.start_processes(commands,processors,verbose)
+                # only run trf if the fastq file has sequences
+                if fasta_chunks:
+                    # suppress html output and write reduced data file to standard output
+                    # running as many chunks at once as the threads for all processes
+                    trf_parallel.run_trf_chunks(fasta_chunks, trf_path, " ".join(trf_args+["-h","-ngs"]),
+                        threads*processors, trf_output_file, temp_folder, verbose)
         
-        # remove all fasta files when complete
-        for file in temp_fasta_files:
-            utilities.remove_file(file)
+            # remove all fasta files when complete
+            for file in temp_fasta_files:
+                utilities.remove_file(file)
     
-        # use the trf output to print the final fastq output files
-        for i in range(len(input_fastq_files)):
-            remove_repeats_from_fastq(input_fastq_files[i], trf_output_files[i], output_fastq_files[i])
+            # use the trf output to print the final fastq output files
+            for i in range(len(input_fastq_files)):
+                remove_repeats_from_fastq(input_fastq_files[i], trf_output_files[i], output_fastq_files[i])
             
-        # remove trf output if remove temp output is set
-        if remove_temp_output:
-            for file in trf_output_files:
-                utilities.remove_file(file)
+            # remove trf output if remove temp output is set
+            if remove_temp_output:
+                for file in trf_output_files:
+                    utilities.remove_file(file)
+        
+            if cache:
+                cache.store(cache_key, output_fastq_files)
         
         # sets for running the alignment steps
         if pairs:
@@ -566,7 +774,8 @@ def decontaminate(args, output_prefix, files_to_align):
         alignment_output_files = align([files_to_align[0][0],files_to_align[0][1]]+utilities.resolve_sublists(files_to_align[1:]), 
             args.reference_db, output_prefix, args.remove_temp_output, args.bowtie2_path, args.threads,
             args.processes, args.bowtie2_options, args.verbose, discordant=args.discordant, 
-            reorder=args.reorder, serial=args.serial, decontaminate_pairs=args.decontaminate_pairs)
+            reorder=args.reorder, serial=args.serial, decontaminate_pairs=args.decontaminate_pairs,
+            cache=args.cache)
         output_files=alignment_output_files
     else:
         for files_list in files_to_align:
@@ -580,11 +789,12 @@ def decontaminate(args, output_prefix, files_to_align):
             if args.bmtagger:
                 alignment_output_files = tag(files_list, args.reference_db,
                              args.remove_temp_output, prefix, args.bmtagger_path,
-                             args.processes, args.verbose)
+                             args.processes, args.verbose, temp_dir=args.bmtagger_temp_dir)
             else:
                 alignment_output_files = align(files_list, args.reference_db, prefix, 
                                args.remove_temp_output, args.bowtie2_path, args.threads,
-                               args.processes, args.bowtie2_options, args.verbose, serial=args.serial)
+                               args.processes, args.bowtie2_options, args.verbose, serial=args.serial,
+                               cache=args.cache)
              
             output_files.append(alignment_output_files)   
             
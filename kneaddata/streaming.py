@@ -0,0 +1,247 @@
+"""
+KneadData: streaming module
+
+Copyright (c) 2015 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    # allow for python2 in which the module is named Queue
+    import Queue as queue
+
+from kneaddata import utilities
+from kneaddata import config
+from kneaddata import run
+from kneaddata import trimming
+from kneaddata import tandem_repeats
+
+# name global logging instance
+logger=logging.getLogger(__name__)
+
+# The streaming mode trims the reads and removes the reads with tandem repeats in batches
+# in process, writing the remaining pairs (or single end reads) to fifos read by bowtie2 so
+# all of the steps run at once. The orphans are written to files as they are only read by
+# bowtie2 after the pairs. Only the first database reads the fifos so the databases run in serial.
+
+def get_records(data):
+    """ Split the formatted fastq reads into records """
+
+    lines=data.split(b"\n")
+    return list(zip(lines[0:-1:4], lines[1:-1:4], lines[2:-1:4], lines[3:-1:4]))
+
+def write_to_fifo(fifo, data_queue):
+    """ Write the data from the queue to the fifo until None is read from the queue
+    (run in a thread as opening the fifo blocks until the reader opens it) """
+
+    try:
+        with open(fifo, "wb") as file_handle:
+            for data in iter(data_queue.get, None):
+                file_handle.write(data)
+    except EnvironmentError:
+        # the reader exited (which is reported from its return code) so read the rest
+        # of the queue so the other outputs are not blocked
+        logger.debug("Unable to write to fifo: " + fifo)
+        for data in iter(data_queue.get, None):
+            pass
+
+def stream_reads(batches, repeat_options, trimmed_handles, output_handles, output_queues, total_reads, errors):
+    """ For each output of the trimmed batches, write the trimmed reads (if the file is set),
+    remove the reads with tandem repeats (if the options are set), and write the remaining
+    reads to the file and queue (if set), counting the trimmed and remaining reads """
+
+    try:
+        for output in batches:
+            for index, data in enumerate(output):
+                if trimmed_handles[index]:
+                    trimmed_handles[index].write(data)
+                records=get_records(data)
+                total_reads[index][0]+=len(records)
+                if repeat_options and records:
+                    remaining_records=tandem_repeats.remove_repeats_in_batch(records, *repeat_options)
+                    if len(remaining_records) < len(records):
+                        records=remaining_records
+                        data=b"".join([utilities.format_fastq_record(record) for record in records])
+                total_reads[index][1]+=len(records)
+                if output_handles[index]:
+                    output_handles[index].write(data)
+                if output_queues[index] and data:
+                    output_queues[index].put(data)
+    except (Exception, SystemExit) as error:
+        errors.append(error)
+    finally:
+        # close the files before the end of the fifos as the orphans are read after the pairs
+        for file_handle in trimmed_handles+output_handles:
+            if file_handle:
+                file_handle.close()
+        for data_queue in output_queues:
+            if data_queue:
+                data_queue.put(None)
+
+def open_output_file(file):
+    """ Open the file for writing """
+
+    try:
+        return open(file, "wb")
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to open file: " + file)
+
+def get_nonempty_sets(files, total_reads, paired_end):
+    """ Get the sets of files with reads (the pairs, if both have reads, followed by the orphans) """
+
+    if not paired_end:
+        return [[files[0]]] if total_reads[0] else []
+
+    nonempty_sets=[]
+    if total_reads[0] and total_reads[2]:
+        nonempty_sets.append([files[0], files[2]])
+    elif total_reads[0] or total_reads[2]:
+        nonempty_sets.append([files[0] if total_reads[0] else files[2]])
+    for index in [1, 3]:
+        if total_reads[index]:
+            nonempty_sets.append([files[index]])
+
+    return nonempty_sets
+
+def run_pipeline(args, output_prefix, temp_output_files):
+    """ Trim, remove the reads with tandem repeats, and decontaminate the input streaming
+    the reads between the steps. The trimmed and repeat removed files are only written if
+    temp output is stored. Return the trimmed, repeat removed, and final output files. """
+
+    try:
+        import numpy
+    except ImportError:
+        sys.exit("ERROR: The streaming mode requires numpy. Please install numpy.")
+
+    start_time=time.time()
+    steps=trimming.get_trim_steps(args.trimmomatic_options)
+    quality_offset=64 if "64" in args.trimmomatic_quality_scores else 33
+
+    # start the trim processes before the threads and bowtie2 so the threads are not forked
+    trim_pool=trimming.start_trim_pool(steps, quality_offset, args.threads)
+
+    # name the files as the trim and tandem steps do (pair1, orphan1, pair2, orphan2 for pairs)
+    paired_end=(len(args.input) == 2)
+    if paired_end:
+        trimmed_files=[output_prefix + config.trimomatic_pe_endings[index] for index in [0, 2, 1, 3]]
+        repeats_prefix=output_prefix+".repeats.removed"
+        output_files=[repeats_prefix + name + config.fastq_file_extension for name in [".1", ".unmatched.1", ".2", ".unmatched.2"]]
+        stream_indexes=[0, 2]
+    else:
+        trimmed_files=[output_prefix + config.trimomatic_se_ending]
+        output_files=[output_prefix + ".repeats.removed" + config.fastq_file_extension]
+        stream_indexes=[0]
+
+    repeat_options=None
+    if args.bypass_trf:
+        output_files=trimmed_files
+    else:
+        repeat_options=(args.match, args.mismatch, args.delta, args.minscore, args.maxperiod)
+        # the reads are streamed so TRF can not be run instead for long reads
+        tandem_repeats.check_read_length(args.input)
+
+    # the orphans are always written as they are read after the pairs
+    trimmed_handles=[None]*len(trimmed_files)
+    output_handles=[None]*len(output_files)
+    for index, file in enumerate(output_files):
+        if not index in stream_indexes or args.store_temp_output:
+            output_handles[index]=open_output_file(file)
+        if args.store_temp_output and repeat_options:
+            trimmed_handles[index]=open_output_file(trimmed_files[index])
+
+    # create a fifo for each stream, written by a thread so the fifos are written as read
+    fifo_folder=tempfile.mkdtemp(prefix=os.path.basename(output_prefix)+'_stream_',dir=os.path.dirname(output_prefix))
+    output_queues=[None]*len(output_files)
+    fifos=[]
+    for index in stream_indexes:
+        fifo=os.path.join(fifo_folder, os.path.basename(output_files[index]))
+        try:
+            os.mkfifo(fifo)
+        except (AttributeError, EnvironmentError):
+            sys.exit("ERROR: Unable to create fifo for the streaming mode: " + fifo)
+        fifos.append(fifo)
+        output_queues[index]=queue.Queue(config.stream_queue_size)
+        writer=threading.Thread(target=write_to_fifo, args=(fifo, output_queues[index]))
+        writer.daemon=True
+        writer.start()
+
+    # trim and remove repeats in a thread while bowtie2 reads the streams
+    total_reads=[[0, 0] for file in output_files]
+    errors=[]
+    batches=trimming.trim_batches(args.input, steps, quality_offset, args.threads, trim_pool)
+    producer=threading.Thread(target=stream_reads, args=(batches, repeat_options, trimmed_handles,
+        output_handles, output_queues, total_reads, errors))
+    producer.daemon=True
+    producer.start()
+
+    orphan_files=[output_files[index] for index in range(len(output_files)) if not index in stream_indexes]
+    try:
+        if paired_end and args.discordant:
+            # the orphans are read after the pairs by the discordant pairs mode
+            final_output_files=run.decontaminate(args, output_prefix, [fifos]+[[file] for file in orphan_files])
+            producer.join()
+        else:
+            final_output_files=run.decontaminate(args, output_prefix, [fifos])
+            producer.join()
+            # decontaminate the orphans with reads, named as in the decontaminate step
+            orphan_count=1
+            for file in orphan_files:
+                if total_reads[output_files.index(file)][1]:
+                    final_output_files.append(run.align([file], args.reference_db, output_prefix+"_unmatched_"+str(orphan_count),
+                        args.remove_temp_output, args.bowtie2_path, args.threads, args.processes, args.bowtie2_options,
+                        args.verbose, serial=args.serial))
+                    orphan_count+=1
+    finally:
+        shutil.rmtree(fifo_folder, ignore_errors=True)
+
+    if errors:
+        sys.exit("ERROR: Unable to stream the reads: " + str(errors[0]))
+
+    # record the read counts for the steps (written or streamed) and remove empty orphans
+    for index, (trimmed_file, output_file) in enumerate(zip(trimmed_files, output_files)):
+        utilities.record_read_count(trimmed_file, total_reads[index][0])
+        utilities.record_read_count(output_file, total_reads[index][1])
+        if repeat_options:
+            logger.info("Total number of sequences with repeats removed from file ( " + 
+                trimmed_file + " ): " + str(total_reads[index][0]-total_reads[index][1]))
+        if output_file in orphan_files:
+            if total_reads[index][1]:
+                temp_output_files.append(output_file)
+            else:
+                utilities.remove_file(output_file)
+        if args.store_temp_output and repeat_options and not total_reads[index][0]:
+            utilities.remove_file(trimmed_file)
+
+    message="Total time for streaming pipeline : {0:.2f} seconds wall time".format(time.time()-start_time)
+    logger.info(message)
+    if args.verbose:
+        print(message)
+
+    return (get_nonempty_sets(trimmed_files, [reads[0] for reads in total_reads], paired_end),
+        get_nonempty_sets(output_files, [reads[1] for reads in total_reads], paired_end), final_output_files)
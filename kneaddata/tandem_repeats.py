@@ -0,0 +1,203 @@
+"""
+KneadData: tandem_repeats module
+
+Copyright (c) 2015 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import math
+import logging
+import itertools
+import collections
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # allow for python2 without the futures backport, which scores the batches in one thread
+    ThreadPoolExecutor=None
+
+from kneaddata import utilities
+from kneaddata import config
+
+# name global logging instance
+logger=logging.getLogger(__name__)
+
+# The native engine scores the alignment of each read with itself shifted by each period
+# (the same alignment TRF extends from its k-tuple candidates) using the TRF weights. For
+# each period the best scoring segment that covers at least the minimum copies is found with
+# prefix sums, and one indel is allowed by joining a segment on a neighbouring period.
+# All periods for a batch of reads are scored at once so this is fast for short reads.
+
+def get_base_codes(sequences, length):
+    """ Encode the sequences as an array of base codes padded to the length,
+    with N and padding set to a code that never matches """
+
+    import numpy
+
+    lookup=numpy.full(256, 4, dtype=numpy.int8)
+    for code, base in enumerate(b"ACGT"):
+        lookup[base]=code
+        lookup[base+32]=code
+
+    codes=numpy.full((len(sequences), length), 4, dtype=numpy.int8)
+    for index, sequence in enumerate(sequences):
+        codes[index,:len(sequence)]=lookup[numpy.frombuffer(sequence, dtype=numpy.uint8)]
+
+    return codes
+
+def score_tandem_repeats(sequences, match, mismatch, delta, maxperiod):
+    """ Return an array of the best tandem repeat alignment score for each sequence """
+
+    try:
+        import numpy
+    except ImportError:
+        sys.exit("ERROR: The native tandem repeat engine requires numpy. Please install numpy.")
+
+    scores=numpy.zeros(len(sequences), dtype=numpy.int32)
+    length=max([len(sequence) for sequence in sequences] or [0])
+
+    # a repeat with the minimum copies must fit in the sequence
+    max_period=min(maxperiod, int(length / config.native_trf_min_copies))
+    if max_period < 1:
+        return scores
+
+    codes=get_base_codes(sequences, length)
+    valid=codes < 4
+    # use the smallest type that holds the sums of the weights for the sequence length
+    dtype=numpy.int16 if length*(max(match, mismatch)+delta) < 2**14 else numpy.int32
+    no_score=numpy.iinfo(dtype).min // 4
+
+    previous_best_end=None
+    previous_best_start=None
+    for period in range(1, max_period+1):
+        # score each position aligned with the position one period later
+        weights=numpy.where((codes[:,:-period] == codes[:,period:]) & valid[:,:-period],
+            dtype(match), dtype(-mismatch))
+        prefix=numpy.zeros((len(sequences), weights.shape[1]+1), dtype=dtype)
+        numpy.cumsum(weights, axis=1, out=prefix[:,1:])
+
+        # the best segment ending at each position that aligns at least the minimum
+        # copies (one copy less than the total as the first copy aligns to the second)
+        min_aligned=max(1, int(math.ceil(period*(config.native_trf_min_copies-1))))
+        best_end=numpy.full(weights.shape, no_score, dtype=dtype)
+        if min_aligned <= weights.shape[1]:
+            best_end[:,min_aligned-1:]=prefix[:,min_aligned:]-\
+                numpy.minimum.accumulate(prefix, axis=1)[:,:prefix.shape[1]-min_aligned]
+        # the best segment starting at each position
+        best_start=numpy.maximum.accumulate(prefix[:,::-1], axis=1)[:,::-1][:,1:]-prefix[:,:-1]
+
+        numpy.maximum(scores, best_end.max(axis=1), out=scores)
+
+        # join a segment to one on the neighbouring period after an insertion or deletion
+        if previous_best_end is not None and weights.shape[1] > 1:
+            numpy.maximum(scores, (previous_best_end[:,:-2]+best_start[:,1:]).max(axis=1)-delta, out=scores)
+            numpy.maximum(scores, (best_end+previous_best_start[:,1:]).max(axis=1)-delta, out=scores)
+        previous_best_end=best_end
+        previous_best_start=best_start
+
+    return scores
+
+def find_repeats_in_batch(records, match, mismatch, delta, minscore, maxperiod):
+    """ Return the headers of the records with a tandem repeat scoring at least the min score """
+
+    scores=score_tandem_repeats([record[1] for record in records], match, mismatch, delta, maxperiod)
+    return [record[0] for record, score in zip(records, scores) if score >= minscore]
+
+def remove_repeats_in_batch(records, match, mismatch, delta, minscore, maxperiod):
+    """ Return the records without a tandem repeat scoring at least the min score """
+
+    scores=score_tandem_repeats([record[1] for record in records], match, mismatch, delta, maxperiod)
+    return [record for record, score in zip(records, scores) if score < minscore]
+
+def read_batches(file, batch_size):
+    """ Yield lists of the records in the fastq file """
+
+    batch=[]
+    for record in utilities.read_fastq_records(file):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch=[]
+    if batch:
+        yield batch
+
+def get_max_read_length(input_fastq, total_reads):
+    """ Return the length of the longest read in the first reads of the fastq file """
+
+    return max([len(record[1]) for record in
+        itertools.islice(utilities.read_fastq_records(input_fastq), total_reads)] or [0])
+
+def check_read_length(input_fastq_files, trf_path=None):
+    """ Return the engine to use for the files, falling back to TRF if the reads are
+    longer than the native engine is designed for (and warning if TRF is not available) """
+
+    read_length=max(get_max_read_length(file, config.native_trf_batch_size) for file in input_fastq_files)
+    if read_length <= config.native_trf_max_read_length:
+        return "native"
+
+    message="The native tandem repeat engine is designed for reads up to "+\
+        str(config.native_trf_max_read_length)+" bases but the reads are "+str(read_length)+\
+        " bases ( "+" ".join(input_fastq_files)+" )"
+    if trf_path:
+        message+=", running TRF instead"
+        engine="trf"
+    else:
+        message+=", TRF is not available so the native engine is run which may be slow for these reads"
+        engine="native"
+    logger.warning(message)
+    print("WARNING: "+message)
+
+    return engine
+
+def find_tandem_repeats(input_fastq, output, match, mismatch, delta, minscore, maxperiod, threads=1):
+    """ Write the headers of the reads with tandem repeats to the output file, in the
+    same format as the headers in the TRF -ngs output, scoring the batches in threads """
+
+    try:
+        file_handle=open(output, "wb")
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to open file: " + output)
+
+    # numpy releases the GIL for the array operations so the batches are scored in parallel,
+    # limiting the batches waiting to be written to bound memory
+    threads=max(1, threads)
+    if not ThreadPoolExecutor:
+        for records in read_batches(input_fastq, config.native_trf_batch_size):
+            write_headers(file_handle, find_repeats_in_batch(records, match, mismatch, delta, minscore, maxperiod))
+        file_handle.close()
+        return
+
+    pending=collections.deque()
+    with ThreadPoolExecutor(threads) as executor:
+        for records in read_batches(input_fastq, config.native_trf_batch_size):
+            pending.append(executor.submit(find_repeats_in_batch, records, match, mismatch,
+                delta, minscore, maxperiod))
+            while len(pending) > threads*2:
+                write_headers(file_handle, pending.popleft().result())
+        while pending:
+            write_headers(file_handle, pending.popleft().result())
+    file_handle.close()
+
+def write_headers(file_handle, headers):
+    """ Write the headers, one per line """
+
+    for header in headers:
+        file_handle.write(header+b"\n")
@@ -1,14 +1,34 @@
 import unittest
+import sys
 import tempfile
 import os
 import logging
 import filecmp
+import gzip
+import shutil
+import collections
+import struct
+import multiprocessing
 
 import cfg
 import utils
 
 from kneaddata import run
 from kneaddata import utilities
+from kneaddata import bowtie2_discordant_pairs
+from kneaddata import tandem_repeats
+from kneaddata import trimming
+from kneaddata import streaming
+from kneaddata import bgzf
+from kneaddata import bam
+from kneaddata import cache
+from kneaddata import config
+from kneaddata import knead_data
+
+try:
+    import numpy
+except ImportError:
+    numpy=None
 
 class TestHumann2Functions(unittest.TestCase):
     """
@@ -29,6 +49,37 @@ class TestHumann2Functions(unittest.TestCase):
         
         self.assertEqual(sorted(sequences), sorted(cfg.merge_files_1_sequences))
 
+    def test_read_fastq_records(self):
+        """
+        Test the block based fastq record reader returns the same records as the line based reader,
+        and removes windows line endings including those split between blocks
+        """
+        
+        records=[utilities.format_fastq_record(record).decode("utf-8") for record in utilities.read_fastq_records(cfg.fastq_file)]
+        expected_records=["".join(lines) for lines in utilities.read_file_n_lines(cfg.fastq_file, 4)]
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        crlf_file=os.path.join(temp_directory,"crlf.fastq")
+        with open(cfg.fastq_file,"rb") as file_handle:
+            data=file_handle.read()
+        with open(crlf_file,"wb") as file_handle:
+            file_handle.write(data.replace(b"\n",b"\r\n"))
+        
+        crlf_records=[]
+        block_size=config.file_read_block_size
+        try:
+            # an odd block size so the line endings are split between blocks
+            for config.file_read_block_size in [block_size, 101]:
+                crlf_records.append([utilities.format_fastq_record(record).decode("utf-8")
+                    for record in utilities.read_fastq_records(crlf_file)])
+        finally:
+            config.file_read_block_size=block_size
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(records, expected_records)
+        self.assertEqual(crlf_records, [expected_records, expected_records])
+
     def test_intersect_fastq(self):
         """
         Test the intersect_fastq function
@@ -57,6 +108,83 @@ class TestHumann2Functions(unittest.TestCase):
         self.assertEqual(read_count, len(cfg.merge_files_1_sequences))
         
 
+    def test_count_reads_in_fastq_file_recorded(self):
+        """
+        Test the count reads function uses the count recorded when the file was written
+        and counts the file again if it has changed
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        temp_file=os.path.join(temp_directory,"merge1.fastq")
+        shutil.copyfile(cfg.merge_files[0], temp_file)
+        
+        utilities.record_read_count(temp_file, 100)
+        recorded_count=utilities.count_reads_in_fastq_file(temp_file,False)
+        
+        with open(temp_file,"a") as file_handle:
+            file_handle.write("@new_read\nATGC\n+\n1111")
+        updated_count=utilities.count_reads_in_fastq_file(temp_file,False)
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(recorded_count, 100)
+        self.assertEqual(updated_count, len(cfg.merge_files_1_sequences)+1)
+
+    def test_count_reads_in_fastq_file_gzipped(self):
+        """
+        Test the count reads function reads gzipped files without decompressing to disk
+        """
+        
+        read_count=utilities.count_reads_in_fastq_file(cfg.fastq_file_gzipped,False)
+        
+        self.assertEqual(read_count, utilities.count_reads_in_fastq_file(cfg.fastq_file,False))
+
+    def test_compress_file(self):
+        """
+        Test the compress file function writes a gzip readable copy using multiple threads,
+        and in one thread without concurrent.futures
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        temp_file=os.path.join(temp_directory,"demo.fastq")
+        
+        compressed_lines=[]
+        thread_pool_executor=bgzf.ThreadPoolExecutor
+        try:
+            for executor in [thread_pool_executor, None]:
+                bgzf.ThreadPoolExecutor=executor
+                shutil.copyfile(cfg.fastq_file, temp_file)
+                compressed_file=utilities.compress_file(temp_file, threads=2)
+                with gzip.open(compressed_file,"rt") as file_handle:
+                    compressed_lines.append(file_handle.readlines())
+        finally:
+            bgzf.ThreadPoolExecutor=thread_pool_executor
+        with open(cfg.fastq_file) as file_handle:
+            lines=file_handle.readlines()
+            
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(compressed_lines, [lines, lines])
+
+    def test_cat_files_compressed(self):
+        """
+        Test the cat files function writes the merged file as gzip when compress threads are provided
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        cat_file=os.path.join(temp_directory,"demo.fastq.gz")
+        
+        utilities.cat_files([cfg.fastq_file, cfg.fastq_file], cat_file, compress_threads=2)
+        
+        with gzip.open(cat_file,"rt") as file_handle:
+            compressed_lines=file_handle.readlines()
+        with open(cfg.fastq_file) as file_handle:
+            lines=file_handle.readlines()
+            
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(compressed_lines, lines+lines)
+
     def test_is_file_fastq(self):
         """
         Test the is file fastq function and also the get file format function
@@ -106,5 +234,851 @@ class TestHumann2Functions(unittest.TestCase):
                                      shallow=False))
         
         utils.remove_temp_file(temp_output_file)
+
+    def test_sam_to_fastq_pairs(self):
+        """
+        Test the sam to fastq function with pairs, writing the mates to the pair files,
+        skipping secondary alignments and repeated records, and writing the reads
+        without a mate to the single file
+        """
+        
+        # the first pair has a secondary alignment and a repeated record for the
+        # second mate (reverse complemented), the mates of the second pair are not adjacent,
+        # and the fourth read is missing its mate
+        records=[("pair1",0x63,"ACGTA"),("pair1",0x93,"AACCG"),("pair1",0x193,"AACCG"),
+            ("pair1",0x93,"AACCG"),("pair2",0x43,"GGGTT"),("pair3",0x4D,"TTTAC"),("pair3",0x8D,"CATTA"),
+            ("pair4",0x4D,"GATTA"),("pair2",0x83,"CATTA")]
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        sam_file=os.path.join(temp_directory,"reads.sam")
+        with open(sam_file,"w") as file_handle:
+            file_handle.write("@HD\tVN:1.0\n")
+            for name, flag, sequence in records:
+                file_handle.write("\t".join([name,str(flag),"*","0","0","*","*","0","0",sequence,"IIIII"])+"\n")
+        
+        output_files=utilities.sam_to_fastq(sam_file, os.path.join(temp_directory,"reads.fastq"))
+        
+        output=[]
+        for file in output_files+[os.path.join(temp_directory,"reads.fastq")]:
+            output.append([(record[0], record[1]) for record in utilities.read_fastq_records(file)])
+            
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(output_files, [os.path.join(temp_directory,"reads_R"+str(mate)+".fastq") for mate in [1,2]])
+        self.assertEqual(output[0], [(b"@pair1/1",b"ACGTA"),(b"@pair3/1",b"TTTAC"),(b"@pair2/1",b"GGGTT")])
+        self.assertEqual(output[1], [(b"@pair1/2",b"CGGTT"),(b"@pair3/2",b"CATTA"),(b"@pair2/2",b"CATTA")])
+        self.assertEqual(output[2], [(b"@pair4/1",b"GATTA")])
+
+    def test_sam_to_fastq_sorted_pairs(self):
+        """
+        Test the sam to fastq function with pairs from a file sorted by position,
+        where the mates of the pairs are not adjacent, writing all of the pairs
+        to the pair files and warning from the sort order in the header or from
+        the number of mates held without the header
+        """
+        
+        # each pair has the first mate at position i and the second mate at position i+5
+        # so the mates of all of the pairs are interleaved when sorted by position
+        records=[]
+        for index in range(10):
+            records.append(("pair"+str(index),0x63,index+1,"ACGTA"))
+            records.append(("pair"+str(index),0x93,index+6,"AACCG"))
+        records.sort(key=lambda record: record[2])
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        warnings=[]
+        warn_unpaired_mates=bam.warn_unpaired_mates
+        max_unpaired_mates=bam.max_unpaired_mates
+        try:
+            bam.warn_unpaired_mates=lambda file, reason: warnings.append(reason)
+            bam.max_unpaired_mates=5
+            for sam_name, header in [("sorted","@HD\tVN:1.0\tSO:coordinate\n@SQ\tSN:ref\tLN:100\n"),("no_header","")]:
+                sam_file=os.path.join(temp_directory,sam_name+".sam")
+                with open(sam_file,"w") as file_handle:
+                    file_handle.write(header)
+                    for name, flag, position, sequence in records:
+                        file_handle.write("\t".join([name,str(flag),"ref",str(position),"42","5M","=","0","0",sequence,"IIIII"])+"\n")
+                output_files=utilities.sam_to_fastq(sam_file, os.path.join(temp_directory,"sorted.fastq"))
+        finally:
+            bam.warn_unpaired_mates=warn_unpaired_mates
+            bam.max_unpaired_mates=max_unpaired_mates
+        
+        output=[]
+        for file in output_files:
+            output.append([record[0] for record in utilities.read_fastq_records(file)])
+        single_file_written=os.path.isfile(os.path.join(temp_directory,"sorted.fastq"))
+            
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(warnings, ["the file is sorted by coordinate","the mates are not adjacent"])
+        self.assertEqual(len(output_files), 2)
+        self.assertEqual(sorted(output[0]), sorted([("@pair"+str(index)+"/1").encode() for index in range(10)]))
+        self.assertEqual([header[:-2] for header in output[0]], [header[:-2] for header in output[1]])
+        self.assertFalse(single_file_written)
+
+    def test_bam_to_fastq(self):
+        """
+        Test the bam to fastq function with single end reads
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        temp_output_file=os.path.join(temp_directory,"demo.fastq")
+        
+        output_file=utilities.bam_to_fastq(cfg.file_bam, temp_output_file, temp_directory, 2)
+        
+        self.assertEqual(output_file, temp_output_file)
+        self.assertTrue(filecmp.cmp(temp_output_file, cfg.fastq_file_matches_sam_and_bam,
+                                     shallow=False))
+        self.assertEqual(sorted(os.listdir(temp_directory)), ["demo.fastq"])
+        
+        utils.remove_temp_folder(temp_directory)
+        
+    def test_bam_to_fastq_pairs(self):
+        """
+        Test the bam to fastq function with pairs, writing the mates to the pair files
+        in the same order (including mates that are not adjacent), reverse complementing
+        reverse strand alignments, skipping secondary alignments, and writing the reads
+        without a mate to the single file
+        """
+        
+        def bam_record(name, flag, sequence):
+            codes=["=ACMGRSVTWYHKDBN".index(base) for base in sequence]+[0]
+            packed=bytearray([codes[i] << 4 | codes[i+1] for i in range(0, len(sequence), 2)])
+            data=struct.pack("<iiBBHHHiiii", 0, 0, len(name)+1, 60, 0, 0, flag, len(sequence), 0, 0, 0)+\
+                name.encode()+b"\0"+bytes(packed)+bytes(bytearray([30]*len(sequence)))
+            return struct.pack("<i", len(data))+data
+        
+        # the first pair has the second mate reverse complemented and a secondary alignment,
+        # the second pair is not adjacent, and the third read of a pair is missing its mate
+        records=[("pair1",0x63,"ACGTA"),("pair1",0x93,"AACCG"),("pair1",0x193,"AACCG"),
+            ("pair2",0x43,"GGGTT"),("pair3",0x43,"TTTAC"),("pair2",0x83,"CATTA")]
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        bam_file=os.path.join(temp_directory,"reads.bam")
+        with bgzf.BgzfWriter(bam_file) as file_handle:
+            file_handle.write(b"BAM\x01"+struct.pack("<i",0)+struct.pack("<i",1)+struct.pack("<i",4)+b"ref\0"+struct.pack("<i",100))
+            for record in records:
+                file_handle.write(bam_record(*record))
+        
+        output_files=utilities.bam_to_fastq(bam_file, os.path.join(temp_directory,"reads.fastq"), temp_directory)
+        
+        output=[]
+        for file in output_files+[os.path.join(temp_directory,"reads.fastq")]:
+            output.append([(record[0], record[1]) for record in utilities.read_fastq_records(file)])
+            
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(output[0], [(b"@pair1/1",b"ACGTA"),(b"@pair2/1",b"GGGTT")])
+        self.assertEqual(output[1], [(b"@pair1/2",b"CGGTT"),(b"@pair2/2",b"CATTA")])
+        self.assertEqual(output[2], [(b"@pair3/1",b"TTTAC")])
+
+    def test_organize_alignments_stream(self):
+        """
+        Test organizing the alignments in one pass from the stream matches the two pass
+        organization from the sam file in both modes
+        """
+        
+        # pairs in input order followed by the orphans, with the flag for each read
+        reads=[("r1/1",0,True),("r1/2",16,True),("r2/1",4,True),("r2/2",4,True),
+               ("r3/1",0,True),("r3/2",4,True),("r4/1",4,True),("r4/2",0,True),
+               ("o1/1",0,False),("o2/2",4,False)]
+        sam_lines=[name+"\t"+str(flag)+"\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n" for name, flag, is_pair in reads]
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        sam_file=os.path.join(temp_directory,"test.sam")
+        with open(sam_file,"w") as file_handle:
+            file_handle.write("".join(sam_lines))
+        
+        for mode in ["strict","unpaired"]:
+            outputs={}
+            for method in ["single","stream"]:
+                names=[os.path.join(temp_directory,method+name) for name in ["_al_%","_un_%","_al_single_%","_un_single_%"]]
+                open_files=bowtie2_discordant_pairs.open_output_files(*names)
+                counts={name:0 for name in open_files.keys()}
+                if method == "single":
+                    bowtie2_discordant_pairs.organize_alignments_single(sam_file,open_files,counts,mode)
+                else:
+                    # the stream includes the header which is only written to the sam file
+                    header=["@HD\tVN:1.0\tSO:unsorted\n","@PG\tID:bowtie2\tPN:bowtie2\n"]
+                    read_types=collections.deque([is_pair for name, flag, is_pair in reads])
+                    stream_sam_file=os.path.join(temp_directory,"stream_"+mode+".sam")
+                    with open(stream_sam_file,"wb") as sam_file_handle:
+                        bowtie2_discordant_pairs.organize_alignments_stream([line.encode("utf-8") for line in header+sam_lines],
+                            read_types,open_files,counts,mode,sam_file_handle)
+                    self.assertEqual(open(stream_sam_file).readlines(),header+sam_lines)
+                for file_handle in open_files.values():
+                    file_handle.close()
+                outputs[method]={name: sorted(open(open_files[name].name).readlines()) for name in open_files}
+            
+            self.assertEqual(outputs["single"],outputs["stream"])
+        
+        utils.remove_temp_folder(temp_directory)
+
+    def test_read_alignment_states(self):
+        """
+        Test the compact alignment states keep the states for each query as the table grows
+        """
+        
+        states=bowtie2_discordant_pairs.ReadAlignmentStates(size=4)
+        for read in range(100):
+            states.add("read"+str(read), bowtie2_discordant_pairs.ReadAlignmentStates.pair1_aligned)
+            if read % 2:
+                states.add("read"+str(read), bowtie2_discordant_pairs.ReadAlignmentStates.pair2_unaligned)
+        
+        self.assertEqual(states.get("read10"), 1)
+        self.assertEqual(states.get("read11"), 9)
+        self.assertEqual(states.get("read100"), 0)
+
+    def test_preload_database_index(self):
+        """
+        Test the database index files are found and read for the preload
+        """
+        
+        index_files=utilities.get_database_index_files(cfg.bowtie2_db_index, "bowtie2")
+        
+        self.assertEqual(len(index_files), len(os.listdir(cfg.bowtie2_db_folder)))
+        self.assertTrue(utilities.preload_database_index(cfg.bowtie2_db_index, "bowtie2") >= 0)
+
+    def test_read_sample_sheet(self):
+        """
+        Test reading the sample sheet with single and paired samples, skipping comments
+        """
+        
+        file_handle, temp_sample_sheet=tempfile.mkstemp(prefix="kneaddata_test")
+        with open(temp_sample_sheet,"w") as file_handle:
+            file_handle.write("# sample\tinput1\tinput2\n")
+            file_handle.write("sample1\t"+cfg.fastq_file+"\n\n")
+            file_handle.write("sample2\t"+cfg.merge_files[0]+"\t"+cfg.merge_files[1]+"\n")
+            
+        samples=utilities.read_sample_sheet(temp_sample_sheet)
+        
+        utils.remove_temp_file(temp_sample_sheet)
+        
+        self.assertEqual(samples, [("sample1",[os.path.abspath(cfg.fastq_file)]),
+            ("sample2",[os.path.abspath(cfg.merge_files[0]),os.path.abspath(cfg.merge_files[1])])])
+
+    def test_get_sample_arguments(self):
+        """
+        Test the arguments for each sample are built from the settings parsed, skipping the
+        settings set for each sample in any of the forms they are provided
+        """
+        
+        args=knead_data.get_argument_parser().parse_args(["--sample-sheet","samples.tsv","-o","output",
+            "--threads=8","-p","2","-db","db1","--reference-db=db2","--bypass-trf","-v",
+            "--bowtie2-options=--very-sensitive","--bowtie2-options","-N 1","--trim-engine","native"])
+        
+        sample_arguments=knead_data.get_sample_arguments(args,["sample_sheet","reference_db","threads","processes"])
+        
+        self.assertEqual(sample_arguments, ["--verbose","--output=output","--bypass-trf","--trim-engine=native",
+            "--bowtie2-options=--very-sensitive","--bowtie2-options=-N 1"])
+        self.assertEqual(knead_data.get_argument_parser().parse_args(sample_arguments).bowtie2_options,
+            ["--very-sensitive","-N 1"])
+
+    def test_start_processes(self):
+        """
+        Test the commands are run with the output written to the stdout files, with the
+        thread scheduler and with the process pool used without concurrent.futures
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        output_files=[os.path.join(temp_directory,"output"+str(i)) for i in range(4)]
+        commands=[[["echo","command"+str(i)],"echo",[],[output_files[i]],output_files[i]] for i in range(4)]
+        
+        outputs=[]
+        thread_pool_executor=utilities.ThreadPoolExecutor
+        try:
+            for executor in [thread_pool_executor, None]:
+                utilities.ThreadPoolExecutor=executor
+                utilities.start_processes(commands,2,False,threads=1)
+                outputs.append([open(file).read() for file in output_files])
+                for file in output_files:
+                    utils.remove_temp_file(file)
+        finally:
+            utilities.ThreadPoolExecutor=thread_pool_executor
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        expected_outputs=["command"+str(i)+"\n" for i in range(4)]
+        self.assertEqual(outputs, [expected_outputs, expected_outputs])
+
+    def test_sort_fastq_file(self):
+        """
+        Test the external merge sort with multiple sorted runs matches sorting in memory,
+        keeping the last record for ids repeated in other runs
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        sorted_file=os.path.join(temp_directory,"sorted.fastq")
+        
+        # repeat the first reads with a new sequence after all of the reads
+        input_file=os.path.join(temp_directory,"input.fastq")
+        input_records=list(utilities.read_fastq_records(cfg.fastq_file))
+        input_records+=[(record[0], b"N"*len(record[1]), record[2], record[3]) for record in input_records[:150]]
+        with open(input_file,"wb") as file_handle:
+            for record in input_records:
+                file_handle.write(utilities.format_fastq_record(record))
+        
+        total_reads=utilities.sort_fastq_file(input_file, sorted_file, temp_directory, max_records=100)
+        
+        records=dict((utilities.get_read_id_minus_pair(record[0]), record) for record in input_records)
+        expected_records=[records[id] for id in sorted(records.keys())]
+        sorted_records=list(utilities.read_fastq_records(sorted_file))
+        
+        # check the temp run files were removed
+        temp_files=os.listdir(temp_directory)
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(sorted_records, expected_records)
+        self.assertEqual(total_reads, len(expected_records))
+        self.assertEqual(sorted(temp_files), ["input.fastq","sorted.fastq"])
+
+    def test_check_pair_order(self):
+        """
+        Test the pair order check finds pairs that are ordered, nearly ordered (which can be resynced), 
+        and out of order (which need to be sorted)
+        """
+        
+        ids=["read"+str(i) for i in range(100)]
+        nearly_ordered_ids=ids[1:3]+ids[0:1]+ids[3:]
+        
+        ordered=utilities.PairOrderChecker(window=10)
+        nearly_ordered=utilities.PairOrderChecker(window=10)
+        out_of_order=utilities.PairOrderChecker(window=10)
+        for pair1_id, nearly_ordered_id, reversed_id in zip(ids, nearly_ordered_ids, reversed(ids)):
+            ordered.add(pair1_id, pair1_id)
+            nearly_ordered.add(pair1_id, nearly_ordered_id)
+            out_of_order.add(pair1_id, reversed_id)
+            
+        self.assertTrue(ordered.is_ordered())
+        self.assertFalse(nearly_ordered.is_ordered())
+        self.assertEqual(nearly_ordered.first_divergence, 1)
+        self.assertTrue(nearly_ordered.can_resync())
+        self.assertFalse(out_of_order.can_resync())
+        
+    def test_resync_pair_file(self):
+        """
+        Test the pair2 reads are written in the order of the pair1 reads
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        pair1_file=os.path.join(temp_directory,"pair1.fastq")
+        pair2_file=os.path.join(temp_directory,"pair2.fastq")
+        resync_file=os.path.join(temp_directory,"resync.fastq")
+        for file, pair, order in [(pair1_file,"1",[0,1,2,3]),(pair2_file,"2",[1,0,3,2])]:
+            with open(file,"w") as file_handle:
+                for i in order:
+                    file_handle.write("@read"+str(i)+"/"+pair+"\nACGT\n+\nIIII\n")
         
+        total_reads=utilities.resync_pair_file(pair1_file, pair2_file, resync_file)
+        headers=list(utilities.read_fastq_records(resync_file,header_only=True))
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(total_reads, 4)
+        self.assertEqual(headers, [b"@read0/2",b"@read1/2",b"@read2/2",b"@read3/2"])
+
+    def test_get_reformatted_identifiers_for_pairs(self):
+        """
+        Test reformatting the identifiers for both pairs in one pass matches reformatting each file
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        input_files=[]
+        for pair in ["1","2"]:
+            input_files.append(os.path.join(temp_directory,"input"+pair+".fastq"))
+            with open(input_files[-1],"w") as file_handle:
+                for i in range(10):
+                    file_handle.write("@M00:1:FC:1:1:"+str(i)+":1 "+pair+":N:0:1\nACGT\n+\nIIII\n")
+        
+        expected_files=[utilities.get_reformatted_identifiers(file,index,temp_directory,[],[]) for index, file in enumerate(input_files)]
+        reformatted_files, pair_order=utilities.get_reformatted_identifiers_for_pairs(list(input_files),temp_directory,[])
+        
+        outputs=[open(file).read() for file in reformatted_files]
+        expected_outputs=[open(file).read() for file in expected_files]
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(outputs, expected_outputs)
+        self.assertTrue(pair_order.is_ordered())
+        self.assertEqual(pair_order.total_reads, [10,10])
+
+    def test_read_last_lines(self):
+        """
+        Test reading the last lines of plain and BGZF compressed files seeking from the end,
+        and not reading the last identifiers of other gzip files (which would need a full pass)
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        temp_file=os.path.join(temp_directory,"input.fastq")
+        shutil.copy(cfg.fastq_file, temp_file)
+        compressed_file=utilities.compress_file(temp_file)
+        gzip_file=os.path.join(temp_directory,"input_gzip.fastq.gz")
+        with open(cfg.fastq_file,"rb") as file_handle:
+            with gzip.open(gzip_file,"wb") as file_handle_write:
+                file_handle_write.write(file_handle.read())
+        
+        with open(cfg.fastq_file,"rb") as file_handle:
+            expected_lines=file_handle.readlines()[-400:]
+            
+        plain_lines=utilities.read_last_lines(cfg.fastq_file, 400)
+        compressed_lines=utilities.read_last_lines(compressed_file, 400)
+        gzip_identifiers=utilities.get_last_n_seq_identifiers(gzip_file, 400)
+        pair_ends_match=utilities.check_pair_ends([gzip_file, compressed_file])
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(plain_lines, expected_lines)
+        self.assertEqual(compressed_lines, expected_lines)
+        self.assertEqual(gzip_identifiers, [])
+        self.assertTrue(pair_ends_match)
+
+    def test_fastq_to_fasta_chunks(self):
+        """
+        Test converting the fastq file to balanced fasta chunks with all of the reads in order
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        
+        chunk_files=utilities.fastq_to_fasta_chunks(cfg.fastq_file, 4, temp_directory)
+        
+        chunk_reads=[]
+        for file in chunk_files:
+            with open(file) as file_handle:
+                chunk_reads.append([line.rstrip() for line in file_handle])
+        expected_reads=[]
+        for lines in utilities.read_file_n_lines(cfg.fastq_file, 4):
+            expected_reads+=[">"+lines[0].rstrip()[1:], lines[1].rstrip()]
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(len(chunk_files), 4)
+        self.assertEqual(sum(chunk_reads, []), expected_reads)
+        self.assertTrue(max(len(reads) for reads in chunk_reads)-min(len(reads) for reads in chunk_reads) <= 2*3)
+
+    def test_fastq_to_fasta_chunks_size(self):
+        """
+        Test converting the fastq file to fasta chunks of the chunk size
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        
+        chunk_files=utilities.fastq_to_fasta_chunks(cfg.fastq_file, 1, temp_directory, reads_per_chunk=100)
+        chunk_reads=[utilities.count_lines_in_file(file)//2 for file in chunk_files]
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        total_reads=int(utilities.count_reads_in_fastq_file(cfg.fastq_file, False))
+        self.assertEqual(sum(chunk_reads), total_reads)
+        self.assertEqual(chunk_reads[:-1], [100]*(len(chunk_reads)-1))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed so test is skipped")
+    def test_find_tandem_repeats(self):
+        """
+        Test finding the reads with tandem repeats with the native engine
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        input_fastq=os.path.join(temp_directory,"reads.fastq")
+        output=os.path.join(temp_directory,"reads.dat")
+        
+        # reads with a short period, a period with an insertion, and without a repeat
+        sequences={"period_3":"CAG"*30+"TTGACCGTAAGCTTAGGCAT",
+                   "period_6_insertion":"ACGTAC"*5+"ACGTACG"+"ACGTAC"*5,
+                   "no_repeat":"TTGACCGTAAGCTTAGGCATCCGATGAACTGGTCAAGTCTAGCGTAGCAATGC"}
+        with open(input_fastq,"w") as file_handle:
+            for name, sequence in sequences.items():
+                file_handle.write("@"+name+"\n"+sequence+"\n+\n"+"I"*len(sequence)+"\n")
+        
+        # score in threads, and in one thread without concurrent.futures
+        headers=[]
+        thread_pool_executor=tandem_repeats.ThreadPoolExecutor
+        try:
+            for executor in [thread_pool_executor, None]:
+                tandem_repeats.ThreadPoolExecutor=executor
+                tandem_repeats.find_tandem_repeats(input_fastq, output, 2, 7, 7, 50, 500, threads=2)
+                with open(output) as file_handle:
+                    headers.append(file_handle.read().split())
+        finally:
+            tandem_repeats.ThreadPoolExecutor=thread_pool_executor
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(headers, [["@period_3","@period_6_insertion"]]*2)
+
+    def test_check_read_length_tandem_repeats(self):
+        """
+        Test the native tandem repeat engine is used for short reads and TRF is used
+        for long reads if available
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        files={}
+        for name, length in [("short",100),("long",config.native_trf_max_read_length+1)]:
+            files[name]=os.path.join(temp_directory,name+".fastq")
+            with open(files[name],"w") as file_handle:
+                for index in range(3):
+                    sequence="ACGT"*(length//4)+"A"*(length%4)
+                    file_handle.write("@"+name+str(index)+"\n"+sequence[:length-index]+"\n+\n"+"I"*(length-index)+"\n")
+        
+        engines=[tandem_repeats.check_read_length([files["short"]], "trf"),
+            tandem_repeats.check_read_length([files["short"],files["long"]], "trf"),
+            tandem_repeats.check_read_length([files["long"]], None)]
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(engines, ["native","trf","native"])
 
+    def test_remove_repeats_from_fastq(self):
+        """
+        Test removing the sequences with repeats with the TRF output in the same order
+        as the fastq file and out of order
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        
+        headers=[record[0] for record in utilities.read_fastq_records(cfg.fastq_file)]
+        repeat_headers=headers[::7]
+        expected_headers=[header for header in headers if not header in repeat_headers]
+        
+        output_headers=[]
+        for name, dat_headers in [("in_order",repeat_headers),("out_of_order",list(reversed(repeat_headers)))]:
+            trf_output=os.path.join(temp_directory,name+".dat")
+            with open(trf_output,"wb") as file_handle:
+                for header in dat_headers:
+                    file_handle.write(header+b"\n1 10 2 5.0 2 100 0 20 50 50 0 0 1.00 AC ACACACACAC . .\n")
+            output_fastq=os.path.join(temp_directory,name+".fastq")
+            run.remove_repeats_from_fastq(cfg.fastq_file, trf_output, output_fastq)
+            output_headers.append([record[0] for record in utilities.read_fastq_records(output_fastq)])
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(output_headers[0], expected_headers)
+        self.assertEqual(output_headers[1], expected_headers)
+
+    def test_step_cache(self):
+        """
+        Test the step cache restores the output files (and read counts) for the same
+        command and inputs in another output folder, does not restore if the input
+        changes (including changes that keep the same size) or the database is rebuilt,
+        and removes the entries used least recently to fit the max size
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        folders=[os.path.join(temp_directory,name) for name in ["run1","run2","cache"]]
+        for folder in folders[:2]:
+            os.mkdir(folder)
+        step_cache=cache.StepCache(folders[2], 10000)
+        
+        input_file=os.path.join(temp_directory,"input.fastq")
+        shutil.copy(cfg.fastq_file, input_file)
+        outfiles=[[os.path.join(folder,"output.fastq"),os.path.join(folder,"missing.fastq")] for folder in folders[:2]]
+        keys=[step_cache.get_key("step",["tool",input_file]+files,[input_file],files) for files in outfiles]
+        
+        with open(outfiles[0][0],"w") as file_handle:
+            file_handle.write("@read\nACGT\n+\nIIII\n")
+        utilities.record_read_count(outfiles[0][0], 1)
+        step_cache.store(keys[0], outfiles[0])
+        restored=step_cache.restore(keys[1], outfiles[1])
+        restored_output=open(outfiles[1][0]).read()
+        restored_count=utilities.get_recorded_read_count(outfiles[1][0])
+        
+        # change a base in the middle of the input file, keeping the same size
+        with open(input_file,"rb") as file_handle:
+            data=bytearray(file_handle.read())
+        middle=data.index(b"\n", len(data)//2)+1
+        data[middle]=ord("A") if data[middle] != ord("A") else ord("C")
+        with open(input_file,"wb") as file_handle:
+            file_handle.write(bytes(data))
+        changed_key=step_cache.get_key("step",["tool",input_file]+outfiles[1],[input_file],outfiles[1])
+        
+        # rebuild the database index files at the same path
+        database=os.path.join(temp_directory,"db")
+        database_keys=[]
+        for index_data in ["index","rebuilt index"]:
+            with open(database+".1.bt2","w") as file_handle:
+                file_handle.write(index_data)
+            database_keys.append(step_cache.get_key("step",["tool","-x",database,input_file],[input_file],[],
+                databases=[database]))
+        
+        # add entries larger than the max size
+        large_output=os.path.join(folders[0],"large.fastq")
+        with open(large_output,"w") as file_handle:
+            file_handle.write("A"*6000)
+        step_cache.store("large_1", [large_output])
+        step_cache.store("large_2", [large_output])
+        entries=sorted(os.listdir(folders[2]))
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(keys[0], keys[1])
+        self.assertTrue(restored)
+        self.assertEqual(restored_output, "@read\nACGT\n+\nIIII\n")
+        self.assertEqual(restored_count, 1)
+        self.assertNotEqual(changed_key, keys[1])
+        self.assertNotEqual(database_keys[0], database_keys[1])
+        self.assertEqual(entries, ["large_2"])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed so test is skipped")
+    def test_trim_step_cache_rerun(self):
+        """
+        Test a rerun of the trim step restores the outputs from the cache when the inputs
+        have the same contents but new temp file names (as the reformatted and reordered
+        inputs do) in a new output folder
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        step_cache=cache.StepCache(os.path.join(temp_directory,"cache"), 10**9)
+        
+        outputs=[]
+        restored=[]
+        trim_function=trimming.trim
+        try:
+            for run_index in range(2):
+                output_folder=os.path.join(temp_directory,"run"+str(run_index))
+                os.mkdir(output_folder)
+                file_out, input_file=tempfile.mkstemp(prefix="reformatted_identifiers", suffix="_demo.fastq", dir=output_folder)
+                os.close(file_out)
+                shutil.copy(cfg.fastq_file, input_file)
+                
+                trim_calls=[]
+                def record_trim(*args):
+                    trim_calls.append(args)
+                    trim_function(*args)
+                trimming.trim=record_trim
+                
+                output_files=run.trim([input_file], os.path.join(output_folder,"demo_kneaddata"), None, "-phred33",
+                    None, ["SLIDINGWINDOW:4:20","MINLEN:50"], 1, False, engine="native", cache=step_cache)
+                outputs.append([open(file).read() for file in utilities.resolve_sublists(output_files)])
+                restored.append(not trim_calls)
+        finally:
+            trimming.trim=trim_function
+        entries=os.listdir(os.path.join(temp_directory,"cache"))
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(restored, [False, True])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(entries), 1)
+
+    def test_get_total_processes_memory_without_psutil(self):
+        """
+        Test the processes run at once are limited by the memory available when psutil
+        is not installed
+        """
+        
+        psutil_module=sys.modules.get("psutil")
+        get_available_cores=utilities.get_available_cores
+        # setting the module to None makes the import raise ImportError
+        sys.modules["psutil"]=None
+        utilities.get_available_cores=lambda: 8
+        try:
+            available_memory=utilities.get_available_memory()
+            total_processes=utilities.get_total_processes(8, 8, 1, memory=available_memory//3+1) if available_memory else None
+        finally:
+            utilities.get_available_cores=get_available_cores
+            if psutil_module is None:
+                del sys.modules["psutil"]
+            else:
+                sys.modules["psutil"]=psutil_module
+        
+        self.assertTrue(available_memory > 0)
+        self.assertEqual(total_processes, 2)
+
+    def test_tag_temp_folders_and_memory(self):
+        """
+        Test bmtagger is run for each database with its own temp folder in the temp dir
+        selected (removed when complete) and the runs at once limited by the memory for
+        the largest database index
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        scratch_directory=os.path.join(temp_directory,"scratch")
+        os.mkdir(scratch_directory)
+        
+        # create two databases of different sizes
+        databases=[]
+        for name, size in [("small",100),("large",1000)]:
+            databases.append(os.path.join(temp_directory,name))
+            for extension in [".bitmask",".srprism.idx"]:
+                with open(databases[-1]+extension,"w") as file_handle:
+                    file_handle.write("0"*size)
+        
+        # a stand-in for bmtagger that records the temp folder and writes all reads as untagged
+        bmtagger=os.path.join(temp_directory,"bmtagger.py")
+        with open(bmtagger,"w") as file_handle:
+            file_handle.write("#!"+sys.executable+"\nimport sys, os, shutil\n"+
+                "args=dict(zip(sys.argv[1:],sys.argv[2:]))\n"+
+                "open(os.path.join(args['-T'],'temp'),'w').write(str(len(os.listdir(args['-T']))))\n"+
+                "open(os.path.join(os.path.dirname(args['-o']),'temp_folders.txt'),'a').write(args['-T']+'\\n')\n"+
+                "shutil.copy(args['-1'],args['-o']+'.fastq')\n")
+        os.chmod(bmtagger,0o755)
+        
+        memory=[]
+        start_processes=utilities.start_processes
+        def record_memory(*args, **kwargs):
+            memory.append(kwargs.get("memory"))
+            start_processes(*args, **kwargs)
+        utilities.start_processes=record_memory
+        try:
+            output_files=run.tag([cfg.fastq_file], databases, True, os.path.join(temp_directory,"output"),
+                bmtagger, 2, False, temp_dir=scratch_directory)
+        finally:
+            utilities.start_processes=start_processes
+        
+        temp_folders=open(os.path.join(temp_directory,"temp_folders.txt")).read().split()
+        remaining_temp_folders=os.listdir(scratch_directory)
+        total_reads=len(list(utilities.read_fastq_records(output_files[0])))
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(memory, [2000])
+        self.assertEqual(len(set(temp_folders)), 2)
+        self.assertTrue(all(os.path.dirname(folder) == scratch_directory for folder in temp_folders))
+        self.assertEqual(remaining_temp_folders, [])
+        self.assertEqual(total_reads, len(list(utilities.read_fastq_records(cfg.fastq_file))))
+
+    def test_write_tagged_sequences(self):
+        """
+        Test writing the sequences tagged by bmtagger for multiple databases with one pass
+        through the input with the extract outputs in the same order as the fastq file
+        and with one extract output out of order
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        
+        records=list(utilities.read_fastq_records(cfg.fastq_file))
+        untagged=[records[::3], [record for index, record in enumerate(records) if index % 5]]
+        expected_headers=[[record[0] for record in records if not record in untagged_records]
+            for untagged_records in untagged]
+        
+        output_headers=[]
+        for name, order in [("in_order",[1,1]),("out_of_order",[1,-1])]:
+            bmtagger_outputs=[]
+            output_fastqs=[]
+            for index, untagged_records in enumerate(untagged):
+                bmtagger_outputs.append(os.path.join(temp_directory,name+"_"+str(index)+"_bmtagger.fastq"))
+                output_fastqs.append(os.path.join(temp_directory,name+"_"+str(index)+"_contam.fastq"))
+                with open(bmtagger_outputs[-1],"wb") as file_handle:
+                    for record in untagged_records[::order[index]]:
+                        file_handle.write(utilities.format_fastq_record(record))
+            run.write_tagged_sequences(cfg.fastq_file, bmtagger_outputs, output_fastqs, False)
+            output_headers.append([[record[0] for record in utilities.read_fastq_records(file)] for file in output_fastqs])
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(output_headers[0], expected_headers)
+        self.assertEqual(output_headers[1], expected_headers)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed so test is skipped")
+    def test_stream_reads(self):
+        """
+        Test streaming the reads without tandem repeats to the queue for the pairs and
+        to the file for the orphans, counting the reads before and after removing repeats
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        orphan_file=os.path.join(temp_directory,"orphan.fastq")
+        
+        repeat=b"@repeat\n"+b"CAG"*30+b"\n+\n"+b"I"*90+b"\n"
+        no_repeat=b"@no_repeat\nTTGACCGTAAGCTTAGGCATCCGATGAACTGGTCAAGTCTAGCGTAGCAATGC\n+\n"+b"I"*52+b"\n"
+        batches=[[repeat+no_repeat, no_repeat], [b"", repeat]]
+        
+        output_queue=streaming.queue.Queue()
+        total_reads=[[0, 0], [0, 0]]
+        errors=[]
+        streaming.stream_reads(iter(batches), (2, 7, 7, 50, 500), [None, None], [None, open(orphan_file, "wb")],
+            [output_queue, None], total_reads, errors)
+        
+        queued=list(iter(output_queue.get, None))
+        with open(orphan_file, "rb") as file_handle:
+            orphans=file_handle.read()
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(errors, [])
+        self.assertEqual(queued, [no_repeat])
+        self.assertEqual(orphans, no_repeat)
+        self.assertEqual(total_reads, [[2, 1], [2, 1]])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed so test is skipped")
+    def test_native_trim(self):
+        """
+        Test trimming pairs with the native engine, clipping the adapters for a pair with a short
+        fragment, trimming low quality bases, and writing the orphans
+        """
+        
+        temp_directory=tempfile.mkdtemp(prefix="kneaddata_test")
+        adapter_file=os.path.join(temp_directory,"adapters.fa")
+        with open(adapter_file,"w") as file_handle:
+            file_handle.write(">PrefixNX/1\nAGATGTGTATAAGAGACAG\n>PrefixNX/2\nAGATGTGTATAAGAGACAG\n"+
+                ">Trans1_rc\nCTGTCTCTTATACACATCTGACGCTGCCGACGA\n>Trans2_rc\nCTGTCTCTTATACACATCTCCGAGCCCACGAGAC\n")
+        
+        # the first pair has a fragment of 60 bases so both reads continue into the adapters,
+        # the second pair has a low quality end on the first read, and the third pair has
+        # a second read that is low quality
+        fragment="ACGGTCATTGCAGGTACCTTGAGCATCGATTCAGGCTAAGTCGGATCCATGCAAGTCTGA"
+        reverse_complement=fragment[::-1].translate(str.maketrans("ACGT","TGCA"))
+        reads1=[fragment+"CTGTCTCTTATACACATCTCCGAGCCCA", "GATTACA"*14, "TTGCA"*20]
+        reads2=[reverse_complement+"CTGTCTCTTATACACATCTGACGCTGCC", "CCAGT"*20, "AAGCT"*20]
+        qualities1=["I"*88, "I"*70+"#"*28, "I"*100]
+        qualities2=["I"*88, "I"*100, "#"*100]
+        input_files=[os.path.join(temp_directory,"reads_1.fastq"),os.path.join(temp_directory,"reads_2.fastq")]
+        for file, reads, qualities in zip(input_files, [reads1, reads2], [qualities1, qualities2]):
+            with open(file,"w") as file_handle:
+                for index, (read, quality) in enumerate(zip(reads, qualities)):
+                    file_handle.write("@read"+str(index)+"\n"+read+"\n+\n"+quality+"\n")
+        
+        output_files=[os.path.join(temp_directory,name) for name in ["pair1.fastq","orphan1.fastq","pair2.fastq","orphan2.fastq"]]
+        trimming.trim(input_files, output_files, ["ILLUMINACLIP:"+adapter_file+":2:30:10:8:TRUE",
+            "SLIDINGWINDOW:4:20","MINLEN:50"], "-phred33", 2, False)
+        
+        output=[]
+        for file in output_files:
+            output.append([(record[0], record[1]) for record in utilities.read_fastq_records(file)])
+        
+        utils.remove_temp_folder(temp_directory)
+        
+        self.assertEqual(output[0], [(b"@read0", fragment.encode()), (b"@read1", reads1[1][:70].encode())])
+        self.assertEqual(output[2], [(b"@read0", reverse_complement.encode()), (b"@read1", reads2[1].encode())])
+        self.assertEqual(output[1], [(b"@read2", reads1[2].encode())])
+        self.assertEqual(output[3], [])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed so test is skipped")
+    def test_trim_batches_stops_workers(self):
+        """
+        Test the processes trimming the batches are stopped if the batches are not all read
+        """
+        
+        batch_size=config.native_trim_batch_size
+        try:
+            config.native_trim_batch_size=10
+            batches=trimming.trim_batches([cfg.fastq_file], trimming.get_trim_steps(["MINLEN:50"]), 33, 2)
+            next(batches)
+            workers=len(multiprocessing.active_children())
+            batches.close()
+        finally:
+            config.native_trim_batch_size=batch_size
+        
+        self.assertEqual(workers, 2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed so test is skipped")
+    def test_trim_batches_started_pool(self):
+        """
+        Test trimming the batches with a pool started before the batches are read (as in the
+        streaming mode) matches trimming in this process, and the pool is stopped when complete
+        """
+        
+        steps=trimming.get_trim_steps(["SLIDINGWINDOW:4:20","MINLEN:50"])
+        batch_size=config.native_trim_batch_size
+        try:
+            config.native_trim_batch_size=10
+            pool=trimming.start_trim_pool(steps, 33, 2)
+            pool_output=list(trimming.trim_batches([cfg.fastq_file], steps, 33, 2, pool))
+            output=list(trimming.trim_batches([cfg.fastq_file], steps, 33, 1))
+        finally:
+            config.native_trim_batch_size=batch_size
+        
+        self.assertEqual(pool_output, output)
+        self.assertEqual(multiprocessing.active_children(), [])
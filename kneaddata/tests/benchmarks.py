@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+"""
+This software is used to benchmark the KneadData read processing functions.
+Synthetic files are written to a temp folder and removed after each benchmark.
+
+To Run: python benchmarks.py --benchmark fastq_reader --reads 10000000
+(the alignment state benchmark uses the reads as the number of pairs)
+(the trf concordance benchmark requires numpy and compares to TRF if it is installed)
+(the repeat filter benchmark was run with --reads 20000000)
+(the trim validation benchmark uses the reads as the number of pairs, requires numpy, and
+compares to Trimmomatic if it is installed)
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import random
+import struct
+import subprocess
+
+# Try to load the kneaddata package to check the installation
+try:
+    from kneaddata import utilities
+    from kneaddata import config
+    from kneaddata import run
+    from kneaddata import bgzf
+except ImportError:
+    sys.exit("CRITICAL ERROR: Unable to find the kneaddata python package." +
+        " Please check your install.")
+
+def write_synthetic_fastq(file, reads, read_length=100, pair=1):
+    """ Write a fastq file of synthetic reads """
+
+    sequence="ACGT"*(read_length//4)+"A"*(read_length%4)
+    quality="I"*read_length
+    with open(file, "w") as file_handle:
+        for read in range(reads):
+            file_handle.write("@read"+str(read)+"/"+str(pair)+"\n"+sequence+"\n+\n"+quality+"\n")
+
+def time_function(function, *args):
+    """ Return the time in seconds to run the function """
+
+    start_time=time.time()
+    function(*args)
+    return time.time()-start_time
+
+def print_throughput(name, reads, seconds):
+    """ Print the time and records per second """
+
+    print("{0:<40} {1:>10.2f} sec {2:>14,.0f} records/sec".format(name, seconds, reads/max(seconds,1e-9)))
+
+def benchmark_fastq_reader(reads, temp_folder):
+    """ Compare the line based reader with the block based fastq record reader """
+
+    fastq_file=os.path.join(temp_folder,"benchmark.fastq")
+    write_synthetic_fastq(fastq_file, reads)
+
+    def consume(generator):
+        for record in generator:
+            pass
+
+    print_throughput("read_file_n_lines", reads,
+        time_function(consume, utilities.read_file_n_lines(fastq_file,4)))
+    print_throughput("read_fastq_records", reads,
+        time_function(consume, utilities.read_fastq_records(fastq_file)))
+    print_throughput("read_fastq_records (header only)", reads,
+        time_function(consume, utilities.read_fastq_records(fastq_file, header_only=True)))
+
+def alignment_state_peak_rss(method, reads):
+    """ Print the increase in peak RSS (in KB) to store the alignment states for the pairs,
+    with the original dictionary of sets or the compact hash table """
+
+    import resource
+    from kneaddata import bowtie2_discordant_pairs
+
+    start_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if method == "dict_of_sets":
+        aligned={}
+        unaligned={}
+        for pair1 in [True, False]:
+            for read in range(reads):
+                states=aligned if read % 10 == 0 else unaligned
+                states.setdefault("read"+str(read)+"/",set()).add(pair1)
+    else:
+        states=bowtie2_discordant_pairs.ReadAlignmentStates()
+        for pair1 in [True, False]:
+            for read in range(reads):
+                states.add("read"+str(read)+"/", 1 if read % 10 == 0 else 4)
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-start_rss)
+
+def benchmark_alignment_state(reads, temp_folder):
+    """ Compare the peak memory to store the alignment state for the pairs, running each
+    method in a new process so the peak RSS is not shared """
+
+    for method in ["dict_of_sets", "hash_table"]:
+        start_time=time.time()
+        peak_rss=subprocess.check_output([sys.executable, "-c",
+            "import benchmarks; benchmarks.alignment_state_peak_rss('{0}', {1})".format(method, reads)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds=time.time()-start_time
+        print("{0:<40} {1:>10.2f} sec {2:>14,.0f} MB peak RSS".format(method, seconds, int(peak_rss)/1024.0))
+
+def write_synthetic_repeats_fastq(file, reads, read_length=150, fraction_with_repeats=0.1):
+    """ Write a fastq file of random reads with tandem repeats planted in a fraction of
+    the reads, returning the set of headers of the reads with repeats """
+
+    random.seed(1)
+    headers_with_repeats=set()
+    quality="I"*read_length
+    with open(file, "w") as file_handle:
+        for read in range(reads):
+            sequence=[random.choice("ACGT") for i in range(read_length)]
+            header="@read"+str(read)
+            if random.random() < fraction_with_repeats:
+                # plant a repeat with a random period and enough copies to score above the min score
+                period=random.randint(1,20)
+                unit=[random.choice("ACGT") for i in range(period)]
+                repeat_length=random.randint(max(2*period,40),read_length)
+                start=random.randint(0,read_length-repeat_length)
+                sequence[start:start+repeat_length]=(unit*(repeat_length//period+1))[:repeat_length]
+                headers_with_repeats.add(header)
+            file_handle.write(header+"\n"+"".join(sequence)+"\n+\n"+quality+"\n")
+
+    return headers_with_repeats
+
+def find_reads_with_repeats(engine, fastq_file, trf_path=None):
+    """ Return the time and the set of headers of the reads with repeats found by the engine """
+
+    start_time=time.time()
+    run.tandem([[fastq_file]], os.path.splitext(fastq_file)[0]+"_"+engine, config.trf_match, config.trf_mismatch,
+        config.trf_delta, config.trf_match_probability, config.trf_pi, config.trf_minscore, config.trf_maxperiod,
+        trf_path, 1, False, False, 1, engine=engine)
+    seconds=time.time()-start_time
+
+    trf_args=map(str, [config.trf_match, config.trf_mismatch, config.trf_delta, config.trf_match_probability,
+        config.trf_pi, config.trf_minscore, config.trf_maxperiod])
+    trf_output_file=os.path.splitext(fastq_file)[0]+config.fasta_file_extension+".trf.parameters."+".".join(trf_args)+".dat"
+    with open(trf_output_file) as file_handle:
+        headers=set(line.rstrip() for line in file_handle if line.startswith("@"))
+    utilities.remove_file(trf_output_file)
+
+    return seconds, headers
+
+def print_concordance(name, seconds, reads, headers, expected_headers):
+    """ Print the time and the reads found in both or only one of the sets of headers """
+
+    print("{0:<40} {1:>10.2f} sec {2:>14,.0f} records/sec {3:>8,} both {4:>8,} only {5:>8,} missed".format(
+        name, seconds, reads/max(seconds,1e-9), len(headers & expected_headers), len(headers - expected_headers),
+        len(expected_headers - headers)))
+
+def benchmark_trf_concordance(reads, temp_folder):
+    """ Compare the reads with repeats found by the native engine to those found by TRF on
+    the test data and to the repeats planted in synthetic reads """
+
+    trf_path=utilities.find_exe_in_path(config.trf_exe, bypass_permissions_check=True)
+    if trf_path:
+        trf_path=os.path.join(trf_path, config.trf_exe)
+    else:
+        print("TRF is not installed so only the planted repeats are compared")
+
+    data_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+    fastq_files=[]
+    for file in ["demo.fastq","demo2.fastq"]:
+        shutil.copy(os.path.join(data_folder,file), temp_folder)
+        fastq_files.append(os.path.join(temp_folder,file))
+
+    synthetic_fastq_file=os.path.join(temp_folder,"benchmark.fastq")
+    planted_headers=write_synthetic_repeats_fastq(synthetic_fastq_file, reads)
+    fastq_files.append(synthetic_fastq_file)
+
+    for fastq_file in fastq_files:
+        total_reads=int(utilities.count_reads_in_fastq_file(fastq_file, False))
+        native_seconds, native_headers=find_reads_with_repeats("native", fastq_file)
+        if trf_path:
+            trf_seconds, trf_headers=find_reads_with_repeats("trf", fastq_file, trf_path)
+            print_throughput("trf ( "+os.path.basename(fastq_file)+" )", total_reads, trf_seconds)
+            print_concordance("native vs trf ( "+os.path.basename(fastq_file)+" )", native_seconds, total_reads,
+                native_headers, trf_headers)
+        if fastq_file == synthetic_fastq_file:
+            print_concordance("native vs planted", native_seconds, total_reads, native_headers, planted_headers)
+
+def repeat_filter_peak_rss(method, fastq_file, trf_output, output_fastq):
+    """ Print the increase in peak RSS (in KB) to filter the reads with repeats, with the
+    set of all of the headers or the ordered merge of the TRF output with the fastq file """
+
+    import resource
+
+    start_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    filter_repeats=run.filter_repeats_with_set if method == "set" else run.filter_repeats_in_order
+    with open(output_fastq, "wb") as file_handle:
+        filter_repeats(fastq_file, trf_output, file_handle)
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-start_rss)
+
+def benchmark_repeat_filter(reads, temp_folder):
+    """ Compare the time and peak memory to filter the reads with repeats (one in ten reads),
+    running each method in a new process so the peak RSS is not shared """
+
+    fastq_file=os.path.join(temp_folder,"benchmark.fastq")
+    write_synthetic_fastq(fastq_file, reads)
+    trf_output=os.path.join(temp_folder,"benchmark.dat")
+    with open(trf_output, "w") as file_handle:
+        for read in range(0, reads, 10):
+            file_handle.write("@read"+str(read)+"/1\n1 100 4 25.0 4 100 0 200 25 25 25 25 2.00 ACGT ACGT . .\n")
+
+    for method in ["set", "merge"]:
+        start_time=time.time()
+        peak_rss=subprocess.check_output([sys.executable, "-c",
+            "import benchmarks; benchmarks.repeat_filter_peak_rss('{0}', '{1}', '{2}', '{3}')".format(
+            method, fastq_file, trf_output, os.path.join(temp_folder,method+".fastq"))],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds=time.time()-start_time
+        print("{0:<40} {1:>10.2f} sec {2:>14,.0f} records/sec {3:>10,.0f} MB peak RSS".format(
+            method, seconds, reads/max(seconds,1e-9), int(peak_rss)/1024.0))
+
+nextera_adapters=[(">PrefixNX/1","AGATGTGTATAAGAGACAG"), (">PrefixNX/2","AGATGTGTATAAGAGACAG"),
+    (">Trans1","TCGTCGGCAGCGTCAGATGTGTATAAGAGACAG"), (">Trans1_rc","CTGTCTCTTATACACATCTGACGCTGCCGACGA"),
+    (">Trans2","GTCTCGTGGGCTCGGAGATGTGTATAAGAGACAG"), (">Trans2_rc","CTGTCTCTTATACACATCTCCGAGCCCACGAGAC")]
+
+def reverse_complement(sequence):
+    """ Return the reverse complement of the sequence """
+
+    return sequence[::-1].translate(str.maketrans("ACGT","TGCA"))
+
+def write_synthetic_adapter_pairs(files, pairs, read_length=100, fraction_short_fragments=0.1):
+    """ Write fastq files of random pairs where a fraction of the fragments are shorter than
+    the reads, so the reads continue into the Nextera adapters, with random low quality bases """
+
+    random.seed(1)
+    adapters=dict(nextera_adapters)
+    with open(files[0], "w") as file_handle1, open(files[1], "w") as file_handle2:
+        for pair in range(pairs):
+            fragment_length=random.randint(20,read_length) if random.random() < fraction_short_fragments else read_length*3
+            fragment="".join(random.choice("ACGT") for i in range(fragment_length))
+            read1=(fragment+adapters[">Trans2_rc"])[:read_length]
+            read2=(reverse_complement(fragment)+adapters[">Trans1_rc"])[:read_length]
+            for file_handle, read in [(file_handle1, read1), (file_handle2, read2)]:
+                quality="".join(random.choice("IIIIIIIII5#") for i in range(len(read)))
+                file_handle.write("@pair"+str(pair)+"\n"+read+"\n+\n"+quality+"\n")
+
+def read_trimmed_sequences(files):
+    """ Return a dictionary of the sequences for each header in the files, if they exist """
+
+    sequences={}
+    for file in files:
+        if os.path.isfile(file):
+            for record in utilities.read_fastq_records(file):
+                sequences[record[0]]=record[1]
+    return sequences
+
+def benchmark_trim_validation(reads, temp_folder):
+    """ Compare the reads trimmed by the native engine to those trimmed by Trimmomatic with the default
+    options on the test data and synthetic pairs, and the time to trim the synthetic pairs """
+
+    trimmomatic_path=utilities.find_exe_in_path(config.trimmomatic_jar, bypass_permissions_check=True, add_exe_to_path=True)
+    if not trimmomatic_path:
+        print("Trimmomatic is not installed so only the time for the native engine is reported")
+
+    adapter_folder=config.trimmomatic_adapter_folder
+    if not os.path.isfile(os.path.join(adapter_folder, config.trimmomatic_provided_sequencer_default+"-PE.fa")):
+        adapter_folder=temp_folder
+        with open(os.path.join(temp_folder, config.trimmomatic_provided_sequencer_default+"-PE.fa"), "w") as file_handle:
+            file_handle.write("\n".join(["\n".join(adapter) for adapter in nextera_adapters])+"\n")
+
+    data_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+    synthetic_files=[os.path.join(temp_folder,"benchmark_1.fastq"), os.path.join(temp_folder,"benchmark_2.fastq")]
+    write_synthetic_adapter_pairs(synthetic_files, reads)
+    inputs=[("demo.fastq", [os.path.join(data_folder,"demo.fastq")]),
+            ("demo.fastq demo2.fastq", [os.path.join(data_folder,"demo.fastq"), os.path.join(data_folder,"demo2.fastq")]),
+            ("synthetic pairs", synthetic_files)]
+
+    for name, input_files in inputs:
+        options=utilities.get_default_trimmomatic_options(utilities.get_read_length_fastq(input_files[0]),
+            path=adapter_folder, type="PE" if len(input_files) == 2 else "SE",
+            sequencer_source=config.trimmomatic_provided_sequencer_default)
+        endings=config.trimomatic_pe_endings if len(input_files) == 2 else [config.trimomatic_se_ending]
+        trimmed={}
+        for engine in ["native", "trimmomatic"] if trimmomatic_path else ["native"]:
+            output_prefix=os.path.join(temp_folder, engine)
+            start_time=time.time()
+            run.trim(input_files, output_prefix, trimmomatic_path, "-phred33", config.trimmomatic_memory,
+                options, 1, False, engine)
+            print_throughput(engine+" ( "+name+" )", reads if input_files == synthetic_files else
+                int(utilities.count_reads_in_fastq_file(input_files[0], False)), time.time()-start_time)
+            trimmed[engine]=[read_trimmed_sequences([output_prefix+ending]) for ending in endings]
+        if trimmomatic_path:
+            for ending, native, trimmomatic in zip(endings, trimmed["native"], trimmed["trimmomatic"]):
+                same=sum(1 for header in native if trimmomatic.get(header) == native[header])
+                print("{0:<40} {1:>8,} same {2:>8,} different length {3:>8,} native only {4:>8,} trimmomatic only".format(
+                    "  "+ending, same, len(set(native) & set(trimmomatic))-same, len(set(native)-set(trimmomatic)),
+                    len(set(trimmomatic)-set(native))))
+
+def encode_bam_record(name, flag, sequence, quality):
+    """ Return the BAM record (unmapped) for the read """
+
+    bases="=ACMGRSVTWYHKDBN"
+    codes=[bases.index(base) for base in sequence]+[0]
+    packed=bytearray([codes[i] << 4 | codes[i+1] for i in range(0, len(sequence), 2)])
+    name=name.encode("utf-8")+b"\0"
+    data=struct.pack("<iiBBHHHiiii", -1, -1, len(name), 255, 4680, 0, flag, len(sequence), -1, -1, 0)+\
+        name+bytes(packed)+bytes(bytearray([ord(score)-33 for score in quality]))
+    return struct.pack("<i", len(data))+data
+
+def write_synthetic_bam(file, pairs, read_length=100):
+    """ Write a BAM file of random pairs, with the mates adjacent as in an unaligned BAM """
+
+    random.seed(1)
+    with bgzf.BgzfWriter(file) as file_handle:
+        file_handle.write(b"BAM\x01"+struct.pack("<ii", 0, 0))
+        for pair in range(pairs):
+            for flag in [0x4d, 0x8d]:
+                sequence="".join(random.choice("ACGT") for i in range(read_length))
+                file_handle.write(encode_bam_record("pair"+str(pair), flag, sequence, "I"*read_length))
+
+def benchmark_bam_to_fastq(reads, temp_folder):
+    """ Compare the time to convert a paired BAM file to fastq files with samtools and grep
+    to the native reader with one and multiple threads """
+
+    bam_file=os.path.join(temp_folder,"benchmark.bam")
+    write_synthetic_bam(bam_file, reads//2)
+
+    fastq_file=os.path.join(temp_folder,"benchmark.fastq")
+    if utilities.find_exe_in_path(config.samtools_exe):
+        start_time=time.time()
+        subprocess.check_call(config.samtools_exe+" bam2fq "+bam_file+" > "+fastq_file, shell=True)
+        for mate in ["1", "2"]:
+            subprocess.check_call("grep '^@.*/"+mate+"$' "+fastq_file+" -A 3 --no-group-separator > "+
+                fastq_file+mate, shell=True)
+        print_throughput("samtools and grep", reads, time.time()-start_time)
+    else:
+        print("samtools is not installed so only the time for the native reader is reported")
+
+    for threads in sorted(set([1, max(1, utilities.get_available_cores())])):
+        start_time=time.time()
+        utilities.bam_to_fastq(bam_file, fastq_file, temp_folder, threads)
+        print_throughput("native ( "+str(threads)+" threads )", reads, time.time()-start_time)
+
+benchmarks={"fastq_reader": benchmark_fastq_reader,
+            "alignment_state": benchmark_alignment_state,
+            "trf_concordance": benchmark_trf_concordance,
+            "repeat_filter": benchmark_repeat_filter,
+            "trim_validation": benchmark_trim_validation,
+            "bam_to_fastq": benchmark_bam_to_fastq}
+
+def parse_arguments(args):
+    """
+    Parse the arguments from the user
+    """
+    parser = argparse.ArgumentParser(
+        description= "KneadData Benchmarks\n",
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="benchmarks")
+    parser.add_argument(
+        "--benchmark",
+        choices=sorted(benchmarks.keys()),
+        action="append",
+        help="the benchmark to run (additional arguments add benchmarks)\n[ DEFAULT : all ]")
+    parser.add_argument(
+        "--reads",
+        type=int,
+        default=10000000,
+        help="the number of synthetic reads\n[ DEFAULT : 10000000 ]")
+    parser.add_argument(
+        "--temp",
+        help="the folder to write the synthetic files\n[ DEFAULT : $TMPDIR ]")
+
+    return parser.parse_args()
+
+def main():
+    # Parse arguments from command line
+    args=parse_arguments(sys.argv)
+
+    for name in args.benchmark or sorted(benchmarks.keys()):
+        print("Running benchmark: "+name+" ( "+str(args.reads)+" reads )")
+        temp_folder=tempfile.mkdtemp(prefix="kneaddata_benchmark_",dir=args.temp)
+        try:
+            benchmarks[name](args.reads, temp_folder)
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,7 @@ THE SOFTWARE.
 import sys
 import os
 import argparse
+import shutil
 import tempfile
 import subprocess
 
@@ -52,7 +53,8 @@ def parse_arguments(args):
 
     parser.add_argument(
         "--input",
-        help="the fasta file of reads",
+        nargs="+",
+        help="the fasta file of reads (or multiple fasta files of reads already split for the processes)",
         required=True)
     parser.add_argument(
         "--output",
@@ -71,15 +73,25 @@ def parse_arguments(args):
         default=1,
         type=int,
         help="total number of processes to use")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="split the input into chunks of this many reads, which are run by the processes\n"+\
+             "as each chunk finishes (default is to split into one chunk per process)")
 
     return parser.parse_args()
 
 
-def run_trf(input, trf_path, trf_options, nproc, output, verbose=True):
+def run_trf(input, trf_path, trf_options, nproc, output, verbose=True, chunk_size=None):
     """Run TRF with the options provided, optionally in parallel.
 
-    When nproc > 1:
-      - The input FASTA is split into nproc chunks (2 lines per read).
+    When multiple input files are provided:
+      - The inputs are chunks already split from the reads.
+      - TRF is run on each chunk in parallel.
+      - The resulting .dat files are merged in order into the final output.
+
+    When nproc > 1 (or a chunk size is set) and a single input file is provided:
+      - The input FASTA is split into nproc chunks (or chunks of chunk size reads, 2 lines per read).
       - Each chunk is written to a short-named temp file.
       - TRF is run on each temp file in parallel.
       - The resulting .dat files are merged into the final output.
@@ -89,106 +101,103 @@ def run_trf(input, trf_path, trf_options, nproc, output, verbose=True):
       - Allows overriding the temp directory via KNEADDATA_TRF_TMP.
     """
 
-    tempfile_list = []
-    tempfile_written_list = []
-    datfile_list = []
-    datfile_to_write_list = []
-    commands = []
+    if not isinstance(input, list):
+        input = [input]
 
     # Choose a directory for TRF temp files.
     # Allow override via env var to keep paths short (recommended).
-    tmp_dir = os.environ.get("KNEADDATA_TRF_TMP")
-    if tmp_dir:
-        try:
-            os.makedirs(tmp_dir, exist_ok=True)
-        except OSError:
-            # If mkdir fails, fall back to output dir
-            tmp_dir = os.path.dirname(output) or "."
-    else:
-        tmp_dir = os.path.dirname(output) or "."
-
-    # Helper: numeric options part for TRF .dat naming
-    # Original code used:
-    #   new_file + ".".join(trf_options.split("-")[0].split(" ")) + "dat"
-    # which corresponds to <input>.<numeric_opts>.dat
-    numeric_opts_raw = trf_options.split("-")[0].split()
-    numeric_opts = ".".join(numeric_opts_raw) if numeric_opts_raw else ""
-    if numeric_opts:
-        numeric_opts = "." + numeric_opts  # leading dot, e.g. ".2.7.7.80.10.50.500"
+    tmp_dir = utilities.get_trf_temp_folder(os.path.dirname(output))
 
     # Single-process mode: just run TRF directly
-    if nproc == 1:
+    if nproc == 1 and len(input) == 1 and not chunk_size:
         # NOTE: If input path itself is extremely long and TRF still chokes,
         # you may want to symlink input to a short path before invoking this.
-        commands.append([
-            [trf_path, input] + trf_options.split(" "),
+        commands = [[
+            [trf_path, input[0]] + trf_options.split(" "),
             "trf",
-            [input],
+            [input[0]],
             [output],
             output
-        ])
+        ]]
 
         utilities.start_processes(commands, nproc, verbose)
         return
 
-    # Multi-process mode
+    # Split the input into multiple files, if not already split
+    if len(input) == 1:
+        chunk_list = split_fasta(input[0], nproc, tmp_dir, chunk_size)
+    else:
+        chunk_list = input
+
+    run_trf_chunks(chunk_list, trf_path, trf_options, nproc, output, tmp_dir, verbose)
+
+    # Remove temp files split from the input
+    if len(input) == 1:
+        for filename in chunk_list:
+            try:
+                os.remove(filename)
+            except EnvironmentError:
+                print("Unable to remove temp file: " + filename)
+
+
+def split_fasta(input, nproc, tmp_dir, chunk_size=None):
+    """ Split the fasta file into at most nproc temp files of equal line counts (2 lines per read)
+    or into temp files of chunk size reads """
+
     # Count total lines in input
-    total_lines = 0
-    with open(input) as file_handle:
-        for line in file_handle:
-            total_lines += 1
-
-    # Split the input into multiple files and run in parallel
-    for i in range(int(nproc)):
-        # Use a short, stable prefix instead of the full output basename
-        fd, new_file = tempfile.mkstemp(
-            prefix="kd_trf_{:03d}_".format(i),
-            suffix=".fa",
-            dir=tmp_dir
-        )
-        os.close(fd)
-
-        tempfile_list.append(new_file)
-        # Expected TRF .dat output for this temp input
-        datfile_name = new_file + numeric_opts + ".dat"
-        datfile_list.append(datfile_name)
-
-    # Write the input file into all temp output files (FASTA: 2 lines per read)
-    output_file_number = 0
-    lines_per_file = int(total_lines / int(nproc)) if nproc > 0 else total_lines
+    lines_per_file = chunk_size*2 if chunk_size else -(-utilities.count_lines_in_file(input) // (2*int(nproc)))*2
+
+    # Write the input file into the temp output files (FASTA: 2 lines per read)
+    tempfile_written_list = []
     lines_written = 0
     file_handle_write = None
 
     for read_line in utilities.read_file_n_lines(input, 2):
-        if not file_handle_write:
-            file_handle_write = open(tempfile_list[output_file_number], "wt")
-            tempfile_written_list.append(tempfile_list[output_file_number])
-            datfile_to_write_list.append(datfile_list[output_file_number])
+        if not file_handle_write or lines_written >= lines_per_file:
+            if file_handle_write:
+                file_handle_write.close()
+            # Use a short, stable prefix instead of the full output basename
+            fd, new_file = tempfile.mkstemp(
+                prefix="kd_trf_{:03d}_".format(len(tempfile_written_list)),
+                suffix=".fa",
+                dir=tmp_dir
+            )
+            file_handle_write = os.fdopen(fd, "wt")
+            tempfile_written_list.append(new_file)
+            lines_written = 0
 
         file_handle_write.write("".join(read_line))
-
         lines_written += 2
-        # Only roll over to a new file if we haven't reached the last one
-        if (lines_written > lines_per_file and
-                output_file_number < (len(tempfile_list) - 1)):
-            file_handle_write.close()
-            lines_written = 0
-            output_file_number += 1
-            file_handle_write = None
 
     if file_handle_write is not None:
         file_handle_write.close()
 
-    # Run TRF on each temporary chunk
-    for i, temp_in, temp_out in zip(
-        range(len(tempfile_written_list)),
-        tempfile_written_list,
-        datfile_to_write_list,
-    ):
+    return tempfile_written_list
+
+
+def run_trf_chunks(chunk_list, trf_path, trf_options, nproc, output, tmp_dir, verbose=True):
+    """ Run TRF on each of the chunks in parallel, merging the .dat outputs in the order of the chunks """
+
+    # Helper: numeric options part for TRF .dat naming
+    # Original code used:
+    #   new_file + ".".join(trf_options.split("-")[0].split(" ")) + "dat"
+    # which corresponds to <input>.<numeric_opts>.dat
+    numeric_opts_raw = trf_options.split("-")[0].split()
+    numeric_opts = ".".join(numeric_opts_raw) if numeric_opts_raw else ""
+    if numeric_opts:
+        numeric_opts = "." + numeric_opts  # leading dot, e.g. ".2.7.7.80.10.50.500"
+
+    # Run TRF on each chunk, writing the .dat output to the temp folder
+    # (the chunks are run as the processes finish, with the time for each chunk logged)
+    commands = []
+    datfile_list = []
+    for i, temp_in in enumerate(chunk_list):
+        temp_out = os.path.join(tmp_dir, os.path.basename(temp_in) + numeric_opts + ".dat")
+        datfile_list.append(temp_out)
         trf_command = [trf_path, temp_in] + trf_options.split(" ")
         commands.append([
             trf_command,
-            "trf{}".format(i),
+            "trf chunk {} of {}".format(i+1, len(chunk_list)),
             [temp_in],
             [temp_out],
             temp_out
@@ -197,14 +206,13 @@ def run_trf(input, trf_path, trf_options, nproc, output, verbose=True):
     utilities.start_processes(commands, nproc, verbose)
 
     # Merge all of the outputs to the final output file
-    with open(output, "w") as file_write:
-        for datfile in datfile_to_write_list:
-            with open(datfile) as file_read:
-                for line in file_read:
-                    file_write.write(line)
+    with open(output, "wb") as file_write:
+        for datfile in datfile_list:
+            with open(datfile, "rb") as file_read:
+                shutil.copyfileobj(file_read, file_write)
 
     # Remove temp files
-    for filename in tempfile_list + datfile_to_write_list:
+    for filename in datfile_list:
         try:
             os.remove(filename)
         except EnvironmentError:
@@ -224,7 +232,7 @@ def main():
             args.trf_path += "/"
         args.trf_path += "trf"
 
-    run_trf(args.input, args.trf_path, args.trf_options, args.nproc, args.output)
+    run_trf(args.input, args.trf_path, args.trf_options, args.nproc, args.output, chunk_size=args.chunk_size)
 
 
 if __name__ == "__main__":
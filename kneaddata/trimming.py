@@ -0,0 +1,475 @@
+"""
+KneadData: trimming module
+
+Copyright (c) 2015 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import math
+import time
+import logging
+import collections
+import multiprocessing
+
+from kneaddata import utilities
+from kneaddata import config
+
+# name global logging instance
+logger=logging.getLogger(__name__)
+
+# The native engine runs the Trimmomatic steps in the default options (ILLUMINACLIP,
+# SLIDINGWINDOW, and MINLEN) on batches of reads with numpy. All of these steps only
+# trim from the end of the reads so the state of each read is the length to keep,
+# which is zero once the read has been dropped.
+
+# alignments score log10(4) for each match and minus the quality/10 for each mismatch
+# and clipping requires a seed of this many bases with at most the seed mismatches
+log10_4=math.log10(4)
+seed_length=16
+prefix_quality=100
+
+# the steps and quality offset for the worker processes
+worker_steps=None
+worker_quality_offset=None
+
+def get_base_codes(sequence):
+    """ Get the array of base codes for the sequence, with N (and padding) as 4 """
+
+    import numpy
+
+    lookup=numpy.full(256, 4, dtype=numpy.int8)
+    for code, base in enumerate(b"ACGT"):
+        lookup[base]=code
+        lookup[base+32]=code
+
+    return lookup[numpy.frombuffer(sequence, dtype=numpy.uint8)]
+
+def read_adapters(file):
+    """ Read the adapter sequences from the fasta file. Return the prefix pairs for
+    palindrome clipping, and the sequences to clip from the forward and reverse reads
+    (in Trimmomatic, names ending in /1 or /2 are only clipped from that read and pairs
+    of names starting with Prefix are used for palindrome clipping). """
+
+    sequences=collections.OrderedDict()
+    name=None
+    try:
+        with open(file) as file_handle:
+            for line in file_handle:
+                line=line.strip()
+                if line.startswith(">"):
+                    name=line[1:].split(" ")[0]
+                    sequences[name]=""
+                elif name is not None:
+                    sequences[name]+=line.upper()
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to read adapter file: " + file)
+
+    forward=collections.OrderedDict()
+    reverse=collections.OrderedDict()
+    common=[]
+    for name, sequence in sequences.items():
+        if name.endswith("/1"):
+            forward[name]=sequence
+        elif name.endswith("/2"):
+            reverse[name]=sequence
+        else:
+            common.append(sequence)
+
+    prefix_pairs=[]
+    for name in list(forward.keys()):
+        reverse_name=name[:-2]+"/2"
+        if name.startswith("Prefix") and reverse_name in reverse:
+            prefix_pairs.append((forward.pop(name).encode(), reverse.pop(reverse_name).encode()))
+
+    return (prefix_pairs, [sequence.encode() for sequence in list(forward.values())+common],
+        [sequence.encode() for sequence in list(reverse.values())+common])
+
+def get_trim_steps(options):
+    """ Get the steps to run from the Trimmomatic options, exiting if an option is not supported """
+
+    steps=[]
+    for option in options:
+        name, delimiter, values = option.partition(config.trimmomatic_option_delimiter)
+        values=values.split(config.trimmomatic_option_delimiter)
+        try:
+            if name == "ILLUMINACLIP":
+                prefix_pairs, forward_adapters, reverse_adapters = read_adapters(values[0])
+                min_adapter_length=int(values[4]) if len(values) > 4 else 8
+                keep_both_reads=len(values) > 5 and values[5].lower() == "true"
+                steps.append((name, [prefix_pairs, forward_adapters, reverse_adapters, int(values[1]),
+                    float(values[2]), float(values[3]), min_adapter_length, keep_both_reads]))
+            elif name == "SLIDINGWINDOW":
+                steps.append((name, [int(values[0]), float(values[1])]))
+            elif name == "MINLEN":
+                steps.append((name, [int(values[0])]))
+            else:
+                sys.exit("ERROR: The native trim engine does not support the Trimmomatic option: " + option)
+        except (IndexError, ValueError):
+            sys.exit("ERROR: Unable to read the Trimmomatic option: " + option)
+
+    return steps
+
+def get_batch_arrays(records, quality_offset):
+    """ Get the arrays of base codes, qualities, and lengths for the fastq records """
+
+    import numpy
+
+    lengths=numpy.array([len(record[1]) for record in records], dtype=numpy.int64)
+    width=max(int(lengths.max()) if len(records) else 0, 1)
+    in_read=numpy.arange(width) < lengths[:,None]
+
+    codes=numpy.full((len(records), width), 4, dtype=numpy.int8)
+    codes[in_read]=get_base_codes(b"".join([record[1] for record in records]))
+    qualities=numpy.zeros((len(records), width), dtype=numpy.int32)
+    qualities[in_read]=numpy.frombuffer(b"".join([record[3] for record in records]),
+        dtype=numpy.uint8).astype(numpy.int32)-quality_offset
+
+    return codes, qualities, lengths
+
+def mask_after_lengths(codes, lengths):
+    """ Set the bases after the length to keep to N so they are not aligned """
+
+    import numpy
+
+    return numpy.where(numpy.arange(codes.shape[1]) < lengths[:,None], codes, numpy.int8(4))
+
+def best_segment_scores(scores):
+    """ Return the score of the best segment along the last axis """
+
+    import numpy
+
+    cumulative_scores=numpy.cumsum(scores, axis=-1)
+    min_prefix=numpy.zeros_like(cumulative_scores)
+    numpy.minimum(numpy.minimum.accumulate(cumulative_scores, axis=-1)[...,:-1], 0, out=min_prefix[...,1:])
+    return (cumulative_scores-min_prefix).max(axis=-1)
+
+def clip_adapter(codes, qualities, lengths, adapter, seed_mismatches, threshold):
+    """ Return the length to keep for each read after clipping the adapter at the first offset
+    where a seed aligns with at most the seed mismatches and the best segment of the alignment
+    scores at least the threshold (the Trimmomatic simple clipping) """
+
+    import numpy
+
+    adapter_codes=get_base_codes(adapter)
+    size=len(adapter_codes)
+    # the alignment must overlap the read by more than the bases to score the threshold
+    min_overlap=int(threshold/log10_4)
+    if size <= min_overlap or size < seed_length:
+        return lengths
+
+    # pad the reads so the adapter can start before the read, comparing each base
+    # of the adapter to the reads for all offsets at once
+    reads, width=codes.shape
+    pad=size-min_overlap-1
+    padded_codes=numpy.full((reads, pad+width+size), 4, dtype=numpy.int8)
+    padded_codes[:,pad:pad+width]=codes
+    total_offsets=pad+width-min_overlap
+    offsets=numpy.arange(total_offsets)-pad
+    matches=numpy.zeros((reads, total_offsets), dtype=numpy.int8 if size < 128 else numpy.int16)
+    for index, base in enumerate(adapter_codes):
+        if base < 4:
+            matches+=padded_codes[:,index:index+total_offsets] == base
+
+    # only align the offsets with enough matches to score the threshold
+    candidate_reads, columns=numpy.nonzero(matches >= math.ceil(threshold/log10_4))
+    if not len(candidate_reads):
+        return lengths
+    positions=columns[:,None]+numpy.arange(size)
+    read_codes=padded_codes[candidate_reads[:,None], positions]
+    read_qualities=qualities[candidate_reads[:,None], numpy.clip(positions-pad, 0, width-1)]/numpy.float32(10)
+    read_lengths=lengths[candidate_reads]
+    offsets=offsets[columns]
+
+    aligned=read_codes == adapter_codes
+    mismatches=(read_codes < 4) & (adapter_codes < 4) & ~aligned
+    scores=numpy.where(aligned, numpy.float32(log10_4), numpy.where(mismatches, -read_qualities, numpy.float32(0)))
+
+    # seeds start at each position of the adapter with a full seed, and in the read
+    # (the seeds at the end of the read only include the bases in the read)
+    cumulative_mismatches=numpy.zeros((len(candidate_reads), size+1), dtype=numpy.int16)
+    numpy.cumsum(mismatches, axis=1, out=cumulative_mismatches[:,1:])
+    seed_read_start=offsets[:,None]+numpy.arange(size-seed_length+1)
+    seeds=((cumulative_mismatches[:,seed_length:]-cumulative_mismatches[:,:-seed_length]) <= seed_mismatches) & \
+        (seed_read_start >= 0) & (seed_read_start < read_lengths[:,None])
+
+    # the overlap of the adapter and the read for each offset
+    overlap=numpy.minimum(size, read_lengths-offsets)-numpy.maximum(0, -offsets)
+
+    # clip each read at the first offset
+    clipped=seeds.any(axis=1) & (overlap > min_overlap) & (best_segment_scores(scores) >= threshold)
+    keep=lengths.copy()
+    numpy.minimum.at(keep, candidate_reads[clipped], numpy.maximum(offsets[clipped], 0))
+    return keep
+
+def clip_palindrome(codes1, qualities1, lengths1, codes2, qualities2, lengths2, prefix_pair,
+    threshold, min_adapter_length, max_chunk=32):
+    """ Return the length to keep for the pairs of reads where the reads read through the
+    fragment into the adapters (the Trimmomatic palindrome clipping). The reads with the
+    adapters prefixed are aligned in reverse complement for each fragment length, with
+    the total score of the alignment at least the threshold. """
+
+    import numpy
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    reads=codes1.shape[0]
+    prefix1, prefix2=[get_base_codes(prefix) for prefix in prefix_pair]
+    sequence1=numpy.concatenate([numpy.broadcast_to(prefix1, (reads, len(prefix1))), codes1], axis=1)
+    sequence2=numpy.concatenate([numpy.broadcast_to(prefix2, (reads, len(prefix2))), codes2], axis=1)
+    quality1=numpy.concatenate([numpy.full((reads, len(prefix1)), prefix_quality), qualities1], axis=1)
+    quality2=numpy.concatenate([numpy.full((reads, len(prefix2)), prefix_quality), qualities2], axis=1)
+
+    # the fragment lengths with at least the min adapter length in the longer read
+    min_fragment=max(0, seed_length-len(prefix1))
+    max_fragment=numpy.maximum(lengths1, lengths2)-min_adapter_length
+    overlaps=numpy.arange(min_fragment, int(max_fragment.max())+1)+len(prefix1)+len(prefix2)
+    if not len(overlaps):
+        return lengths1, lengths2, numpy.zeros(reads, dtype=bool)
+
+    # the overlap aligns sequence1[i] to the complement of sequence2[overlap-1-i] so pad the
+    # reversed complement of sequence2 to have a window at the start of each alignment (with
+    # N and padding as 5 in sequence2 so only bases in both sequences in the overlap match)
+    max_overlap=int(overlaps[-1])
+    length2=sequence2.shape[1]
+    reverse_complement2=numpy.where(sequence2 < 4, 3-sequence2, numpy.int8(5))[:,::-1]
+    pad=max(0, max_overlap-length2)
+    padded_codes2=numpy.full((reads, pad+length2+max_overlap), 5, dtype=numpy.int8)
+    padded_codes2[:,pad:pad+length2]=reverse_complement2
+    padded_quality2=numpy.full(padded_codes2.shape, prefix_quality)
+    padded_quality2[:,pad:pad+length2]=quality2[:,::-1]
+    padded_codes1=numpy.full((reads, max_overlap), 4, dtype=numpy.int8)
+    padded_codes1[:,:min(max_overlap, sequence1.shape[1])]=sequence1[:,:max_overlap]
+    padded_quality1=numpy.full((reads, max_overlap), prefix_quality)
+    padded_quality1[:,:min(max_overlap, sequence1.shape[1])]=quality1[:,:max_overlap]
+
+    # count the matches for each overlap, with the windows for the overlaps in reverse order
+    windows2=sliding_window_view(padded_codes2, max_overlap, axis=1)
+    window_end=pad+length2-overlaps[0]+1
+    matches=numpy.zeros((reads, len(overlaps)), dtype=numpy.int16)
+    for start in range(0, len(overlaps), max_chunk):
+        chunk_windows=windows2[:,window_end-start-min(max_chunk, len(overlaps)-start):window_end-start][:,::-1]
+        matches[:,start:start+max_chunk]=(chunk_windows == padded_codes1[:,None,:]).sum(axis=2)
+
+    # only score the overlaps with enough matches to score the threshold
+    fragments=overlaps-len(prefix1)-len(prefix2)
+    candidate_reads, columns=numpy.nonzero((matches*log10_4 >= threshold) & (fragments <= max_fragment[:,None]))
+    if not len(candidate_reads):
+        return lengths1, lengths2, numpy.zeros(reads, dtype=bool)
+    positions=(pad+length2-overlaps[columns])[:,None]+numpy.arange(max_overlap)
+    aligned_codes2=padded_codes2[candidate_reads[:,None], positions]
+    aligned_codes1=padded_codes1[candidate_reads]
+    mismatches=(aligned_codes2 != aligned_codes1) & (aligned_codes2 < 4) & (aligned_codes1 < 4)
+    penalty=numpy.minimum(padded_quality1[candidate_reads], padded_quality2[candidate_reads[:,None], positions])/10.0
+    scores=matches[candidate_reads, columns]*log10_4-numpy.where(mismatches, penalty, 0).sum(axis=1)
+
+    # clip each pair at the first fragment length
+    found=scores >= threshold
+    fragment=numpy.full(reads, numpy.iinfo(numpy.int64).max)
+    numpy.minimum.at(fragment, candidate_reads[found], fragments[columns[found]])
+    clipped=fragment < numpy.iinfo(numpy.int64).max
+
+    return numpy.where(clipped, numpy.minimum(lengths1, fragment), lengths1), \
+        numpy.where(clipped, numpy.minimum(lengths2, fragment), lengths2), clipped
+
+def sliding_window(qualities, lengths, window_size, required_quality):
+    """ Return the length to keep for each read, cutting when the average quality of the
+    window falls below the required quality and then trimming bases below the required quality
+    from the end (the Trimmomatic sliding window) """
+
+    import numpy
+
+    reads, width=qualities.shape
+    if width < window_size:
+        return numpy.zeros(reads, dtype=numpy.int64)
+
+    positions=numpy.arange(width)
+    # windows past the end of the read are not checked
+    window_qualities=numpy.where(positions < lengths[:,None], qualities, 1000)
+    cumulative_qualities=numpy.zeros((reads, width+1), dtype=numpy.int64)
+    numpy.cumsum(window_qualities, axis=1, out=cumulative_qualities[:,1:])
+    failed=(cumulative_qualities[:,window_size:]-cumulative_qualities[:,:-window_size]) < window_size*required_quality
+
+    first_failed=numpy.argmax(failed, axis=1)
+    keep=numpy.where(failed.any(axis=1), first_failed+window_size-1, lengths)
+    keep=numpy.where((first_failed == 0) & failed[:,0], 0, keep)
+
+    # trim back to the last base with at least the required quality
+    good=(qualities >= required_quality) & (positions < keep[:,None])
+    last_good=width-numpy.argmax(good[:,::-1], axis=1)
+    keep=numpy.where(good.any(axis=1), last_good, 0)
+
+    return numpy.where(lengths < window_size, 0, keep)
+
+def run_trim_steps(steps, batches):
+    """ Run the steps on the arrays for the reads (or the pairs of reads), returning the lengths to keep """
+
+    import numpy
+
+    lengths=[batch[2].copy() for batch in batches]
+    for name, values in steps:
+        if name == "ILLUMINACLIP":
+            prefix_pairs, forward_adapters, reverse_adapters, seed_mismatches, palindrome_threshold, \
+                simple_threshold, min_adapter_length, keep_both_reads = values
+            codes=[mask_after_lengths(batch[0], length) for batch, length in zip(batches, lengths)]
+            clipped_lengths=[length.copy() for length in lengths]
+            if len(batches) == 2:
+                # only check pairs where both reads remain
+                both=(lengths[0] > 0) & (lengths[1] > 0)
+                for prefix_pair in prefix_pairs:
+                    keep1, keep2, clipped=clip_palindrome(codes[0], batches[0][1], lengths[0], codes[1], batches[1][1],
+                        lengths[1], prefix_pair, palindrome_threshold, min_adapter_length)
+                    clipped&=both
+                    clipped_lengths[0]=numpy.where(clipped, numpy.minimum(clipped_lengths[0], keep1), clipped_lengths[0])
+                    clipped_lengths[1]=numpy.where(clipped, numpy.minimum(clipped_lengths[1], keep2) if keep_both_reads else 0,
+                        clipped_lengths[1])
+            for index, adapters in enumerate([forward_adapters, reverse_adapters][:len(batches)]):
+                for adapter in adapters:
+                    clipped_lengths[index]=numpy.minimum(clipped_lengths[index], clip_adapter(codes[index],
+                        batches[index][1], lengths[index], adapter, seed_mismatches, simple_threshold))
+            lengths=clipped_lengths
+        elif name == "SLIDINGWINDOW":
+            window_size, required_quality = values
+            lengths=[numpy.minimum(length, sliding_window(numpy.where(batch[0] < 4, batch[1], 0), length, window_size,
+                required_quality)) for batch, length in zip(batches, lengths)]
+        elif name == "MINLEN":
+            lengths=[numpy.where(length >= values[0], length, 0) for length in lengths]
+
+    return lengths
+
+def format_trimmed_record(record, length):
+    """ Format the fastq record trimmed to the length """
+
+    return b"\n".join([record[0], record[1][:length], record[2], record[3][:length]])+b"\n"
+
+def set_worker_options(steps, quality_offset):
+    """ Set the steps and quality offset for the worker """
+
+    global worker_steps, worker_quality_offset
+    worker_steps=steps
+    worker_quality_offset=quality_offset
+
+def trim_batch(records):
+    """ Trim the batch of records (a list of records for each input file), returning the output
+    for each file (the reads for single end or the pair1, orphan1, pair2, orphan2 files) """
+
+    batches=[get_batch_arrays(read_records, worker_quality_offset) for read_records in records]
+    lengths=run_trim_steps(worker_steps, batches)
+
+    if len(records) == 1:
+        return [b"".join([format_trimmed_record(record, length) for record, length in zip(records[0], lengths[0]) if length > 0])]
+
+    output=[[], [], [], []]
+    for record1, record2, length1, length2 in zip(records[0], records[1], lengths[0], lengths[1]):
+        if length1 > 0 and length2 > 0:
+            output[0].append(format_trimmed_record(record1, length1))
+            output[2].append(format_trimmed_record(record2, length2))
+        elif length1 > 0:
+            output[1].append(format_trimmed_record(record1, length1))
+        elif length2 > 0:
+            output[3].append(format_trimmed_record(record2, length2))
+    return [b"".join(file_output) for file_output in output]
+
+def read_batches(infiles, batch_size):
+    """ Yield batches of the records from the files, as one list of records for each file
+    (pairing the reads by position until the end of the shorter file, as in Trimmomatic) """
+
+    readers=[utilities.read_fastq_records(file) for file in infiles]
+    batch=[[] for file in infiles]
+    for records in utilities.zip_longest(*readers):
+        if None in records:
+            logger.warning("The input files do not have the same number of reads so the reads after " +
+                "the end of the shorter file are not trimmed: " + " ".join(infiles))
+            break
+        for read_batch, record in zip(batch, records):
+            read_batch.append(record)
+        if len(batch[0]) == batch_size:
+            yield batch
+            batch=[[] for file in infiles]
+    if batch[0]:
+        yield batch
+
+def start_trim_pool(steps, quality_offset, threads):
+    """ Start the processes to trim the batches, or return None to trim in this process """
+
+    if threads < 2:
+        return None
+
+    return multiprocessing.Pool(threads, initializer=set_worker_options, initargs=(steps, quality_offset))
+
+def trim_batches(infiles, steps, quality_offset, threads, pool=None):
+    """ Yield the output of trimming each batch of reads, in the input order, with the
+    pool provided (so it can be started before any threads) or a new pool for the threads """
+
+    batches=read_batches(infiles, config.native_trim_batch_size)
+    if pool is None:
+        pool=start_trim_pool(steps, quality_offset, threads)
+    if pool is not None:
+        # trim the batches in processes, limiting the batches waiting to be written to bound memory
+        try:
+            pending=collections.deque()
+            for batch in batches:
+                pending.append(pool.apply_async(trim_batch, (batch,)))
+                while len(pending) > threads*2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            # stop the workers even if the output is not all read (on an error or if the generator is closed)
+            pool.terminate()
+            pool.join()
+    else:
+        set_worker_options(steps, quality_offset)
+        for batch in batches:
+            yield trim_batch(batch)
+
+def trim(infiles, outfiles, options, quality_scores, threads, verbose):
+    """ Trim the reads with the native engine, writing the output files in the same order as
+    Trimmomatic (the reads for single end or the pair1, orphan1, pair2, orphan2 files) """
+
+    try:
+        import numpy
+    except ImportError:
+        sys.exit("ERROR: The native trim engine requires numpy. Please install numpy.")
+
+    start_time=time.time()
+    steps=get_trim_steps(options)
+    quality_offset=64 if "64" in quality_scores else 33
+
+    file_handles=[]
+    for file in outfiles:
+        try:
+            file_handles.append(open(file, "wb"))
+        except EnvironmentError:
+            sys.exit("ERROR: Unable to open file: " + file)
+
+    total_reads=[0]*len(outfiles)
+    for output in trim_batches(infiles, steps, quality_offset, threads):
+        for index, file_output in enumerate(output):
+            file_handles[index].write(file_output)
+            total_reads[index]+=file_output.count(b"\n")//4
+
+    for file, file_handle, reads in zip(outfiles, file_handles, total_reads):
+        file_handle.close()
+        utilities.record_read_count(file, reads)
+
+    message="Total time for native trim engine : {0:.2f} seconds wall time".format(time.time()-start_time)
+    logger.info(message)
+    if verbose:
+        print(message)
@@ -24,6 +24,9 @@ THE SOFTWARE.
 
 import os
 import fnmatch
+import array
+import bisect
+import heapq
 import sys
 import shlex
 import logging
@@ -37,13 +40,37 @@ import multiprocessing
 import datetime
 import errno
 import shutil
+import time
 from zipfile import ZipFile
 
+try:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except ImportError:
+    # allow for python2 without the futures backport, which runs the commands with a process pool
+    ThreadPoolExecutor=None
+
+try:
+    from itertools import zip_longest
+except ImportError:
+    # allow for python2 in which the function is named izip_longest
+    from itertools import izip_longest as zip_longest
+
 from kneaddata import config
+from kneaddata import bgzf
+from kneaddata import bam
 
 # name global logging instance
 logger=logging.getLogger(__name__)
 
+# the read counts recorded for files written, stored with the file size and modification time
+read_counts={}
+
+# the array type for the read id hashes (python2 does not have "q", and its hashes are C longs)
+try:
+    hash_typecode=array.array("q").typecode
+except ValueError:
+    hash_typecode="l"
+
 def get_read_id_minus_pair(sequence_id_line):
     return sequence_id_line.rstrip()[:-1]
 
@@ -60,48 +87,226 @@ def update_temp_output_files(temp_output_files, new_file_list, all_input_files):
 
     temp_output_files+=new_file_list
 
-def check_and_reorder_reads(input_files, output_folder, temp_output_files):
-    """ Check if reads are ordered and if not reorder """
+def write_sorted_run(records, output_folder):
+    """ Sort the records by read id and write to a temp run file """
+    
+    records.sort(key=lambda record: record[0])
+    file_out, run_file=tempfile.mkstemp(prefix="reorder_run_", dir=output_folder)
+    with os.fdopen(file_out,"wb") as file_handle:
+        for id, record in records:
+            file_handle.write(format_fastq_record(record))
+    
+    return run_file
 
-    # read in the ids from the first pair (only check the first 100)
-    ids = []
-    for count, lines in zip(range(100),read_file_n_lines(input_files[0],4)):
-        ids.append(get_read_id_minus_pair(lines[0]))
+def read_sorted_run(run_file, run_index):
+    """ Read the records from the sorted run, with the read id, run index, and position in the run
+    for each (so records with the same id are merged in the input order without comparing the records) """
+    
+    for position, record in enumerate(read_fastq_records(run_file)):
+        yield get_read_id_minus_pair(record[0]), run_index, position, record
 
-    mismatch=False
-    for lines, pair_id in zip(read_file_n_lines(input_files[1],4), ids):
-        if not get_read_id_minus_pair(lines[0]) == pair_id:
-            mismatch=True
-            break
+def sort_fastq_file(infile, outfile, output_folder, max_records=config.reorder_max_records_in_memory):
+    """ Sort the fastq file by read id with an external merge sort, writing sorted runs of at most 
+    max records to temp files and then merging the runs, keeping the last record for duplicate ids """
+    
+    run_files=[]
+    records=[]
+    try:
+        for record in read_fastq_records(infile):
+            records.append((get_read_id_minus_pair(record[0]), record))
+            if len(records) >= max_records:
+                run_files.append(write_sorted_run(records, output_folder))
+                records=[]
+        
+        # sort the remaining records in memory, merging with the runs if the file did not fit in memory
+        records.sort(key=lambda record: record[0])
+        # merge the records decorated with the run and position (python2 merge does not have a key)
+        sorted_records=heapq.merge(*[read_sorted_run(run_file, run_index) for run_index, run_file in enumerate(run_files)]+
+            [((id, len(run_files), position, record) for position, (id, record) in enumerate(records))])
+        
+        total_reads=0
+        with open(outfile,"wb") as file_handle:
+            # the runs are in input order, so the last record for an id is the last one in the input file
+            for id, group in itertools.groupby(sorted_records, key=lambda record: record[0]):
+                for id, run_index, position, record in group:
+                    pass
+                file_handle.write(format_fastq_record(record))
+                total_reads+=1
+    finally:
+        for run_file in run_files:
+            remove_file(run_file)
+            
+    return total_reads
+
+def sort_fastq_file_star(args):
+    """ Sort the fastq file with the arguments in a list (for a process pool) """
+    
+    return sort_fastq_file(*args)
+
+class PairOrderChecker(object):
+    """ Check the order of the pairs as the read ids are streamed, tracking the hashes of the
+    reads waiting for a mate (up to the window) to find how far the pairs are out of order """
+    
+    def __init__(self, window=config.pair_order_resync_window):
+        self.window=window
+        self.total_reads=[0,0]
+        self.first_divergence=None
+        self.max_pending=0
+        self.window_exceeded=False
+        self.pending=[set(),set()]
+        
+    def add(self, pair1_id, pair2_id):
+        """ Add the read ids at the next position in each file (None if the file has ended) """
+        
+        for index, id in enumerate([pair1_id, pair2_id]):
+            if id is not None:
+                self.total_reads[index]+=1
+        
+        # the reads are mates so the reads pending do not change
+        if pair1_id == pair2_id:
+            return
+            
+        if self.first_divergence is None:
+            self.first_divergence=max(self.total_reads)
+        
+        if self.window_exceeded:
+            return
+            
+        for index, id in enumerate([pair1_id, pair2_id]):
+            if id is None:
+                continue
+            # remove the mate from the reads pending in the other file, or add this read as pending
+            id_hash=hash(id)
+            if id_hash in self.pending[1-index]:
+                self.pending[1-index].remove(id_hash)
+            else:
+                self.pending[index].add(id_hash)
+                
+        total_pending=len(self.pending[0])+len(self.pending[1])
+        if total_pending > self.max_pending:
+            self.max_pending=total_pending
+            # stop tracking if the reads are too far out of order to resync
+            if self.max_pending > self.window:
+                self.window_exceeded=True
+                self.pending=[set(),set()]
+        
+    def is_ordered(self):
+        """ Check if all of the pairs are in the same order """
+        
+        return self.first_divergence is None
+    
+    def can_resync(self):
+        """ Check if all reads have mates that are within the window """
+        
+        return (not self.window_exceeded and self.total_reads[0] == self.total_reads[1] and
+            not self.pending[0] and not self.pending[1])
+    
+def check_pair_order(input_files, window=config.pair_order_resync_window):
+    """ Walk through the read ids of both pair files checking the order of the pairs,
+    recording the read counts for the files """
+    
+    pair_order=PairOrderChecker(window)
+    for header1, header2 in zip_longest(read_fastq_records(input_files[0],header_only=True),
+        read_fastq_records(input_files[1],header_only=True)):
+        pair_order.add(get_read_id_minus_pair(header1) if header1 is not None else None,
+            get_read_id_minus_pair(header2) if header2 is not None else None)
+        
+    for file, total_reads in zip(input_files, pair_order.total_reads):
+        record_read_count(file, total_reads)
+    
+    return pair_order
+
+def resync_pair_file(pair1_file, pair2_file, outfile):
+    """ Write the pair2 reads in the order of the pair1 reads, holding the pair2 reads read ahead
+    of their mates (the number held is limited by the window used to check the order) """
+    
+    pair2_records=read_fastq_records(pair2_file)
+    read_ahead={}
+    total_reads=0
+    with open(outfile,"wb") as file_handle:
+        for header in read_fastq_records(pair1_file,header_only=True):
+            id=get_read_id_minus_pair(header)
+            record=read_ahead.pop(id,None)
+            while record is None:
+                next_record=next(pair2_records,None)
+                if next_record is None:
+                    # the mate was not found (from a hash collision in the check)
+                    return None
+                next_id=get_read_id_minus_pair(next_record[0])
+                if next_id == id:
+                    record=next_record
+                else:
+                    read_ahead[next_id]=next_record
+            file_handle.write(format_fastq_record(record))
+            total_reads+=1
+            
+    return total_reads
+
+def check_and_reorder_reads(input_files, output_folder, temp_output_files, processes=1, pair_order=None):
+    """ Check if reads are ordered and if not reorder. If all reads are near their mates, resync
+    the pair2 reads to the pair1 order, otherwise sort the pairs (in parallel if more than 
+    one process is available) """
+
+    # check the order of all of the reads, if not already checked
+    if pair_order is None:
+        pair_order=check_pair_order(input_files)
+
+    if pair_order.is_ordered():
+        return input_files
+    
+    message="Pairs are not ordered starting at read "+str(pair_order.first_divergence)+" with "+\
+        (str(pair_order.max_pending) if not pair_order.window_exceeded else "more than "+str(pair_order.window))+\
+        " reads waiting for mates"
+    logger.info(message)
 
     # reorder the pairs to match
     new_file_list = []
-    if mismatch:
-        message="Reordering read identifiers ..."
+    if pair_order.can_resync():
+        message="Resyncing read identifiers ..."
         print(message+"\n")
         logger.info(message)
+        
+        file_out, new_file=tempfile.mkstemp(prefix="reordered_",
+            suffix="_"+file_without_extension(input_files[1]), dir=output_folder)
+        os.close(file_out)
+        
+        total_reads=resync_pair_file(input_files[0], input_files[1], new_file)
+        if total_reads is not None:
+            record_read_count(new_file, total_reads)
+            input_files[1]=new_file
+            update_temp_output_files(temp_output_files, [new_file], input_files)
+            return input_files
+        
+        # if unable to resync, sort the pairs
+        remove_file(new_file)
+        
+    message="Reordering read identifiers ..."
+    print(message+"\n")
+    logger.info(message)
 
-        for index, infile in enumerate(input_files):
-            file_out, new_file=tempfile.mkstemp(prefix="reordered_",
-                suffix="_"+file_without_extension(infile), dir=output_folder)
-            os.close(file_out)
-
-            # read in all of the sequences then sort and write out
-            ids={}
-            for lines in read_file_n_lines(infile,4):
-                id=get_read_id_minus_pair(lines[0])
-                ids[id]=lines
-
-            with open(new_file,"w") as file_handle:
-                for id in sorted(ids.keys()):
-                    file_handle.write("".join(ids[id]))
+    for infile in input_files:
+        file_out, new_file=tempfile.mkstemp(prefix="reordered_",
+            suffix="_"+file_without_extension(infile), dir=output_folder)
+        os.close(file_out)
+        new_file_list.append(new_file)
+        
+    # sort each file with a bounded number of records in memory
+    sort_args=[[infile, new_file, output_folder] for infile, new_file in zip(input_files, new_file_list)]
+    if processes > 1:
+        pool=multiprocessing.Pool(min(processes,len(sort_args)))
+        total_reads=pool.map(sort_fastq_file_star, sort_args)
+        pool.close()
+        pool.join()
+    else:
+        total_reads=[sort_fastq_file_star(args) for args in sort_args]
 
-            # set the input file to the reordered temp file
-            input_files[index]=new_file
-            new_file_list.append(new_file)
+    for index, new_file in enumerate(new_file_list):
+        record_read_count(new_file, total_reads[index])
+        # set the input file to the reordered temp file
+        input_files[index]=new_file
 
-        # add the temp file to the list and remove extra that are not needed
-        update_temp_output_files(temp_output_files, new_file_list, input_files)
+    # add the temp file to the list and remove extra that are not needed
+    update_temp_output_files(temp_output_files, new_file_list, input_files)
 
     return input_files
 
@@ -141,17 +346,76 @@ def parse_positive_int(string):
         raise argparse.ArgumentTypeError("%s is not a positive integer" %string)
     return val
 
-def start_processes(commands,processes,verbose):
-    """ Run the processes with the commands provided """
+def get_available_cores():
+    """ Get the number of cores this process is allowed to run on """
+    
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return multiprocessing.cpu_count()
+    
+def get_available_memory():
+    """ Get the memory available (in bytes) from psutil if installed, otherwise from
+    /proc/meminfo (on linux) or the free pages reported by the system, or None if unknown """
+    
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except (ImportError, AttributeError, OSError):
+        pass
+    
+    # the available memory includes the page cache that can be reclaimed
+    try:
+        with open("/proc/meminfo") as file_handle:
+            for line in file_handle:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])*1024
+    except (EnvironmentError, ValueError, IndexError):
+        pass
+    
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def get_total_processes(total_commands,processes,threads=1,memory=None):
+    """ Get the number of commands to run at once so the threads used by all commands
+    and the memory required by all commands (if provided) fit on this machine """
+    
+    total_processes=min(processes,total_commands,max(1,get_available_cores() // max(1,threads)))
+    
+    available_memory=get_available_memory()
+    if memory and available_memory:
+        total_processes=min(total_processes,max(1,int(available_memory // memory)))
+        
+    return max(1,total_processes)
+
+def start_processes(commands,processes,verbose,threads=1,memory=None):
+    """ Run the processes with the commands provided, limiting the number of commands
+    run at once by the threads for each command and memory required (in bytes) for each command """
     
     # add verbose to command list
     commands = [i+[verbose] for i in commands]
     
-    # create a pool of workers
-    pool = multiprocessing.Pool(processes)
-    returncodes = pool.map(run_command_returncode,commands)
-    pool.close()
-    pool.join()
+    total_processes=get_total_processes(len(commands),processes,threads,memory)
+    if total_processes < min(processes,len(commands)):
+        message="Running "+str(total_processes)+" processes at once to fit the "+str(threads)+\
+            " threads for each process in the cores and memory available"
+        logger.info(message)
+        print(message)
+    
+    # run the commands with threads, as each command runs in its own subprocess,
+    # handling the results as each command finishes
+    returncodes=[]
+    if ThreadPoolExecutor:
+        with ThreadPoolExecutor(total_processes) as executor:
+            for future in as_completed([executor.submit(run_command_returncode,command) for command in commands]):
+                returncodes.append(future.result())
+    else:
+        pool = multiprocessing.Pool(total_processes)
+        returncodes = pool.map(run_command_returncode,commands)
+        pool.close()
+        pool.join()
     
     # exit if any subprocesses reported errors
     if sum(returncodes) > 0:
@@ -171,6 +435,22 @@ def run_command_returncode(args):
         
     return returncode
 
+def wait_for_process(process):
+    """ Wait for the process to finish, returning the return code and the cpu time used
+    by the process and its children (if available on this platform) """
+    
+    try:
+        pid, status, usage = os.wait4(process.pid, 0)
+    except (AttributeError, OSError):
+        return process.wait(), None
+    
+    if os.WIFSIGNALED(status):
+        process.returncode=-os.WTERMSIG(status)
+    else:
+        process.returncode=os.WEXITSTATUS(status)
+        
+    return process.returncode, usage.ru_utime+usage.ru_stime
+
 def run_command(command,command_name,infiles,outfiles,stdout_file,verbose,exit_on_error,shell=False):
     """ Run and log command """
     
@@ -201,15 +481,22 @@ def run_command(command,command_name,infiles,outfiles,stdout_file,verbose,exit_o
                 sys.exit("CRITICAL ERROR: " + message)
             else:
                 raise EnvironmentError
+    start_time=time.time()
     try:
         if stdout_file:
-            if shell:
-                p_out = subprocess.check_call(" ".join(command), stdout=stdout, shell=True)
-            else:
-                # run command, raise CalledProcessError if return code is non-zero
-                p_out = subprocess.check_call(command, stdout=stdout)
+            process=subprocess.Popen(" ".join(command) if shell else command, stdout=stdout, shell=shell)
+            output=None
         else:
-            p_out = subprocess.check_output(command, stderr=subprocess.STDOUT)
+            process=subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output=process.stdout.read()
+            process.stdout.close()
+        returncode, cpu_time = wait_for_process(process)
+        if stdout_file:
+            stdout.close()
+        # raise CalledProcessError if return code is non-zero
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output=output)
+        p_out = output if output is not None else returncode
         logger.debug(p_out)
     except (EnvironmentError, subprocess.CalledProcessError) as e:
         message="Error executing: " + " ".join(command) + "\n"
@@ -222,11 +509,20 @@ def run_command(command,command_name,infiles,outfiles,stdout_file,verbose,exit_o
         else:
             print(message)
             raise
+        
+    message="Total time for " + command_name + " : {0:.2f} seconds wall time".format(time.time()-start_time)
+    if cpu_time is not None:
+        message+=", {0:.2f} seconds cpu time".format(cpu_time)
+    logger.info(message)
+    if verbose:
+        print(message)
 
     # check that the output files exist and are readable
     for file in outfiles:
         logger.debug("Checking output file from "+command_name+" : "+file)
         is_file_readable(file, exit_on_error) 
+        
+    return p_out
     
             
 def format_options_to_list(input_options):
@@ -287,11 +583,71 @@ def gunzip_file(gzip_file, new_file):
         
     return new_file
 
+def compress_file(file, threads=1):
+    """ Compress the file to BGZF (gzip compatible) using the threads provided, removing the original """
+
+    new_file=file+config.gzip_file_extension
+    
+    message="Compressing file: " + file
+    logger.info(message)
+
+    try:
+        with open(file, "rb") as file_read:
+            with bgzf.BgzfWriter(new_file, threads) as file_write:
+                for block in iter(lambda: file_read.read(config.file_read_block_size), b""):
+                    file_write.write(block)
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to compress file: " + file)
+    
+    remove_file(file)
+    logger.info("Compressed file created: " + new_file)
+    
+    return new_file
+
+def find_intermediate_output_files(output_folder, output_prefix, final_output_files):
+    """ Find the fastq files written by the workflow that are not final output files """
+    
+    intermediate_files=[]
+    for file in sorted(os.listdir(output_folder)):
+        file=os.path.join(output_folder, file)
+        if (os.path.basename(file).startswith(output_prefix) and file.endswith(config.fastq_file_extension) 
+            and os.path.isfile(file) and not file in final_output_files):
+            intermediate_files.append(file)
+            
+    return intermediate_files
+
 def file_without_extension(file):
     """ Return the basename of the file without the extension """
     
     return os.path.splitext(os.path.basename(file))[0]
 
+def is_file_compressed(file):
+    """ Return true if the file is gzip or bzip2 compressed based on the extension """
+    
+    return file.endswith(".gz") or file.endswith(".bz2")
+
+def remove_compression_extension(file):
+    """ Return the file name without the gzip or bzip2 extension, if present """
+    
+    if is_file_compressed(file):
+        file=os.path.splitext(file)[0]
+        
+    return file
+
+def open_file(file, mode="rt"):
+    """ Open a file for reading, decompressing on the fly if gzip or bzip2 compressed """
+    
+    if file.endswith(".gz"):
+        return gzip.open(file, mode)
+    elif file.endswith(".bz2"):
+        try:
+            return bz2.open(file, mode)
+        except AttributeError:
+            # python2 does not have bz2.open and only reads in binary mode
+            return bz2.BZ2File(file)
+    
+    return open(file, mode)
+
 def get_decompressed_file(file, output_folder, temp_file_list, all_input_files):
     """ Check if a file is compressed, if so decompress """
     
@@ -335,14 +691,52 @@ def sequence_identifier_format_conditions(identifier_seq):
         new_format=True
     return new_format
     
+def can_read_last_lines(file):
+    """ Check if the end of the file can be read without reading through the whole file
+    (true for plain and BGZF files, false for other gzip and bzip2 files) """
+    
+    return not is_file_compressed(file) or bgzf.is_bgzf_file(file)
+
+def read_last_lines(file, n):
+    """ Read the last n lines of the plain or BGZF file seeking from the end """
+    
+    if not can_read_last_lines(file):
+        raise ValueError("Unable to seek to the end of the compressed file: " + file)
+    
+    read_size=config.tail_read_size
+    while True:
+        if is_file_compressed(file):
+            data, file_start=bgzf.read_last_blocks(file, read_size)
+        else:
+            with open(file, "rb") as file_handle:
+                file_handle.seek(0, os.SEEK_END)
+                start=max(0, file_handle.tell()-read_size)
+                file_handle.seek(start)
+                data=file_handle.read()
+            file_start=start == 0
+        
+        lines=[line+b"\n" for line in data.split(b"\n")]
+        # the last line does not have a new line, and is empty if the file ends with a new line
+        lines[-1]=lines[-1][:-1]
+        if not lines[-1]:
+            lines.pop()
+        # the first line is partial unless the data is from the start of the file
+        if not file_start and lines:
+            lines=lines[1:]
+        if len(lines) >= n or file_start:
+            return lines[-n:] if n > 0 else []
+        read_size*=4
+
 def get_last_n_seq_identifiers(file, n):
+    """ Get the sequence identifiers from the last n lines of the file (none for compressed
+    files that are not BGZF, as these would need a full extra pass to read the end) """
+    
     last_seq_identifiers=[]
-    # Tail to find last lines
-    try:
-        process = subprocess.Popen(['tail', '-'+str(n), file], stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError:
-        pass
-    for i,line in enumerate(process.stdout.readlines()):
+    if not can_read_last_lines(file):
+        logger.debug("Not checking the last sequence identifiers of the compressed file: " + file)
+        return last_seq_identifiers
+    
+    for i,line in enumerate(read_last_lines(file, n)):
         if (i%4==0):
             last_seq_identifiers.append(line.decode("utf-8")) 
     return last_seq_identifiers
@@ -364,6 +758,55 @@ def get_first_n_seq_identifiers(file,n):
 
 
         
+def get_identifier_without_pair(identifier):
+    """ Get the sequence identifier without the pair, for identifiers in the old or new illumina format """
+    
+    identifier=identifier.split()[0] if identifier.strip() else ""
+    return identifier[:-2] if identifier[-2:] in ["/1","/2"] else identifier
+
+def check_pair_ends(input_files, n=100):
+    """ Check the first and last n read identifiers of the pair files match (reading only
+    the start and the end of the files, and only the start for compressed files that are not BGZF) """
+    
+    check_last=all(can_read_last_lines(file) for file in input_files)
+    identifiers=[]
+    for file in input_files:
+        identifiers.append([get_identifier_without_pair(identifier) for identifier in
+            get_first_n_seq_identifiers(file, n)+(get_last_n_seq_identifiers(file, n*4) if check_last else [])])
+    
+    return identifiers[0] == identifiers[1]
+
+def get_pair_identifier(input_index):
+    """ Get the identifier to add to the reads for the input file """
+    
+    return b"#0/1" if input_index == 0 else b"#0/2"
+
+def reformat_identifier(record, pair_identifier):
+    """ Reformat the sequence identifier for the fastq record """
+    
+    header, sequence, plus, quality = record
+    if b" " in header:
+        # only use the first part of the sequence identifier as the second part might include the read id
+        # (the pair identifier is always added to these as done with the prior line based reformat)
+        header=header.split(b" ")[0]+pair_identifier
+        plus=b"+"
+    elif not header.endswith(b"/1") and not header.endswith(b"/2"):
+        header=header.rstrip()+pair_identifier
+        # keep the quality id empty for biopython dependency 
+        plus=b"+"
+        
+    return (header, sequence, plus, quality)
+
+def get_reformatted_identifiers_file(file, output_folder):
+    """ Create the temp file to write the reformatted reads """
+    
+    # make .fastq temp file (the input is read decompressed, so the new file is not compressed)
+    file_out, new_file=tempfile.mkstemp(prefix="reformatted_identifiers",
+        suffix="_"+os.path.basename(remove_compression_extension(file)), dir=output_folder)
+    os.close(file_out)
+    
+    return new_file
+        
 def get_reformatted_identifiers(file, input_index, output_folder, temp_file_list, all_input_files):
     """ Reformat the sequence identifiers in the fastq file writing to a temp file """
     
@@ -377,34 +820,74 @@ def get_reformatted_identifiers(file, input_index, output_folder, temp_file_list
     print(message+"\n")
     logger.info(message)   
     
-    # make .fastq temp file
-    file_out, new_file=tempfile.mkstemp(prefix="reformatted_identifiers",
-        suffix="_"+os.path.basename(file), dir=output_folder)
-    os.close(file_out)
+    new_file=get_reformatted_identifiers_file(file, output_folder)
+    pair_identifier=get_pair_identifier(input_index)
     
-    with open(new_file, "wt") as file_handle:
-        for lines in read_file_n_lines(file,4):
+    total_reads=0
+    with open(new_file, "wb") as file_handle:
+        for record in read_fastq_records(file):
+            total_reads+=1
             # reformat the identifier and write to temp file
-            if " " in lines[0]:
-                # only use the first part of the sequence identifier as the second part might include the read id
-                lines[0]=lines[0].split(" ")[0]
-                lines[2]="+\n"
-            if not lines[0].endswith("/1\n") and not lines[0].endswith("/2\n"):  
-                if (input_index == 0):
-                    lines[0]=lines[0].rstrip()+"#0/1\n"
-                else:
-                    lines[0]=lines[0].rstrip()+"#0/2\n"
-                # keep the quality id empty for biopython dependency 
-                lines[2]="+\n"
-                    
-                    
-            file_handle.write("".join(lines))
+            file_handle.write(format_fastq_record(reformat_identifier(record, pair_identifier)))
+    record_read_count(new_file, total_reads)
     
     # add the new file to the list of temp files
     update_temp_output_files(temp_file_list, new_file, all_input_files)
     
     return new_file
 
+def get_reformatted_identifiers_for_pairs(input_files, output_folder, temp_file_list, check_order=True):
+    """ Reformat the sequence identifiers in the pair files as needed, while counting the reads
+    and checking the order of the pairs, reading through both (compressed or decompressed) 
+    files once together. Return the pair files and the pair order. """
+    
+    reformat_files=[check_sequence_identifier_format(file) for file in input_files]
+    
+    if not check_order and not check_pair_ends(input_files):
+        message="WARNING: The first and last read identifiers of the pair files do not match, "+\
+            "the pairs might not be ordered"
+        logger.warning(message)
+        print(message)
+    
+    if not any(reformat_files) and not check_order:
+        return input_files, None
+    
+    if any(reformat_files):
+        message="Reformatting file sequence identifiers ..."
+        print(message+"\n")
+        logger.info(message)
+    
+    new_files=[get_reformatted_identifiers_file(file, output_folder) if reformat else None
+        for file, reformat in zip(input_files, reformat_files)]
+    file_handles=[open(file, "wb") if file else None for file in new_files]
+    pair_identifiers=[get_pair_identifier(index) for index in range(len(input_files))]
+    
+    pair_order=PairOrderChecker()
+    for records in zip_longest(*[read_fastq_records(file, header_only=not reformat) 
+        for file, reformat in zip(input_files, reformat_files)]):
+        ids=[]
+        for index, record in enumerate(records):
+            if record is None:
+                ids.append(None)
+            elif reformat_files[index]:
+                record=reformat_identifier(record, pair_identifiers[index])
+                file_handles[index].write(format_fastq_record(record))
+                ids.append(get_read_id_minus_pair(record[0]))
+            else:
+                ids.append(get_read_id_minus_pair(record))
+        pair_order.add(*ids)
+    
+    for index, file_handle in enumerate(file_handles):
+        if file_handle:
+            file_handle.close()
+            input_files[index]=new_files[index]
+            update_temp_output_files(temp_file_list, new_files[index], input_files)
+    
+    for file, total_reads in zip(input_files, pair_order.total_reads):
+        record_read_count(file, total_reads)
+            
+    return input_files, pair_order
+
 def bam_to_sam(bam_file, new_file):
     """
     Convert from a bam to sam file
@@ -421,49 +904,60 @@ def bam_to_sam(bam_file, new_file):
     
     logger.info("Sam file created at: " + new_file)
     
-def bam_to_fastq(bam_file, new_file, output_folder):
-    """ Convert bam file to single or set of fastq files """
-
-    exe=config.samtools_exe
-    args=["bam2fq",bam_file]
+def bam_to_fastq(bam_file, new_file, output_folder, threads=1):
+    """ Convert bam file to single or set of fastq files, splitting the mates of the
+    pairs from the single end reads in one pass with multiple threads for decompression """
 
     message="Converting bam file to fastq format ..."
     print(message)
     logger.info(message)
-    
-    run_command([exe]+args, exe, [bam_file], [new_file], new_file, verbose=False,exit_on_error=True)
 
-    # check for paired-end output
+    filename=file_without_extension(bam_file)
+    pair_files=[os.path.join(output_folder,file_without_extension(filename)+"_decompressed_R"+str(mate)+".fastq") for mate in [1,2]]
     try:
-        output=subprocess.check_output("grep '^@.*/2$' "+new_file,shell=True)
-    except (EnvironmentError, subprocess.CalledProcessError):
-        output=[]
+        file_handles=[open(file,"wb") for file in pair_files+[new_file]]
+    except EnvironmentError:
+        sys.exit("CRITICAL ERROR: Unable to write fastq files from bam file: " + bam_file)
 
-    if output:
-        # pairs found
-        filename=file_without_extension(bam_file)
-        pair1_file=os.path.join(output_folder,file_without_extension(filename)+"_decompressed_R1"+".fastq")
-        pair2_file=os.path.join(output_folder,file_without_extension(filename)+"_decompressed_R2"+".fastq")
+    try:
+        total_pairs, total_single=bam.split_reads(bam_file, file_handles[:2], file_handles[2], threads)
+    except (EnvironmentError, ValueError) as error:
+        sys.exit("CRITICAL ERROR: Unable to read bam file: " + bam_file + " : " + str(error))
+    finally:
+        for file_handle in file_handles:
+            file_handle.close()
 
-        run_command(["grep","'^@.*/1$'",new_file,"-A 3","--no-group-separator"],"bam to fastq R1",[new_file],[pair1_file],pair1_file,verbose=False,exit_on_error=True,shell=True)
-        run_command(["grep","'^@.*/2$'",new_file,"-A 3","--no-group-separator"],"bam to fastq R2",[new_file],[pair2_file],pair2_file,verbose=False,exit_on_error=True,shell=True)
+    return select_split_fastq_files(pair_files, new_file, total_pairs, total_single, "bam")
 
-        remove_file(new_file)
+def select_split_fastq_files(pair_files, new_file, total_pairs, total_single, input_type):
+    """ Return the pair files if pairs were written (removing the empty files), otherwise
+    the single file, recording the read counts for the files """
+
+    if total_pairs:
+        # pairs found
+        for file in pair_files:
+            record_read_count(file, total_pairs)
+        if total_single:
+            record_read_count(new_file, total_single)
+            message="The reads in the "+input_type+" file without a mate are not processed, written to file: " + new_file
+            logger.warning(message)
+            print(message)
+        else:
+            remove_file(new_file)
+        return pair_files
 
-        new_file=[pair1_file,pair2_file]
+    for file in pair_files:
+        remove_file(file)
+    record_read_count(new_file, total_single)
 
     return new_file
 
 
-def get_fastq_from_bam_file(file, output_folder, temp_file_list, all_input_files):
-    """ Look for paired input files from bam, requires samtools """
+def get_fastq_from_bam_file(file, output_folder, temp_file_list, all_input_files, threads=1):
+    """ Look for paired input files from bam """
     if file.endswith(".bam"):
-        # Check for the samtools software
-        if not find_exe_in_path(config.samtools_exe):
-            sys.exit("CRITICAL ERROR: The samtools executable can not be found. "
-            "Please check the install or select another input format.")
         new_file=os.path.join(output_folder,file_without_extension(file)+"_decompressed"+".fastq")
-        new_file=bam_to_fastq(file, new_file, output_folder) 
+        new_file=bam_to_fastq(file, new_file, output_folder, threads) 
         update_temp_output_files(temp_file_list, new_file, all_input_files)
     else:
         new_file=file
@@ -488,46 +982,39 @@ def get_sam_from_bam_file(file, output_folder, temp_file_list, all_input_files):
     return new_file
 
 def sam_to_fastq(file, new_file):
-    """ Create a fastq file from the sam file """
+    """ Create a fastq file from the sam file, or a set of fastq files if the sam file
+    has pairs, writing each primary read once in one pass """
     
     message="Converting sam file to fastq format ..."
     print(message+"\n")
     logger.info(message)    
     
-    # First read in all of the ids
-    # Read then write to not write duplicates
-    # Also do not store all sequences and quality scores here to save space
-    ids=set()
-    with open(file) as file_handle:
-        for line in file_handle:
-            if not re.search("^@",line):
-                data=line.rstrip().split(config.sam_delimiter)
-                ids.add(data[config.sam_read_name_index])
-        
-    # Now read through the file again, writing out fastq sequences
-    with open(file) as file_handle:
-        with open(new_file, "w") as write_file_handle:
-            for line in file_handle:
-                if not re.search("^@",line):
-                    data=line.rstrip().split(config.sam_delimiter)
-                    read_id=data[config.sam_read_name_index]
-                    if read_id in ids:
-                        write_file_handle.write("@"+read_id+"\n")
-                        write_file_handle.write(data[config.sam_read_index]+"\n")
-                        write_file_handle.write("+\n")
-                        write_file_handle.write(data[config.sam_read_quality]+"\n")
-                        # remove the id so as to not write it more than once
-                        ids.remove(read_id)
+    name, extension=os.path.splitext(new_file)
+    pair_files=[name+"_R"+str(mate)+extension for mate in [1,2]]
+    try:
+        file_handles=[open(file_name,"wb") for file_name in pair_files+[new_file]]
+    except EnvironmentError:
+        sys.exit("CRITICAL ERROR: Unable to write fastq files from sam file: " + file)
+
+    try:
+        total_pairs, total_single=bam.split_sam_reads(file, file_handles[:2], file_handles[2])
+    except (EnvironmentError, ValueError, IndexError) as error:
+        sys.exit("CRITICAL ERROR: Unable to read sam file: " + file + " : " + str(error))
+    finally:
+        for file_handle in file_handles:
+            file_handle.close()
+
+    return select_split_fastq_files(pair_files, new_file, total_pairs, total_single, "sam")
 
 def get_fastq_from_sam_file(file, output_folder, temp_file_list, all_input_files):
-    """ Check if a file is sam, if so create a fastq file """
+    """ Check if a file is sam, if so create a fastq file (or set of files for pairs) """
     
     if file.endswith(".sam"):
         new_basename=file_without_extension(file)
         if not "decompressed" in new_basename:
             new_basename+="_decompressed"
         new_file=os.path.join(output_folder,new_basename+config.fastq_file_extension)
-        sam_to_fastq(file,new_file)
+        new_file=sam_to_fastq(file,new_file)
         update_temp_output_files(temp_file_list, new_file, all_input_files)
     else:
         new_file=file
@@ -548,11 +1035,8 @@ def get_file_format(file):
         logger.critical("The input file selected is not readable: %s.",file)
 
     try:
-        # check for gzipped files
-        if file.endswith(".gz"):
-            file_handle = gzip.open(file, "rt")
-        else:
-            file_handle = open(file, "rt")
+        # check for gzipped or bzipped files
+        file_handle = open_file(file)
 
         first_line = file_handle.readline()
         second_line = file_handle.readline()
@@ -594,28 +1078,68 @@ def log_run_and_arguments(executable, arguments, verbose):
         print(message)
     logger.debug(message)
     
-def count_reads_in_fastq_file(file,verbose):
-    """ Count the number of reads in a fastq file """
+def get_file_fingerprint(file):
+    """ Return the size and modification time of the file """
     
-    total_lines=0
     try:
-        # file is compressed based on extension
-        if file.endswith(".gz"):
-            file_handle=gzip.open(file)
-        else:
-            file_handle=open(file)
-            
-        # count the lines in the file
-        for line in file_handle:
-            total_lines+=1
-            
-        file_handle.close()
+        stat=os.stat(file)
     except EnvironmentError:
-        total_lines=0
-        message="Unable to count reads in file: "+file
-        if verbose:
-            print(message)
-        logger.debug(message)
+        return None
+    
+    return (stat.st_size, stat.st_mtime)
+
+def record_read_count(file, total_reads):
+    """ Store the number of reads written to a file so it does not need to be read again to count
+    (or the number of reads streamed to the next step for a file that is not written) """
+    
+    read_counts[file]=(get_file_fingerprint(file), total_reads)
+    
+def get_recorded_read_count(file):
+    """ Return the number of reads recorded for the file or None if not recorded or the file has changed """
+    
+    if not file in read_counts:
+        return None
+    
+    fingerprint, total_reads = read_counts[file]
+    if fingerprint != get_file_fingerprint(file):
+        return None
+    
+    return total_reads
+
+def count_lines_in_file(file):
+    """ Count the lines in a file reading large binary blocks """
+    
+    total_lines=0
+    last_block=b""
+    with open_file(file, "rb") as file_handle:
+        for block in iter(lambda: file_handle.read(config.file_read_block_size), b""):
+            total_lines+=block.count(b"\n")
+            last_block=block
+    
+    # count the last line if it does not end with a new line
+    if last_block and not last_block.endswith(b"\n"):
+        total_lines+=1
+        
+    return total_lines
+
+def count_reads_in_fastq_file(file,verbose):
+    """ Count the number of reads in a fastq file """
+    
+    # use the count recorded by the step that wrote the file, if available
+    recorded_reads=get_recorded_read_count(file)
+    if recorded_reads is not None:
+        total_lines=recorded_reads*4
+    else:
+        try:
+            # file is decompressed on the fly based on extension
+            total_lines=count_lines_in_file(file)
+            record_read_count(file, total_lines//4)
+        except EnvironmentError:
+            total_lines=0
+            message="Unable to count reads in file: "+file
+            if verbose:
+                print(message)
+            logger.debug(message)
         
     # divide the total line number to get the total number of reads
     total_reads=total_lines/4
@@ -733,6 +1257,35 @@ def check_file_executable(exe):
     except subprocess.CalledProcessError:
         pass
 
+def read_sample_sheet(file):
+    """ Read the tab-delimited sample sheet of sample names and input files (one or two per sample) """
+    
+    samples=[]
+    sample_names=set()
+    try:
+        with open(file) as file_handle:
+            for line in file_handle:
+                data=line.rstrip("\r\n").split("\t")
+                # ignore empty lines and comments
+                if not data[0] or data[0].startswith("#"):
+                    continue
+                if not len(data) in [2,3]:
+                    sys.exit("ERROR: Each line in the sample sheet should have a sample name and one or two input files: " + line)
+                if data[0] in sample_names:
+                    sys.exit("ERROR: The sample name is included more than once in the sample sheet: " + data[0])
+                sample_names.add(data[0])
+                inputs=[os.path.abspath(input_file) for input_file in data[1:]]
+                for input_file in inputs:
+                    is_file_readable(input_file, exit_on_error=True)
+                samples.append((data[0],inputs))
+    except EnvironmentError:
+        sys.exit("ERROR: Unable to read sample sheet: " + file)
+        
+    if not samples:
+        sys.exit("ERROR: No samples found in the sample sheet: " + file)
+        
+    return samples
+
 def find_dependency(path_provided,exe,name,path_option,bypass_permissions_check):
     """ 
     Check if the dependency can be found in the path provided or in $PATH
@@ -816,6 +1369,55 @@ def find_database_index(directory, database_type):
     
     return index
 
+def get_database_index_files(index, database_type):
+    """ Get the files for the database index """
+    
+    if database_type == "bmtagger":
+        all_extensions=config.bmtagger_db_endings
+    else:
+        # include the extensions for a large bowtie2 index
+        all_extensions=config.bowtie2_db_endings+[extension+"l" for extension in config.bowtie2_db_endings]
+        
+    return [index+extension for extension in all_extensions if os.path.isfile(index+extension)]
+
+def get_database_index_size(index, database_type):
+    """ Get the total size (in bytes) of the files for the database index """
+    
+    return sum(os.path.getsize(file) for file in get_database_index_files(index, database_type))
+
+def preload_database_index(index, database_type):
+    """ Read the database index files into the page cache so the processes aligning to the
+    index on this node (for this sample and later samples) load it from memory instead of disk """
+    
+    start_time=time.time()
+    total_bytes=0
+    buffer=bytearray(config.file_read_block_size)
+    for file in get_database_index_files(index, database_type):
+        try:
+            with open(file, "rb") as file_handle:
+                # request read ahead of the whole file, if available on this platform
+                try:
+                    os.posix_fadvise(file_handle.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                except (AttributeError, OSError):
+                    pass
+                # read through the file to make sure all of the pages are loaded
+                while True:
+                    bytes_read=file_handle.readinto(buffer)
+                    if not bytes_read:
+                        break
+                    total_bytes+=bytes_read
+        except EnvironmentError:
+            message="Unable to preload database index file: " + file
+            logger.warning(message)
+            print(message)
+    
+    seconds=time.time()-start_time
+    message="Preloaded database index ( " + index + " ) : {0:.2f} GB in {1:.2f} seconds".format(total_bytes/(1024.0**3), seconds)
+    logger.info(message)
+    print(message)
+    
+    return seconds
+
 def file_size(file):
     """ Return the size of the file """
     
@@ -935,7 +1537,7 @@ def read_file_n_lines(file,n):
     """ Read a file n lines at a time """
     
     line_set=[]
-    with open(file) as file_handle:
+    with open_file(file) as file_handle:
         for line in file_handle:
             if len(line_set) == n:
                 yield line_set
@@ -946,11 +1548,93 @@ def read_file_n_lines(file,n):
     if len(line_set) == n:
         yield line_set
         
+def read_fastq_records(file, header_only=False):
+    """ Read a fastq file in large blocks yielding each record as a tuple of its
+    four lines (as bytes without line endings, including windows line endings)
+    or only the identifier line if header_only is set """
+    
+    remainder=b""
+    with open_file(file, "rb") as file_handle:
+        # read the data available (up to the block size) so reads from a fifo do not
+        # wait for a full block (python2 file objects do not have read1)
+        read=getattr(file_handle, "read1", file_handle.read)
+        while True:
+            block=read(config.file_read_block_size)
+            if not block:
+                break
+            data=remainder+block
+            # the remainder holds the end of the last block so a line ending split between blocks is found
+            if b"\r" in data:
+                data=data.replace(b"\r\n", b"\n")
+            lines=data.split(b"\n")
+            
+            # hold the partial last line and any incomplete record for the next block
+            total=(len(lines)-1)//4*4
+            remainder=b"\n".join(lines[total:])
+            
+            if header_only:
+                for header in lines[0:total:4]:
+                    yield header
+            else:
+                for record in zip(lines[0:total:4],lines[1:total:4],lines[2:total:4],lines[3:total:4]):
+                    yield record
+    
+    # the last record might not end with a new line
+    if remainder.endswith(b"\r"):
+        remainder=remainder[:-1]
+    lines=remainder.split(b"\n")
+    if len(lines) >= 4:
+        if header_only:
+            yield lines[0]
+        else:
+            yield tuple(lines[:4])
+            
+def get_sorted_read_id_hashes(file):
+    """ Return a sorted array of the 64-bit hashes of the read identifiers in the fastq file
+    (a numpy array if numpy is installed, otherwise a python array) """
+    
+    hashes=(hash(header) for header in read_fastq_records(file, header_only=True))
+    try:
+        import numpy
+        sorted_hashes=numpy.fromiter(hashes, dtype=numpy.int64)
+        sorted_hashes.sort()
+    except ImportError:
+        sorted_hashes=array.array(hash_typecode, sorted(hashes))
+        
+    return sorted_hashes
+
+def hashes_in_sorted_array(hashes, sorted_hashes):
+    """ Return a list of booleans indicating if each hash is in the sorted array of hashes """
+    
+    if not len(sorted_hashes):
+        return [False]*len(hashes)
+    
+    try:
+        import numpy
+    except ImportError:
+        numpy=None
+        
+    if numpy is not None and isinstance(sorted_hashes, numpy.ndarray):
+        hashes=numpy.array(hashes, dtype=numpy.int64)
+        index=numpy.minimum(numpy.searchsorted(sorted_hashes, hashes), len(sorted_hashes)-1)
+        return (sorted_hashes[index] == hashes).tolist()
+    
+    found=[]
+    for value in hashes:
+        index=bisect.bisect_left(sorted_hashes, value)
+        found.append(index < len(sorted_hashes) and sorted_hashes[index] == value)
+    return found
+
+def format_fastq_record(record):
+    """ Join the lines of a fastq record for writing """
+    
+    return b"\n".join(record)+b"\n"
+
 def get_read_length_fastq(file):
     """ Get the read length from a fastq file """
     
     try:
-        file_handle=open(file)
+        file_handle=open_file(file)
     except EnvironmentError:
         sys.exit("Unable to read file: " + file)
         
@@ -989,21 +1673,37 @@ def get_default_trimmomatic_options(read_length=None, path="", type="SE", sequen
                 config.trimmomatic_slidingwindow_option,
                 config.trimmomatic_minlen_option_tag+config.trimmomatic_option_delimiter+str(minlen)]
     
-def cat_files(files,output_file):
-    """ Cat the files to a single file """
+def cat_files(files,output_file,compress_threads=None):
+    """ Cat the files to a single file, writing BGZF directly if compress threads are provided """
     
     # check that the files exist
     file_list=list(filter(os.path.isfile,files))
     
-    try:
-        stdout=open(output_file,"w")
-    except EnvironmentError:
-        sys.exit("ERROR: Unable to open file: " + output_file)
-    
-    try:
-        subprocess.check_call(["cat"]+file_list,stdout=stdout)
-    except (subprocess.CalledProcessError,EnvironmentError):
-        sys.exit("ERROR: Unable to cat files.")
+    if compress_threads:
+        try:
+            with bgzf.BgzfWriter(output_file, compress_threads) as file_write:
+                for file in file_list:
+                    with open(file, "rb") as file_read:
+                        for block in iter(lambda: file_read.read(config.file_read_block_size), b""):
+                            file_write.write(block)
+        except EnvironmentError:
+            sys.exit("ERROR: Unable to cat files.")
+    else:
+        try:
+            stdout=open(output_file,"w")
+        except EnvironmentError:
+            sys.exit("ERROR: Unable to open file: " + output_file)
+        
+        try:
+            subprocess.check_call(["cat"]+file_list,stdout=stdout)
+        except (subprocess.CalledProcessError,EnvironmentError):
+            sys.exit("ERROR: Unable to cat files.")
+        stdout.close()
+        
+    # the total reads is the sum of the reads in the files, if all are known
+    total_reads=[get_recorded_read_count(file) for file in file_list]
+    if not None in total_reads:
+        record_read_count(output_file, sum(total_reads))
 
 def fastq_to_fasta(file, new_file):
     """
@@ -1056,6 +1756,56 @@ def fastq_to_fasta(file, new_file):
 
     return new_file    
 
+def get_trf_temp_folder(default_folder):
+    """ Get the folder for the TRF temp files, which can be set with KNEADDATA_TRF_TMP
+    to keep the paths short (TRF can fail with long paths) """
+    
+    tmp_dir = os.environ.get("KNEADDATA_TRF_TMP")
+    if tmp_dir:
+        try:
+            os.makedirs(tmp_dir)
+        except OSError:
+            # the folder exists or can not be created, if so fall back to the default folder
+            if not os.path.isdir(tmp_dir):
+                tmp_dir = default_folder
+    else:
+        tmp_dir = default_folder
+        
+    return tmp_dir or "."
+
+def fastq_to_fasta_chunks(file, total_chunks, output_folder, reads_per_chunk=None):
+    """ Convert the fastq file to fasta files of (at most) the total chunks, 
+    balancing the number of reads in each chunk, in a single pass through the fastq file.
+    If the reads per chunk are provided, write chunks of this size instead. """
+    
+    # use the read count, if recorded when the file was written, to balance the chunks
+    if not reads_per_chunk:
+        total_reads=int(count_reads_in_fastq_file(file, False))
+        reads_per_chunk=max(1,-(-total_reads // max(1,total_chunks)))
+    
+    chunk_files=[]
+    file_handle=None
+    reads_written=0
+    for header, sequence, plus, quality in read_fastq_records(file):
+        # skip reads without sequences (as they are not written to fasta)
+        if not sequence:
+            continue
+        if file_handle is None or reads_written >= reads_per_chunk:
+            if file_handle:
+                file_handle.close()
+            file_out, chunk_file=tempfile.mkstemp(prefix="kd_trf_{:03d}_".format(len(chunk_files)),
+                suffix=config.fasta_file_extension, dir=output_folder)
+            file_handle=os.fdopen(file_out, "wb")
+            chunk_files.append(chunk_file)
+            reads_written=0
+        file_handle.write(b">"+header[1:]+b"\n"+sequence+b"\n")
+        reads_written+=1
+        
+    if file_handle:
+        file_handle.close()
+        
+    return chunk_files
+    
 def write_read_count_table(output, reads):
     """
     Write the table of read counts for all samples